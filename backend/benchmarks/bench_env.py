@@ -0,0 +1,26 @@
+"""Importa farmacia.py con una base SQLite temporal (o BENCH_DATABASE_URL) para los benchmarks."""
+import logging
+import os
+import secrets
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def import_farmacia():
+    if "DATABASE_URL" not in os.environ:
+        tmp = tempfile.mkdtemp(prefix="bench-farmacia-")
+        os.environ["DATABASE_URL"] = os.getenv("BENCH_DATABASE_URL", f"sqlite:///{tmp}/bench.db")
+    from cryptography.fernet import Fernet
+    os.environ.setdefault("FERNET_KEYS", Fernet.generate_key().decode())
+    os.environ.setdefault("JWT_KEYS", "bench:" + secrets.token_urlsafe(32))
+    sys.path.insert(0, BACKEND_DIR)
+    logging.disable(logging.WARNING)
+    import farmacia
+    return farmacia
+
+
+def percentiles(samples, points=(50, 99)) -> dict:
+    samples = sorted(samples)
+    return {f"p{p}_ms": round(samples[min(len(samples) - 1, len(samples) * p // 100)] * 1000, 3) for p in points}
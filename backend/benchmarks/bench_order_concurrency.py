@@ -0,0 +1,108 @@
+"""
+Benchmark de POST /orders/ con checkouts concurrentes.
+
+Lanza N órdenes a la vez contra la app (ASGI en proceso) mientras una tarea "latido" mide cuánto
+se retrasa el event loop. Con --hot todas las órdenes compran el mismo producto, que es el caso de
+más espera por FOR UPDATE. En SQLite los writers se serializan; para medir locks de fila usar
+BENCH_DATABASE_URL=mysql+pymysql://...
+
+Uso (desde backend/):
+    python benchmarks/bench_order_concurrency.py --orders 400 --concurrency 32 [--hot]
+"""
+import argparse
+import asyncio
+import random
+import time
+
+import httpx
+
+from bench_env import import_farmacia, percentiles
+
+
+async def heartbeat(stop: asyncio.Event, lags: list, interval: float = 0.005):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+def seed(farmacia, clients: int, products: int) -> tuple:
+    """Clientes con dirección y productos con stock de sobra; devuelve (tokens, direcciones, product_ids)."""
+    db = farmacia.SessionLocal()
+    try:
+        role = db.query(farmacia.RoleDB).filter_by(name="cliente").one()
+        category = db.query(farmacia.CategoryDB.id).first()[0]
+        users = [farmacia.UserDB(username=f"bench{i}", hashed_password="-", role_id=role.id) for i in range(clients)]
+        db.add_all(users)
+        db.flush()
+        addresses = [farmacia.AddressDB(user_id=u.id, latitude=4.6, longitude=-74.0) for u in users]
+        db.add_all(addresses)
+        db.execute(farmacia.insert(farmacia.ProductDB), [
+            {"name": f"Producto bench {i}", "stock": 10**9, "price": 1000, "category_id": category}
+            for i in range(products)
+        ])
+        db.commit()
+        product_ids = [pid for (pid,) in db.query(farmacia.ProductDB.id).filter(farmacia.ProductDB.name.like("Producto bench %"))]
+        tokens = [farmacia.create_access_token({"sub": u.username}) for u in users]
+        return tokens, [a.id for a in addresses], product_ids
+    finally:
+        db.close()
+
+
+async def run(farmacia, args) -> dict:
+    rng = random.Random(7)
+    tokens, addresses, product_ids = seed(farmacia, args.clients, args.products)
+    transport = httpx.ASGITransport(app=farmacia.app)
+    async with farmacia.app.router.lifespan_context(farmacia.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            semaphore = asyncio.Semaphore(args.concurrency)
+            latencies, statuses = [], {}
+
+            async def place(i: int):
+                c = i % len(tokens)
+                items = (
+                    [{"product_id": product_ids[0], "quantity": 1}] if args.hot
+                    else [{"product_id": pid, "quantity": 1} for pid in rng.sample(product_ids, 3)]
+                )
+                async with semaphore:
+                    start = time.perf_counter()
+                    response = await client.post(
+                        "/orders/", json={"address_id": addresses[c], "items": items},
+                        headers={"Authorization": f"Bearer {tokens[c]}"}
+                    )
+                    latencies.append(time.perf_counter() - start)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+            stop, lags = asyncio.Event(), []
+            beat = asyncio.create_task(heartbeat(stop, lags))
+            start = time.perf_counter()
+            await asyncio.gather(*[place(i) for i in range(args.orders)])
+            elapsed = time.perf_counter() - start
+            stop.set()
+            await beat
+    lags.sort()
+    return {
+        "orders": args.orders,
+        "concurrency": args.concurrency,
+        "hot": args.hot,
+        "statuses": statuses,
+        "orders_per_s": round(args.orders / elapsed, 1),
+        **percentiles(latencies),
+        "loop_lag_p50_ms": round(lags[len(lags) // 2] * 1000, 2) if lags else None,
+        "loop_lag_max_ms": round(lags[-1] * 1000, 2) if lags else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orders", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--products", type=int, default=200)
+    parser.add_argument("--hot", action="store_true", help="todas las órdenes compran el mismo producto")
+    args = parser.parse_args()
+    print(asyncio.run(run(import_farmacia(), args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Benchmark del hashing de contraseñas: inline en el event loop (antes) vs pool de procesos (después).
+
+Lanza N hashes concurrentes mientras una tarea "latido" mide cuánto se retrasa el event loop,
+que es lo que sufren las demás peticiones del worker durante un pico de logins.
+
+Con --endpoints mide lo mismo extremo a extremo contra la app (ASGI en proceso): throughput de
+POST /token con logins concurrentes y latencia p50/p99 de GET /users/me y GET /categories/ antes
+y durante el pico.
+
+Uso (desde backend/):
+    python benchmarks/bench_password_hashing.py --jobs 32 --workers 2
+    python benchmarks/bench_password_hashing.py --endpoints --logins 200 --concurrency 16
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from cryptography.fernet import Fernet  # noqa: E402
+
+import httpx  # noqa: E402
+
+import password_hashing  # noqa: E402
+from bench_env import import_farmacia, percentiles  # noqa: E402
+
+
+async def heartbeat(stop: asyncio.Event, lags: list, interval: float = 0.005):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def run(mode: str, jobs: int, executor) -> dict:
+    stop, lags = asyncio.Event(), []
+    beat = asyncio.create_task(heartbeat(stop, lags))
+    await asyncio.sleep(0.05)
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    if mode == "inline":
+        for i in range(jobs):
+            password_hashing.get_password_hash(f"clave-{i}")
+            await asyncio.sleep(0)
+    else:
+        await asyncio.gather(*[
+            loop.run_in_executor(executor, password_hashing.get_password_hash, f"clave-{i}")
+            for i in range(jobs)
+        ])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await beat
+    lags.sort()
+    return {
+        "mode": mode,
+        "jobs": jobs,
+        "total_s": round(elapsed, 3),
+        "hashes_per_s": round(jobs / elapsed, 1),
+        "loop_lag_p50_ms": round(lags[len(lags) // 2] * 1000, 2) if lags else None,
+        "loop_lag_max_ms": round(lags[-1] * 1000, 2) if lags else None,
+    }
+
+
+def seed_users(farmacia, users: int) -> list:
+    """Clientes con la misma contraseña (un solo hash: el seed no debe medir bcrypt)."""
+    db = farmacia.SessionLocal()
+    try:
+        role = db.query(farmacia.RoleDB).filter_by(name="cliente").one()
+        hashed = farmacia.get_password_hash("clave-bench")
+        db.execute(farmacia.insert(farmacia.UserDB), [
+            {"username": f"login{i}", "hashed_password": hashed, "role_id": role.id} for i in range(users)
+        ])
+        db.commit()
+        return [f"login{i}" for i in range(users)]
+    finally:
+        db.close()
+
+
+async def probe(client, headers: dict, stop: asyncio.Event, latencies: list):
+    """Peticiones "normales" en serie mientras dure la fase."""
+    paths = ("/users/me", "/categories/")
+    i = 0
+    while not stop.is_set():
+        start = time.perf_counter()
+        response = await client.get(paths[i % len(paths)], headers=headers)
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.text
+        i += 1
+
+
+async def run_endpoints(args) -> list:
+    farmacia = import_farmacia()
+    usernames = seed_users(farmacia, args.users)
+    headers = {"Authorization": f"Bearer {farmacia.create_access_token({'sub': usernames[0]})}"}
+    transport = httpx.ASGITransport(app=farmacia.app)
+    results = []
+    async with farmacia.app.router.lifespan_context(farmacia.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            # Calienta el pool de hashing antes de medir
+            await client.post("/token", data={"username": usernames[0], "password": "clave-bench"})
+
+            stop, idle = asyncio.Event(), []
+            task = asyncio.create_task(probe(client, headers, stop, idle))
+            await asyncio.sleep(args.idle_seconds)
+            stop.set()
+            await task
+            results.append({"phase": "sin logins", "requests": len(idle), **percentiles(idle)})
+
+            semaphore = asyncio.Semaphore(args.concurrency)
+            statuses = {}
+
+            async def login(i: int):
+                async with semaphore:
+                    response = await client.post(
+                        "/token", data={"username": usernames[i % len(usernames)], "password": "clave-bench"}
+                    )
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+            stop, busy = asyncio.Event(), []
+            task = asyncio.create_task(probe(client, headers, stop, busy))
+            start = time.perf_counter()
+            await asyncio.gather(*[login(i) for i in range(args.logins)])
+            elapsed = time.perf_counter() - start
+            stop.set()
+            await task
+            results.append({
+                "phase": "durante logins",
+                "logins": args.logins,
+                "concurrency": args.concurrency,
+                "statuses": statuses,
+                "logins_per_s": round(args.logins / elapsed, 1),
+                "requests": len(busy),
+                **percentiles(busy),
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--endpoints", action="store_true", help="mide /token y otros endpoints contra la app")
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--idle-seconds", type=float, default=2.0)
+    args = parser.parse_args()
+
+    if args.endpoints:
+        # El pool de la app se dimensiona con PASSWORD_HASH_WORKERS al importar farmacia
+        os.environ.setdefault("PASSWORD_HASH_WORKERS", str(args.workers))
+        for result in asyncio.run(run_endpoints(args)):
+            print(result)
+        return
+
+    keys = [Fernet.generate_key().decode()]
+    password_hashing.configure(keys)
+    executor = password_hashing.create_executor(args.workers, keys)
+    # Calienta el pool: el arranque "spawn" no debe contar en la medición
+    executor.submit(password_hashing.get_password_hash, "warmup").result()
+    list(executor.map(password_hashing.get_password_hash, ["warmup"] * args.workers))
+    try:
+        for mode in ("inline", "pool"):
+            print(asyncio.run(run(mode, args.jobs, executor)))
+    finally:
+        executor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Benchmark de GET /products/search: construcción del índice invertido y latencia de búsqueda
+(exacta, por prefijo, con errores de tipeo y multi-palabra) sobre un catálogo sintético.
+
+Uso (desde backend/):
+    python benchmarks/bench_product_search.py --products 100000 --queries 2000
+"""
+import argparse
+import random
+import time
+
+from bench_env import import_farmacia, percentiles
+
+# Palabras reales del dominio (aparecen en muchos productos) + marcas/principios sintéticos (cola larga)
+WORDS = [
+    "acetaminofén", "ibuprofeno", "naproxeno", "loratadina", "cetirizina", "omeprazol", "vitamina",
+    "magnesio", "colágeno", "jarabe", "tabletas", "cápsulas", "suspensión", "crema", "gel", "pediátrico",
+    "forte", "plus", "antigripal", "analgésico", "protector", "solar", "shampoo", "algodón", "gasas",
+    "alcohol", "suero", "oral", "nasal", "ungüento", "descongestionante", "multivitamínico", "zinc",
+]
+
+
+SYLLABLES = ["la", "bo", "fen", "tri", "zol", "mex", "di", "ra", "cor", "vi", "ta", "pro", "nal", "gi", "sol"]
+
+
+def brand_names(rng: random.Random, count: int) -> list:
+    names = set()
+    while len(names) < count:
+        names.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(names)
+
+
+def product_name(rng: random.Random, brands: list) -> str:
+    return " ".join([rng.choice(brands)] + rng.sample(WORDS, 2)) + f" {rng.choice([50, 100, 200, 400, 500])}mg"
+
+
+def mistype(rng: random.Random, word: str) -> str:
+    i = rng.randrange(1, len(word) - 1)
+    return word[:i] + word[i + 1:]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--products", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=2000)
+    args = parser.parse_args()
+
+    farmacia = import_farmacia()
+    rng = random.Random(42)
+    brands = brand_names(rng, max(args.products // 10, 10))
+    db = farmacia.SessionLocal()
+    categories = [c.id for c in db.query(farmacia.CategoryDB.id)]
+    for start in range(0, args.products, 5000):
+        db.execute(farmacia.insert(farmacia.ProductDB), [
+            {"name": f"{product_name(rng, brands)} #{i}", "stock": 10, "price": 1000, "category_id": rng.choice(categories)}
+            for i in range(start, min(start + 5000, args.products))
+        ])
+    db.commit()
+
+    index = farmacia.ProductSearchIndex(refresh_seconds=1e9)
+    start = time.perf_counter()
+    index.rebuild(db)
+    print({"products": args.products, "rebuild_s": round(time.perf_counter() - start, 2)})
+
+    plain = [w.replace("é", "e").replace("á", "a").replace("í", "i").replace("ó", "o").replace("ú", "u") for w in WORDS]
+    long_brands = [b for b in brands if len(b) >= 6]
+    kinds = {
+        "marca": lambda: rng.choice(brands),
+        "marca_prefijo": lambda: rng.choice(long_brands)[:5],
+        "marca_typo": lambda: mistype(rng, rng.choice(long_brands)),
+        "marca_y_palabra": lambda: rng.choice(brands) + " " + rng.choice(WORDS),
+        # Palabras genéricas: casan con ~6% del catálogo cada una, el peor caso de puntaje
+        "generica": lambda: rng.choice(plain),
+        "generica_typo": lambda: mistype(rng, rng.choice([w for w in plain if len(w) >= 6])),
+        "inexistente": lambda: "xq" + str(rng.randrange(10**6)),
+    }
+    for kind, make in kinds.items():
+        queries = [make() for _ in range(args.queries)]
+        samples = []
+        for q in queries:
+            start = time.perf_counter()
+            index.search(db, q, 20)
+            samples.append(time.perf_counter() - start)
+        print({"query": kind, **percentiles(samples)})
+
+    samples = []
+    for i in range(args.queries):
+        start = time.perf_counter()
+        index.upsert(rng.randrange(1, args.products), product_name(rng, brands), "Vitaminas y suplementos")
+        samples.append(time.perf_counter() - start)
+    print({"op": "upsert", **percentiles(samples)})
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Benchmark de GET /admin/analytics/sales: lectura por columnas (fetch_sales_columns) y agregación
+NumPy (aggregate_sales) sobre un histórico sintético de órdenes pagadas.
+
+Uso (desde backend/):
+    python benchmarks/bench_sales_analytics.py --orders 200000 --days 90
+"""
+import argparse
+import random
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from bench_env import import_farmacia
+
+
+def seed(farmacia, orders: int, days: int, products: int):
+    rng = random.Random(3)
+    db = farmacia.SessionLocal()
+    try:
+        categories = [c.id for c in db.query(farmacia.CategoryDB.id)]
+        address = farmacia.AddressDB(user_id=1, latitude=4.6, longitude=-74.0)
+        db.add(address)
+        db.flush()
+        db.execute(farmacia.insert(farmacia.ProductDB), [
+            {"name": f"Producto analytics {i}", "stock": 100, "price": rng.randrange(1000, 90000, 100),
+             "category_id": rng.choice(categories)}
+            for i in range(products)
+        ])
+        product_ids = [pid for (pid,) in db.query(farmacia.ProductDB.id)]
+        start = datetime.utcnow() - timedelta(days=days)
+        for first in range(0, orders, 10_000):
+            ids = range(first + 1, min(first + 10_000, orders) + 1)
+            db.execute(farmacia.insert(farmacia.OrderDB), [
+                {"id": i, "client_id": 1, "address_id": address.id, "total": 0, "payment_status": "paid", "delivery_status": "entregado",
+                 "created_at": start + timedelta(seconds=rng.randrange(days * 86400))}
+                for i in ids
+            ])
+            db.execute(farmacia.insert(farmacia.OrderItemDB), [
+                {"order_id": i, "product_id": rng.choice(product_ids), "quantity": q,
+                 "unit_price": 1000, "discount_applied": 0, "final_price": 1000.0 * q}
+                for i in ids for q in [rng.randint(1, 4) for _ in range(rng.randint(1, 5))]
+            ])
+        db.commit()
+        return start
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orders", type=int, default=200_000)
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--products", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--memory", action="store_true", help="mide el pico de memoria (tracemalloc, mucho más lento)")
+    args = parser.parse_args()
+
+    farmacia = import_farmacia()
+    t0 = time.perf_counter()
+    start = seed(farmacia, args.orders, args.days, args.products)
+    print({"orders": args.orders, "seed_s": round(time.perf_counter() - t0, 1)})
+    end = datetime.utcnow() + timedelta(days=1)
+    db = farmacia.SessionLocal()
+    try:
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            columns = farmacia.fetch_sales_columns(db, start, end, paid_only=True)
+            t1 = time.perf_counter()
+            farmacia.aggregate_sales(columns, top=10)
+            t2 = time.perf_counter()
+            print({"rows": len(columns["order_id"]), "fetch_s": round(t1 - t0, 3), "aggregate_s": round(t2 - t1, 3)})
+        if args.memory:
+            tracemalloc.start()
+            farmacia.fetch_sales_columns(db, start, end, paid_only=True)
+            print({"fetch_peak_mb": round(tracemalloc.get_traced_memory()[1] / 2**20, 1)})
+            tracemalloc.stop()
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
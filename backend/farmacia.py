@@ -1,16 +1,20 @@
 import os
-from datetime import datetime, timedelta
-from typing import List, Optional
+from datetime import date, datetime, timedelta
+from typing import List, Optional, NamedTuple
+from collections import OrderedDict
+import threading
 from dotenv import load_dotenv
-from fastapi import FastAPI, Depends, HTTPException, status, Request, Query, Path, Body
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Depends, HTTPException, status, Request, Query, Path, Body, Header
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
-from passlib.context import CryptContext
-from pydantic import BaseModel, constr, conint
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, ForeignKey, DateTime, Float, func
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, ValidationError, constr, conint
+from sqlalchemy import create_engine, Column, Integer, String, Text, Boolean, ForeignKey, Date, DateTime, Float, Index, func, case, insert, select, update, inspect, text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session, relationship, joinedload
+from sqlalchemy.orm import sessionmaker, Session, relationship, joinedload, selectinload
 import jwt
 import boto3
 from botocore.exceptions import ClientError
@@ -24,12 +28,30 @@ from selenium.common.exceptions import TimeoutException
 import time
 import urllib.parse
 import stripe
-import json, re, logging, requests
-from rapidfuzz import fuzz
-from cryptography.fernet import Fernet, InvalidToken
+import json, re, logging, hashlib
+import httpx
+from rapidfuzz import fuzz, process
+from cryptography.fernet import Fernet
+import password_hashing
+import image_rendering
+from password_hashing import get_password_hash, verify_password, password_needs_rekey, rekey_password_hash
 import secrets
+import uuid
 from math import radians, sin, cos, sqrt, atan2
 import random
+import asyncio
+import bisect
+import heapq
+import unicodedata
+import csv
+import io
+import itertools
+import tempfile
+import zlib
+import numpy as np
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 load_dotenv()
 
@@ -52,42 +74,93 @@ Base = declarative_base()
 # -----------------------------
 # Seguridad: Hashing y cifrado (Fernet)
 # -----------------------------
-# Genera una nueva clave segura
-key = Fernet.generate_key()
-secret = secrets.token_urlsafe(32)
-# Contexto bcrypt para hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+def load_key_list(env_name: str) -> List[str]:
+    """Lee claves separadas por comas desde ENV o desde el archivo indicado en ENV_FILE (una por línea)."""
+    path = os.getenv(f"{env_name}_FILE")
+    if path:
+        with open(path) as f:
+            raw = f.read().replace("\n", ",")
+    else:
+        raw = os.getenv(env_name, "")
+    return [k.strip() for k in raw.split(",") if k.strip()]
+
 # OAuth2 scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-# Clave de cifrado Fernet
-FERNET_KEY = key
-if not FERNET_KEY:
-    raise RuntimeError("FERNET_KEY no configurada")
-cipher_suite = Fernet(FERNET_KEY)
-
-# Funciones de hashing + cifrado de contraseñas
-
-def get_password_hash(password: str) -> str:
-    # 1) genera hash bcrypt
-    bcrypt_hash = pwd_context.hash(password)
-    # 2) cifra el hash con Fernet
-    token = cipher_suite.encrypt(bcrypt_hash.encode())
-    # 3) devuelve el token en base64 (str)
-    return token.decode()
-
-def verify_password(plain_password: str, token_hash: str) -> bool:
+# Claves de cifrado Fernet: la primera cifra, todas descifran (rotación con MultiFernet)
+FERNET_KEYS = load_key_list("FERNET_KEYS")
+if not FERNET_KEYS:
+    logging.getLogger(__name__).warning(
+        "FERNET_KEYS no configurada: se usa una clave efímera, las contraseñas no sobrevivirán a un reinicio"
+    )
+    FERNET_KEYS = [Fernet.generate_key().decode()]
+FERNET_KEY = FERNET_KEYS[0]
+password_hashing.configure(FERNET_KEYS)
+
+# Pool de procesos dedicado al hashing: bcrypt + Fernet son CPU-bound y bloquean
+# el event loop si se ejecutan en el hilo principal.
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
+# Workers "spawn" que solo importan password_hashing; las claves llegan por el initializer
+password_executor = password_hashing.create_executor(PASSWORD_HASH_WORKERS, FERNET_KEYS)
+password_executor_lock = threading.Lock()
+_password_jobs_pending = 0
+
+def rebuild_password_executor(broken):
+    """Reemplaza el pool roto (un worker murió) salvo que otra petición ya lo haya recreado."""
+    global password_executor
+    with password_executor_lock:
+        if password_executor is broken:
+            logging.getLogger(__name__).warning("Pool de hashing roto: se recrea")
+            password_executor = password_hashing.create_executor(PASSWORD_HASH_WORKERS, FERNET_KEYS)
+            broken.shutdown(wait=False, cancel_futures=True)
+        return password_executor
+
+async def run_password_job(func, *args):
+    """Ejecuta una función de hashing en el pool; 503 si la cola está saturada."""
+    global _password_jobs_pending
+    if _password_jobs_pending >= PASSWORD_HASH_MAX_PENDING:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Servicio de autenticación saturado, intenta de nuevo",
+            headers={"Retry-After": "1"}
+        )
+    _password_jobs_pending += 1
     try:
-        # 1) descifra el token a bytes -> bcrypt_hash
-        decrypted = cipher_suite.decrypt(token_hash.encode())
-    except Exception:
-        return False
-    # 2) compara con bcrypt
-    return pwd_context.verify(plain_password, decrypted.decode())
+        loop = asyncio.get_running_loop()
+        executor = password_executor
+        try:
+            return await loop.run_in_executor(executor, func, *args)
+        except BrokenProcessPool:
+            # Un solo reintento con el pool nuevo; si vuelve a romperse, el error sube como 500
+            return await loop.run_in_executor(rebuild_password_executor(executor), func, *args)
+    finally:
+        _password_jobs_pending -= 1
+
+async def get_password_hash_async(password: str) -> str:
+    return await run_password_job(get_password_hash, password)
+
+async def verify_password_async(plain_password: str, token_hash: str) -> bool:
+    return await run_password_job(verify_password, plain_password, token_hash)
 
 # -----------------------------
 # Configuración JWT
 # -----------------------------
-SECRET_KEY = secret
+# Anillo de claves "kid:secreto"; se firma con JWT_ACTIVE_KID y se valida según el kid del token
+JWT_KEYS = {}
+for entry in load_key_list("JWT_KEYS"):
+    kid, _, value = entry.partition(":")
+    if not kid or not value:
+        raise RuntimeError("JWT_KEYS debe tener el formato kid:secreto[,kid:secreto...]")
+    JWT_KEYS[kid] = value
+if not JWT_KEYS:
+    logging.getLogger(__name__).warning(
+        "JWT_KEYS no configurada: se usa una clave efímera, los tokens solo valen en este proceso"
+    )
+    JWT_KEYS = {"local": secrets.token_urlsafe(32)}
+JWT_ACTIVE_KID = os.getenv("JWT_ACTIVE_KID") or next(iter(JWT_KEYS))
+if JWT_ACTIVE_KID not in JWT_KEYS:
+    raise RuntimeError(f"JWT_ACTIVE_KID '{JWT_ACTIVE_KID}' no está en JWT_KEYS")
+SECRET_KEY = JWT_KEYS[JWT_ACTIVE_KID]
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
@@ -123,6 +196,11 @@ class ProductDB(Base):
     category_id = Column(Integer, ForeignKey("categories.id"), nullable=True)
     category = relationship("CategoryDB")
 
+    __table_args__ = (
+        Index("ix_products_category_id_id", "category_id", "id"),
+        Index("ix_products_price", "price"),
+    )
+
 class OrderDB(Base):
     __tablename__ = "orders"
     id = Column(Integer, primary_key=True, index=True)
@@ -138,15 +216,27 @@ class OrderDB(Base):
     address = relationship("AddressDB")
     items = relationship("OrderItemDB", back_populates="order")
 
+    __table_args__ = (
+        Index("ix_orders_client_id_created_at", "client_id", "created_at"),
+        Index("ix_orders_payment_status_created_at", "payment_status", "created_at"),
+    )
+
 class OrderItemDB(Base):
     __tablename__ = "order_items"
     id = Column(Integer, primary_key=True, index=True)
-    order_id = Column(Integer, ForeignKey("orders.id"))
+    # MySQL ya indexa las FK; explícito para que SQLite no recorra order_items por cada orden en los joins
+    order_id = Column(Integer, ForeignKey("orders.id"), index=True)
     product_id = Column(Integer, ForeignKey("products.id"))
     quantity = Column(Integer)
+    # Precio congelado al crear la orden (NULL en órdenes anteriores sin backfill)
+    unit_price = Column(Integer, nullable=True)
+    discount_applied = Column(Float, nullable=True)
+    final_price = Column(Float, nullable=True)
+    promotion_id = Column(Integer, ForeignKey("promotions.id"), nullable=True)
     
     order = relationship("OrderDB", back_populates="items")
     product = relationship("ProductDB")
+    promotion = relationship("PromotionDB")
 
 # Nuevos modelos para movimientos económicos
 class FinancialMovementDB(Base):
@@ -157,6 +247,11 @@ class FinancialMovementDB(Base):
     amount = Column(Float)
     description = Column(String(255))
 
+    __table_args__ = (
+        Index("ix_financial_movements_timestamp_id", "timestamp", "id"),
+        Index("ix_financial_movements_order_id_timestamp_id", "order_id", "timestamp", "id"),
+    )
+
 class StockMovementDB(Base):
     __tablename__ = "stock_movements"
     id = Column(Integer, primary_key=True, index=True)
@@ -165,6 +260,11 @@ class StockMovementDB(Base):
     change = Column(Integer)  # negativo para disminución, positivo para aumento
     description = Column(String(255))
 
+    __table_args__ = (
+        Index("ix_stock_movements_timestamp_id", "timestamp", "id"),
+        Index("ix_stock_movements_product_id_timestamp_id", "product_id", "timestamp", "id"),
+    )
+
 class ExternalPrice(Base):
     __tablename__ = "external_prices"
     id = Column(Integer, primary_key=True, index=True)
@@ -226,13 +326,173 @@ class UserMissionDB(Base):
     completed = Column(Boolean, default=False)
     completed_at = Column(DateTime, nullable=True)
 
+class IdempotencyKeyDB(Base):
+    __tablename__ = "idempotency_keys"
+    id = Column(Integer, primary_key=True)
+    key = Column(String(100), nullable=False)
+    user_id = Column(Integer, nullable=False)
+    endpoint = Column(String(100), nullable=False)
+    fingerprint = Column(String(64), nullable=False)  # sha256 del cuerpo de la request
+    status = Column(String(20), default="processing")  # "processing" o "completed"
+    response_code = Column(Integer, nullable=True)
+    response_body = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    __table_args__ = (
+        Index("ux_idempotency_keys_user_endpoint_key", "user_id", "endpoint", "key", unique=True),
+    )
+
+class StockLedgerBalanceDB(Base):
+    """Suma acumulada de stock_movements por producto hasta el último id conciliado."""
+    __tablename__ = "stock_ledger_balances"
+    product_id = Column(Integer, primary_key=True)
+    balance = Column(Integer, nullable=False, default=0)
+    # Último movimiento incluido en balance: una corrida fallida puede haber avanzado solo algunos productos
+    last_movement_id = Column(Integer, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class StockReconciliationRunDB(Base):
+    __tablename__ = "stock_reconciliation_runs"
+    id = Column(Integer, primary_key=True)
+    status = Column(String(20), default="running")  # "running", "completed" o "failed"
+    # 1 mientras la corrida está en curso y NULL al terminar: el UNIQUE impide dos corridas simultáneas
+    active_slot = Column(Integer, nullable=True, unique=True, index=True)
+    incremental = Column(Boolean, default=True)
+    fix = Column(Boolean, default=False)
+    from_movement_id = Column(Integer, nullable=False)  # exclusivo
+    to_movement_id = Column(Integer, nullable=False)    # inclusivo: high-water mark de la siguiente corrida
+    products_checked = Column(Integer, default=0)
+    discrepancies = Column(Integer, default=0)
+    corrected = Column(Integer, default=0)
+    started_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+class DailySalesRollupDB(Base):
+    """Agregados por día de creación del pedido, mantenidos al crear/confirmar/cancelar órdenes."""
+    __tablename__ = "daily_sales_rollup"
+    day = Column(Date, primary_key=True)
+    orders_count = Column(Integer, nullable=False, default=0)
+    paid_orders_count = Column(Integer, nullable=False, default=0)
+    paid_revenue = Column(Float, nullable=False, default=0.0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class OutboxEventDB(Base):
+    __tablename__ = "outbox_events"
+    id = Column(Integer, primary_key=True)
+    event_type = Column(String(50), nullable=False)
+    payload = Column(Text, nullable=False)  # JSON
+    status = Column(String(20), default="pending")  # "pending", "processing", "done" o "failed"
+    attempts = Column(Integer, default=0)
+    available_at = Column(DateTime, default=datetime.utcnow)
+    claimed_by = Column(String(36), nullable=True)
+    locked_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_outbox_events_status_available_at", "status", "available_at"),
+    )
+
+class OutboxAppliedEventDB(Base):
+    """Marca de efectos aplicados: la PK impide aplicar dos veces un evento re-reclamado tras vencer su lock."""
+    __tablename__ = "outbox_applied_events"
+    event_id = Column(Integer, primary_key=True, autoincrement=False)
+    applied_at = Column(DateTime, default=datetime.utcnow)
+
 
 # Crear todas las tablas
 Base.metadata.create_all(bind=engine)
 
+# create_all no agrega índices a tablas que ya existen: se crean los que falten
+def ensure_indexes():
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+# Igual para columnas nuevas (solo columnas nullable, sin FK a nivel de BD)
+def ensure_columns():
+    inspector = inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    conn.execute(text(
+                        f"ALTER TABLE {preparer.quote(table.name)} "
+                        f"ADD COLUMN {preparer.quote(column.name)} {column.type.compile(dialect=engine.dialect)}"
+                    ))
+
+ensure_columns()
+ensure_indexes()
+
 # -----------------------------
 # Utilidades y funciones auxiliares
 # -----------------------------
+class TTLCache:
+    """Cache LRU con expiración por entrada, segura entre hilos."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl: float = None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+# Identidad del usuario autenticado (snapshot inmutable, sin sesión de BD)
+class Principal(NamedTuple):
+    id: int
+    username: str
+    disabled: bool
+    role: Optional[str]
+
+# Cache de principals por (username, id del token): evita consultar users/roles en cada request.
+# Es local a cada proceso; el TTL acota el tiempo en que otro worker puede ver datos viejos. Con el
+# id en la clave, un usuario borrado y recreado con el mismo username no hereda el principal viejo.
+principal_cache = TTLCache(
+    maxsize=int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("PRINCIPAL_CACHE_TTL", "60"))
+)
+
+def invalidate_principal(username: str, user_id: int = None):
+    # (username, None) cubre los tokens emitidos antes de incluir "uid"
+    principal_cache.invalidate((username, None))
+    if user_id is not None:
+        principal_cache.invalidate((username, user_id))
+
 def get_db() -> Session:
     db = SessionLocal()
     try:
@@ -243,9 +503,9 @@ def get_db() -> Session:
 def get_user(db: Session, username: str) -> UserDB:
     return db.query(UserDB).filter(UserDB.username == username).first()
 
-def authenticate_user(db: Session, username: str, password: str) -> UserDB:
+async def authenticate_user(db: Session, username: str, password: str) -> UserDB:
     user = get_user(db, username)
-    if not user or not verify_password(password, user.hashed_password):
+    if not user or not await verify_password_async(password, user.hashed_password):
         return None
     return user
 
@@ -263,31 +523,51 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     else:
         expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM, headers={"kid": JWT_ACTIVE_KID})
     return encoded_jwt
 
 # Actualización de get_current_user para usar JWT
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> UserDB:
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> Principal:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Credenciales de autenticación inválidas",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        kid = jwt.get_unverified_header(token).get("kid", JWT_ACTIVE_KID)
+        if kid not in JWT_KEYS:
+            raise credentials_exception
+        payload = jwt.decode(token, JWT_KEYS[kid], algorithms=[ALGORITHM])
         username: str = payload.get("sub")
+        user_id = payload.get("uid")
         if username is None:
             raise credentials_exception
     except jwt.PyJWTError:
         raise credentials_exception
-    user = get_user(db, username)
-    if user is None:
-        raise credentials_exception
-    return user
+    cache_key = (username, user_id)
+    principal = principal_cache.get(cache_key)
+    if principal is None:
+        user = (
+            db.query(UserDB)
+            .options(joinedload(UserDB.role))
+            .filter(UserDB.username == username)
+            .first()
+        )
+        # Un token de un usuario borrado no vale para otro que reutilice su username
+        if user is None or (user_id is not None and user.id != user_id):
+            raise credentials_exception
+        principal = Principal(
+            id=user.id,
+            username=user.username,
+            disabled=user.disabled,
+            role=user.role.name if user.role else None
+        )
+        principal_cache.set(cache_key, principal)
+    return principal
 
 def verify_role(required_roles: List[str]):
-    def role_checker(current_user: UserDB = Depends(get_current_user)) -> UserDB:
-        if current_user.role.name not in required_roles:
+    def role_checker(current_user: Principal = Depends(get_current_user)) -> Principal:
+        if current_user.role not in required_roles:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail=f"Permiso denegado, se requiere uno de los roles {required_roles}"
@@ -312,6 +592,7 @@ class Product(BaseModel):
     stock: int
     price: int
     image_filename: Optional[str] = None
+    image_variants: Optional[dict] = None
     category: Optional[str] = None
 
 class UserCreate(BaseModel):
@@ -326,6 +607,11 @@ class ProductCreate(BaseModel):
     image_filename: Optional[str] = None
     category_id: int
 
+# Imágenes de productos (keys de S3) pedidas en lote
+class ImageBatchRequest(BaseModel):
+    keys: List[constr(min_length=1, max_length=1024)]
+    variant: Optional[str] = None  # "thumb" o "medium"; sin variant, la imagen original
+
 class OrderItemCreate(BaseModel):
     product_id: int
     quantity: int
@@ -334,6 +620,9 @@ class OrderCreateRequest(BaseModel):
     address_id: int
     items: List[OrderItemCreate]
 
+class OrderConfirmBatchRequest(BaseModel):
+    order_ids: List[int]
+
 # Esquemas para movimientos (opcionalmente se pueden crear schemas de respuesta)
 class FinancialMovement(BaseModel):
     id: int
@@ -468,6 +757,10 @@ init_db()
 # -----------------------------
 app = FastAPI()
 
+@app.on_event("shutdown")
+def shutdown_password_executor():
+    password_executor.shutdown(wait=False, cancel_futures=True)
+
 # -----------------------------
 # Cross-Origin Resource Sharing
 # -----------------------------
@@ -484,7 +777,9 @@ app.add_middleware(
 )
 
 #Configuración para acceso a S3
-s3 = boto3.client("s3", region_name="us-east-1")
+# S3_ENDPOINT_URL permite apuntar a un S3 local (moto, MinIO) en desarrollo y pruebas
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+s3 = boto3.client("s3", region_name="us-east-1", endpoint_url=S3_ENDPOINT_URL)
 BUCKET_NAME = os.getenv("BUCKET_NAME", "imagenes-productos-farmacia")
 
 #Remote WebDriver Selenium
@@ -497,8 +792,172 @@ stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 # -----------------------------
 # Configuración Lambda URLs
 # -----------------------------
-LAMBDA_URL_PRODUCTO = "https://fnoo5iqzzf.execute-api.us-east-1.amazonaws.com/prod/validate-product"
-LAMBDA_URL_USERNAME = "https://fnoo5iqzzf.execute-api.us-east-1.amazonaws.com/prod/validate-username"
+LAMBDA_URL_PRODUCTO = os.getenv(
+    "LAMBDA_URL_PRODUCTO",
+    "https://fnoo5iqzzf.execute-api.us-east-1.amazonaws.com/prod/validate-product"
+)
+LAMBDA_URL_USERNAME = os.getenv(
+    "LAMBDA_URL_USERNAME",
+    "https://fnoo5iqzzf.execute-api.us-east-1.amazonaws.com/prod/validate-username"
+)
+LAMBDA_TIMEOUT = float(os.getenv("LAMBDA_TIMEOUT", "5"))
+LAMBDA_MAX_CONCURRENCY = int(os.getenv("LAMBDA_MAX_CONCURRENCY", "20"))
+
+class LambdaUnavailable(Exception):
+    pass
+
+class CircuitBreaker:
+    """Abre el circuito tras `threshold` fallos seguidos y deja pasar un intento tras `cooldown` segundos."""
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "half-open":
+                # Solo un intento de prueba por ventana de cooldown
+                self.opened_at = time.monotonic()
+                return True
+            return state == "closed"
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+class LambdaClient:
+    """
+    Cliente HTTP async compartido (keep-alive) para las Lambdas de validación, con breaker y cache de
+    veredictos. Si la Lambda no responde (o el circuito está abierto) se reutiliza el último veredicto
+    conocido para el mismo payload durante LAMBDA_STALE_TTL; sin veredicto previo, LambdaUnavailable.
+    """
+
+    def __init__(self):
+        self.http: Optional[httpx.AsyncClient] = None
+        self.semaphore = asyncio.Semaphore(LAMBDA_MAX_CONCURRENCY)
+        self.breaker = CircuitBreaker(
+            threshold=int(os.getenv("LAMBDA_BREAKER_THRESHOLD", "5")),
+            cooldown=float(os.getenv("LAMBDA_BREAKER_COOLDOWN", "30"))
+        )
+        self.cache = TTLCache(
+            maxsize=int(os.getenv("LAMBDA_CACHE_SIZE", "1024")),
+            ttl=float(os.getenv("LAMBDA_CACHE_TTL", "300"))
+        )
+        # Últimos veredictos, con un TTL más largo: solo se leen cuando la Lambda falla
+        self.stale = TTLCache(
+            maxsize=int(os.getenv("LAMBDA_CACHE_SIZE", "1024")),
+            ttl=float(os.getenv("LAMBDA_STALE_TTL", "3600"))
+        )
+        self.stale_served = 0
+
+    async def open(self):
+        self.http = httpx.AsyncClient(
+            timeout=LAMBDA_TIMEOUT,
+            limits=httpx.Limits(max_connections=LAMBDA_MAX_CONCURRENCY, max_keepalive_connections=LAMBDA_MAX_CONCURRENCY)
+        )
+
+    async def close(self):
+        if self.http is not None:
+            await self.http.aclose()
+            self.http = None
+
+    async def post(self, url: str, payload: dict):
+        """
+        Devuelve (valido, body). Un 2xx es válido y un 400 es inválido (veredictos de la Lambda);
+        cualquier otro status (401/403/404, 429, 5xx...) cuenta como fallo del servicio.
+        """
+        cache_key = (url, json.dumps(payload, sort_keys=True))
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            return cached
+        try:
+            result = await self._call(url, payload)
+        except LambdaUnavailable:
+            stale = self.stale.get(cache_key)
+            if stale is None:
+                raise
+            self.stale_served += 1
+            return stale
+        self.cache.set(cache_key, result)
+        self.stale.set(cache_key, result)
+        return result
+
+    async def _call(self, url: str, payload: dict):
+        if not self.breaker.allow():
+            raise LambdaUnavailable("circuito abierto tras fallos repetidos")
+        if self.http is None:
+            raise LambdaUnavailable("cliente HTTP no iniciado")
+        async with self.semaphore:
+            try:
+                response = await self.http.post(url, json=payload)
+            except httpx.HTTPError as e:
+                self.breaker.record_failure()
+                raise LambdaUnavailable(str(e) or type(e).__name__)
+        if not response.is_success and response.status_code != 400:
+            self.breaker.record_failure()
+            raise LambdaUnavailable(f"respuesta {response.status_code}")
+        self.breaker.record_success()
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        return (response.is_success, body)
+
+    def stats(self) -> dict:
+        return {**self.cache.stats(), "breaker": self.breaker.state, "stale_served": self.stale_served}
+
+lambda_client = LambdaClient()
+
+@app.on_event("startup")
+async def open_lambda_client():
+    await lambda_client.open()
+
+@app.on_event("shutdown")
+async def close_lambda_client():
+    await lambda_client.close()
+
+async def validate_product_lambda(precio: int, stock: int):
+    """Validación del producto vía Lambda (solo precio y stock)."""
+    try:
+        valid, body = await lambda_client.post(LAMBDA_URL_PRODUCTO, {"precio": precio, "stock": stock})
+    except LambdaUnavailable as e:
+        raise HTTPException(status_code=503, detail=f"Servicio de validación de producto no disponible: {str(e)}")
+    if not valid:
+        try:
+            errores = json.loads(body["body"])["errores"]
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error en validación de producto: {str(e)}")
+        raise HTTPException(status_code=400, detail=errores)
+
+async def validate_username_lambda(username: str) -> str:
+    """Valida el formato del username vía Lambda y devuelve el username validado."""
+    try:
+        valid, body = await lambda_client.post(LAMBDA_URL_USERNAME, {"username": username})
+    except LambdaUnavailable as e:
+        raise HTTPException(status_code=503, detail=f"Servicio de validación de username no disponible: {str(e)}")
+    if not valid:
+        error_msg = body.get("error", "Error desconocido en validación de username")
+        raise HTTPException(status_code=400, detail=error_msg)
+    return body.get("data", {}).get("username", username)
 
 # -----------------------------
 # Endpoints de Autenticación y Usuarios
@@ -516,24 +975,7 @@ async def register(user: UserCreate, db: Session = Depends(get_db)):
     """Registrar un nuevo usuario (solo admin)."""
 
     # 1) Validar formato del username con Lambda
-    try:
-        lambda_response = requests.post(
-            LAMBDA_URL_USERNAME,  # URL para validar el username
-            json={"username": user.username},  # Solo validación del username
-            headers={"Content-Type": "application/json"},
-            timeout=5
-        )
-
-        if lambda_response.status_code != 200:
-            body = lambda_response.json()
-            error_msg = body.get("error", "Error desconocido en validación de username")
-            raise HTTPException(status_code=lambda_response.status_code, detail=error_msg)
-        
-        # Usar username validado o el original si no viene
-        validated_username = lambda_response.json().get("data", {}).get("username", user.username)
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error en validación de username vía Lambda: {str(e)}")
+    validated_username = await validate_username_lambda(user.username)
 
     # 2) Verificar si el username ya existe en la base de datos
     existing_user = db.query(UserDB).filter(UserDB.username == validated_username).first()
@@ -548,11 +990,12 @@ async def register(user: UserCreate, db: Session = Depends(get_db)):
     # 4) Crear el nuevo usuario
     new_user = UserDB(
         username=user.username,
-        hashed_password=get_password_hash(user.password),
+        hashed_password=await get_password_hash_async(user.password),
         role_id=role.id
     )
     db.add(new_user)
     db.commit()
+    invalidate_principal(new_user.username, new_user.id)
 
     return {"message": "Usuario registrado exitosamente"}
 
@@ -560,30 +1003,34 @@ async def register(user: UserCreate, db: Session = Depends(get_db)):
 @app.post("/token", response_model=Token)
 async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
     """Generar token para autenticación."""
-    user = authenticate_user(db, form_data.username, form_data.password)
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Nombre de usuario o contraseña incorrectos"
         )
+    # Re-cifra el hash con la clave primaria si fue creado con una clave rotada
+    if password_needs_rekey(user.hashed_password):
+        user.hashed_password = rekey_password_hash(user.hashed_password)
+        db.commit()
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.username, "role": user.role.name}, expires_delta=access_token_expires
+        data={"sub": user.username, "uid": user.id, "role": user.role.name}, expires_delta=access_token_expires
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.get("/users/me", response_model=User)
-async def get_me(current_user: UserDB = Depends(get_current_user)):
+async def get_me(current_user: Principal = Depends(get_current_user)):
     return {
         "id": current_user.id,
         "username": current_user.username,
         "disabled": current_user.disabled,
-        "role": current_user.role.name,
+        "role": current_user.role,
     }
 
 
 @app.get("/users/", response_model=List[User])
-async def list_users(db: Session = Depends(get_db), current_user: UserDB = Depends(verify_role(["admin"]))):
+async def list_users(db: Session = Depends(get_db), current_user: Principal = Depends(verify_role(["admin"]))):
     """Listar todos los usuarios (solo admin)."""
     users = db.query(UserDB).all()
     result = []
@@ -598,7 +1045,7 @@ async def list_users(db: Session = Depends(get_db), current_user: UserDB = Depen
     return result
 
 @app.get("/users/{id}")
-async def get_user_by_id(id: int, db: Session = Depends(get_db), current_user: UserDB = Depends(verify_role(["admin"]))):
+async def get_user_by_id(id: int, db: Session = Depends(get_db), current_user: Principal = Depends(verify_role(["admin"]))):
     """Obtener detalles de un usuario por ID (solo admin)."""
     user = db.query(UserDB).filter(UserDB.id == id).first()
     if not user:
@@ -607,18 +1054,21 @@ async def get_user_by_id(id: int, db: Session = Depends(get_db), current_user: U
     return data
 
 @app.put("/users/{id}")
-async def update_user(id: int, user_data: UserCreate, db: Session = Depends(get_db), current_user: UserDB = Depends(verify_role(["admin"]))):
+async def update_user(id: int, user_data: UserCreate, db: Session = Depends(get_db), current_user: Principal = Depends(verify_role(["admin"]))):
     """Actualizar datos de un usuario (solo admin)."""
     user = db.query(UserDB).filter(UserDB.id == id).first()
     if not user:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    old_username = user.username
     user.username = user_data.username
-    user.hashed_password = get_password_hash(user_data.password)
+    user.hashed_password = await get_password_hash_async(user_data.password)
     db.commit()
+    invalidate_principal(old_username, user.id)
+    invalidate_principal(user.username, user.id)
     return {"message": "Usuario actualizado exitosamente"}
 
 @app.delete("/users/{id}")
-async def delete_user(id: int, db: Session = Depends(get_db), current_user: UserDB = Depends(verify_role(["admin"]))):
+async def delete_user(id: int, db: Session = Depends(get_db), current_user: Principal = Depends(verify_role(["admin"]))):
     """Eliminar un usuario (solo admin)."""
     user = db.query(UserDB).filter(UserDB.id == id).first()
     if not user:
@@ -627,6 +1077,7 @@ async def delete_user(id: int, db: Session = Depends(get_db), current_user: User
         raise HTTPException(status_code=403, detail="No puedes eliminar el usuario admin principal")
     db.delete(user)
     db.commit()
+    invalidate_principal(user.username, user.id)
     return {"message": "Usuario eliminado exitosamente"}
 
 # -----------------------------
@@ -636,6 +1087,331 @@ async def delete_user(id: int, db: Session = Depends(get_db), current_user: User
 # Configura el logging en el backend
 logging.basicConfig(level=logging.DEBUG)
 
+SIMILARITY_THRESHOLD = 70
+
+class ProductNameIndex:
+    """Índice en memoria de nombres de producto para detectar duplicados con RapidFuzz."""
+
+    def __init__(self, refresh_seconds: float):
+        # Reconstrucción periódica para recoger cambios hechos por otros workers
+        self.refresh_seconds = refresh_seconds
+        self._names = {}    # id -> nombre original
+        self._lowered = {}  # id -> nombre en minúsculas (lo que se compara)
+        self._built_at = None
+        self._lock = threading.Lock()
+
+    def rebuild(self, db: Session):
+        rows = db.query(ProductDB.id, ProductDB.name).order_by(ProductDB.id).all()
+        with self._lock:
+            self._names = {pid: name or "" for pid, name in rows}
+            self._lowered = {pid: name.lower() for pid, name in self._names.items()}
+            self._built_at = time.monotonic()
+
+    def ensure_built(self, db: Session):
+        if self._built_at is None or time.monotonic() - self._built_at > self.refresh_seconds:
+            self.rebuild(db)
+
+    def find_similar(self, db: Session, name: str, exclude_id: int = None) -> Optional[str]:
+        """
+        Nombre del primer producto (por id, como el recorrido original de la tabla) con similitud
+        >= SIMILARITY_THRESHOLD, o None.
+        """
+        self.ensure_built(db)
+        with self._lock:
+            ids = list(self._lowered)
+            scores = process.cdist(
+                [name.lower()],
+                list(self._lowered.values()),
+                scorer=fuzz.ratio,
+                score_cutoff=SIMILARITY_THRESHOLD,
+                dtype=np.float32
+            )[0]
+            for i in np.flatnonzero(scores >= SIMILARITY_THRESHOLD):
+                if ids[i] != exclude_id:
+                    return self._names[ids[i]]
+        return None
+
+    def find_similar_batch(self, names: List[str], chunk_size: int = 20000) -> List[Optional[str]]:
+        """find_similar para muchos nombres en una pasada vectorizada (cdist) contra todo el catálogo."""
+        with self._lock:
+            catalog_names = list(self._names.values())
+            choices = list(self._lowered.values())
+        queries = [n.lower() for n in names]
+        first_index = np.full(len(queries), -1)
+        # Por bloques de columnas (en orden de id) para acotar la matriz de scores
+        for start in range(0, len(choices), chunk_size):
+            pending = first_index < 0
+            if not pending.any():
+                break
+            scores = process.cdist(
+                queries,
+                choices[start:start + chunk_size],
+                scorer=fuzz.ratio,
+                score_cutoff=SIMILARITY_THRESHOLD,
+                dtype=np.float32,
+                workers=-1
+            )
+            hits = scores >= SIMILARITY_THRESHOLD
+            found = pending & hits.any(axis=1)
+            first_index[found] = hits[found].argmax(axis=1) + start
+        return [catalog_names[i] if i >= 0 else None for i in first_index]
+
+    def upsert(self, product_id: int, name: str):
+        with self._lock:
+            self._names[product_id] = name or ""
+            self._lowered[product_id] = self._names[product_id].lower()
+
+    def remove(self, product_id: int):
+        with self._lock:
+            self._names.pop(product_id, None)
+            self._lowered.pop(product_id, None)
+
+    def invalidate(self):
+        with self._lock:
+            self._built_at = None
+
+product_name_index = ProductNameIndex(refresh_seconds=float(os.getenv("NAME_INDEX_REFRESH_SECONDS", "300")))
+
+class CatalogSnapshot:
+    """Catálogo de productos pre-serializado (bytes JSON + ETag), reconstruido solo cuando cambia."""
+
+    def __init__(self, ttl: float):
+        # El TTL acota cuánto tarda en verse un cambio hecho por otro worker
+        self.ttl = ttl
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.body = None
+        self.etag = None
+        self._built_at = 0.0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self.body = None
+
+    def get(self, db: Session):
+        with self._lock:
+            if self.body is not None and time.monotonic() - self._built_at < self.ttl:
+                self.hits += 1
+                return self.body, self.etag
+            self.misses += 1
+            version = self.version
+        rows = (
+            db.query(ProductDB.id, ProductDB.name, ProductDB.stock, ProductDB.price,
+                     ProductDB.image_filename, CategoryDB.name)
+            .outerjoin(CategoryDB, ProductDB.category_id == CategoryDB.id)
+            .order_by(ProductDB.id)
+            .all()
+        )
+        body = json.dumps(
+            [
+                {"id": pid, "name": name, "stock": stock, "price": price,
+                 "image_filename": image_filename, "image_variants": image_variants(image_filename),
+                 "category": category}
+                for pid, name, stock, price, image_filename, category in rows
+            ],
+            ensure_ascii=False,
+            separators=(",", ":")
+        ).encode("utf-8")
+        # ETag por contenido: igual en todos los workers si el catálogo es el mismo
+        etag = '"' + hashlib.sha1(body, usedforsecurity=False).hexdigest() + '"'
+        with self._lock:
+            if self.version == version:
+                self.body, self.etag, self._built_at = body, etag, time.monotonic()
+        return body, etag
+
+    def stats(self) -> dict:
+        return {"version": self.version, "hits": self.hits, "misses": self.misses}
+
+catalog_snapshot = CatalogSnapshot(ttl=float(os.getenv("CATALOG_SNAPSHOT_TTL", "30")))
+
+def fold_text(text: str) -> str:
+    """Minúsculas y sin tildes: "Analgésicos" -> "analgesicos"."""
+    normalized = unicodedata.normalize("NFKD", (text or "").lower())
+    return "".join(c for c in normalized if not unicodedata.combining(c))
+
+def tokenize(text: str) -> List[str]:
+    return re.findall(r"[a-z0-9]+", fold_text(text))
+
+class ProductSearchIndex:
+    """Índice invertido en memoria sobre nombre y categoría de los productos."""
+
+    NAME_WEIGHT = 1.0
+    CATEGORY_WEIGHT = 0.4
+    PREFIX_FACTOR = 0.8
+    TYPO_FACTOR = 0.6
+    MAX_PREFIX_TERMS = 50
+
+    def __init__(self, refresh_seconds: float):
+        self.refresh_seconds = refresh_seconds
+        self._postings = {}  # token -> {product_id: peso}
+        self._vocab = []     # tokens ordenados, para búsqueda por prefijo
+        self._shapes = {}    # (primera letra, largo) -> tokens: candidatos acotados para typos
+        self._docs = {}      # product_id -> tokens indexados
+        self._built_at = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _shape(token: str) -> tuple:
+        return token[0], len(token)
+
+    def _doc_weights(self, name: str, category: Optional[str]) -> dict:
+        weights = {t: self.CATEGORY_WEIGHT for t in tokenize(category)}
+        weights.update({t: self.NAME_WEIGHT for t in tokenize(name)})
+        return weights
+
+    def rebuild(self, db: Session):
+        rows = (
+            db.query(ProductDB.id, ProductDB.name, CategoryDB.name)
+            .outerjoin(CategoryDB, ProductDB.category_id == CategoryDB.id)
+            .all()
+        )
+        postings, docs = {}, {}
+        for pid, name, category in rows:
+            weights = self._doc_weights(name, category)
+            for token, weight in weights.items():
+                postings.setdefault(token, {})[pid] = weight
+            docs[pid] = list(weights)
+        shapes = {}
+        for token in postings:
+            shapes.setdefault(self._shape(token), set()).add(token)
+        with self._lock:
+            self._postings, self._docs, self._shapes = postings, docs, shapes
+            self._vocab = sorted(postings)
+            self._built_at = time.monotonic()
+
+    def ensure_built(self, db: Session):
+        if self._built_at is None or time.monotonic() - self._built_at > self.refresh_seconds:
+            self.rebuild(db)
+
+    def invalidate(self):
+        with self._lock:
+            self._built_at = None
+
+    def _remove_locked(self, product_id: int):
+        for token in self._docs.pop(product_id, ()):
+            posting = self._postings.get(token)
+            if posting is None:
+                continue
+            posting.pop(product_id, None)
+            if not posting:
+                del self._postings[token]
+                self._shapes.get(self._shape(token), set()).discard(token)
+                i = bisect.bisect_left(self._vocab, token)
+                if i < len(self._vocab) and self._vocab[i] == token:
+                    del self._vocab[i]
+
+    def upsert(self, product_id: int, name: str, category: Optional[str]):
+        weights = self._doc_weights(name, category)
+        with self._lock:
+            self._remove_locked(product_id)
+            for token, weight in weights.items():
+                posting = self._postings.get(token)
+                if posting is None:
+                    posting = self._postings[token] = {}
+                    bisect.insort(self._vocab, token)
+                    self._shapes.setdefault(self._shape(token), set()).add(token)
+                posting[product_id] = weight
+            self._docs[product_id] = list(weights)
+
+    def remove(self, product_id: int):
+        with self._lock:
+            self._remove_locked(product_id)
+
+    def _expand(self, token: str) -> List[tuple]:
+        """Términos del vocabulario que casan con el token: exacto, prefijo o (si nada) con typo."""
+        terms = [(token, 1.0)] if token in self._postings else []
+        if len(token) >= 2:
+            i = bisect.bisect_left(self._vocab, token)
+            end = min(len(self._vocab), i + self.MAX_PREFIX_TERMS)
+            while i < end and self._vocab[i].startswith(token):
+                if self._vocab[i] != token:
+                    terms.append((self._vocab[i], self.PREFIX_FACTOR))
+                i += 1
+        if not terms and len(token) >= 4:
+            # Solo términos con la misma inicial y largo ±2 (lo habitual en un typo); evita comparar
+            # contra todo el vocabulario, que con marcas y códigos crece con el catálogo
+            candidates = [
+                term
+                for length in range(len(token) - 2, len(token) + 3)
+                for term in self._shapes.get((token[0], length), ())
+            ]
+            for term, score, _ in process.extract(
+                token, candidates, scorer=fuzz.ratio, processor=None, score_cutoff=75, limit=5
+            ):
+                terms.append((term, self.TYPO_FACTOR * score / 100))
+        return terms
+
+    def search(self, db: Session, query: str, limit: int) -> List[tuple]:
+        """Lista de (product_id, score), priorizando productos que casan con más tokens de la consulta."""
+        self.ensure_built(db)
+        tokens = tokenize(query)
+        scores, matched = {}, {}
+        with self._lock:
+            expansions = [self._expand(token) for token in tokens]
+            if len(expansions) == 1 and len(expansions[0]) == 1:
+                # Caso más común (una palabra exacta): se rankea directo sobre la posting, sin acumular
+                term, factor = expansions[0][0]
+                posting = self._postings[term]
+                ranked = heapq.nlargest(limit, posting, key=lambda pid: (posting[pid], -pid))
+                return [(pid, round(factor * posting[pid], 3)) for pid in ranked]
+            for expanded in expansions:
+                best = {}
+                for term, factor in expanded:
+                    for pid, weight in self._postings[term].items():
+                        score = factor * weight
+                        if score > best.get(pid, 0):
+                            best[pid] = score
+                for pid, score in best.items():
+                    scores[pid] = scores.get(pid, 0) + score
+                    matched[pid] = matched.get(pid, 0) + 1
+        ranked = heapq.nlargest(limit, scores, key=lambda pid: (matched[pid], scores[pid], -pid))
+        return [(pid, round(scores[pid], 3)) for pid in ranked]
+
+product_search_index = ProductSearchIndex(refresh_seconds=float(os.getenv("NAME_INDEX_REFRESH_SECONDS", "300")))
+
+def product_written(product_id: int, name: str, category: Optional[str]):
+    """Propaga a los índices y caches en memoria un producto creado o actualizado."""
+    product_name_index.upsert(product_id, name)
+    product_search_index.upsert(product_id, name, category)
+    catalog_snapshot.invalidate()
+
+def product_removed(product_id: int):
+    product_name_index.remove(product_id)
+    product_search_index.remove(product_id)
+    catalog_snapshot.invalidate()
+
+def products_bulk_changed():
+    """Para escrituras masivas: se reconstruye todo en el siguiente uso."""
+    product_name_index.invalidate()
+    product_search_index.invalidate()
+    catalog_snapshot.invalidate()
+
+@app.on_event("startup")
+def build_product_indexes():
+    db = SessionLocal()
+    try:
+        product_name_index.rebuild(db)
+        product_search_index.rebuild(db)
+    finally:
+        db.close()
+
+# Todo cambio de products.stock queda en el libro (la conciliación lo compara contra la suma de movimientos)
+STOCK_OPENING_DESCRIPTION = "Stock inicial del producto"
+STOCK_EDIT_DESCRIPTION = "Ajuste de stock al editar el producto"
+
+def record_stock_movements(db: Session, changes: List[tuple], description: str, keep_zero: bool = False):
+    """Inserta (product_id, cambio) en stock_movements dentro de la transacción del llamador."""
+    now = datetime.utcnow()
+    rows = [
+        {"product_id": product_id, "timestamp": now, "change": change, "description": description}
+        for product_id, change in changes if change or keep_zero
+    ]
+    if rows:
+        db.execute(insert(StockMovementDB), rows)
+
 @app.post("/products/", dependencies=[Depends(verify_role(["admin", "almacenista"]))])
 async def create_product(
     product: ProductCreate,
@@ -654,35 +1430,21 @@ async def create_product(
         raise HTTPException(status_code=413, detail="Payload demasiado grande (máx. 1 MB)")
 
     # 2) Validación del producto vía Lambda (solo precio y stock)
-    try:
-        lambda_response = requests.post(
-            LAMBDA_URL_PRODUCTO,
-            json={"precio": product.price, "stock": product.stock},
-            timeout=5
-        )
-        if lambda_response.status_code == 400:
-            errores = json.loads(lambda_response.json()["body"])["errores"]
-            raise HTTPException(status_code=400, detail=errores)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error en validación de producto: {str(e)}")
+    await validate_product_lambda(product.price, product.stock)
 
     # 3) Verificar similitudes con productos existentes usando RapidFuzz
-    productos = db.query(ProductDB).all()
-    for existente in productos:
-        similitud = fuzz.ratio(product.name.lower(), existente.name.lower())
-        logging.debug(f"Similitud con el producto '{existente.name}': {similitud}")
-        if similitud >= 70:
-            if not confirmado:
-                logging.debug(f"Similitud alta detectada: {existente.name}, se necesita confirmación.")
-                return JSONResponse(
-                    status_code=409,
-                    content={
-                        "mensaje": "Este producto es similar a uno ya existente.",
-                        "producto_similar": existente.name,
-                        "confirmacion_requerida": True
-                    }
-                )
-            break
+    if not confirmado:
+        similar = product_name_index.find_similar(db, product.name)
+        if similar is not None:
+            logging.debug("Similitud alta detectada: %s, se necesita confirmación.", similar)
+            return JSONResponse(
+                status_code=409,
+                content={
+                    "mensaje": "Este producto es similar a uno ya existente.",
+                    "producto_similar": similar,
+                    "confirmacion_requerida": True
+                }
+            )
 
     # 4) Busca la categoría
     category = db.query(CategoryDB).filter(CategoryDB.id == product.category_id).first()
@@ -704,25 +1466,428 @@ async def create_product(
         category_id=sanitized["category_id"]
     )
     db.add(new_product)
+    db.flush()
+    # La apertura se registra aunque sea 0: marca el producto como ya asentado para el backfill
+    record_stock_movements(db, [(new_product.id, new_product.stock)], STOCK_OPENING_DESCRIPTION, keep_zero=True)
     db.commit()
+    product_written(new_product.id, new_product.name, category.name)
+    image_uploaded(new_product.image_filename)
 
     logging.debug("Producto guardado exitosamente.")
     return {"message": "Producto agregado exitosamente"}
 
-@app.get("/products/", response_model=List[Product])
-async def list_products(db: Session = Depends(get_db)):
-    products = db.query(ProductDB).all()
-    result = []
-    for p in products:
-        result.append({
-            "id": p.id,
-            "name": p.name,
-            "stock": p.stock,
-            "price": p.price,
-            "image_filename": p.image_filename,
-            "category": p.category.name if p.category else None
-        })
-    return result
+PRODUCT_FIELDS = {
+    "id": ProductDB.id,
+    "name": ProductDB.name,
+    "stock": ProductDB.stock,
+    "price": ProductDB.price,
+    "image_filename": ProductDB.image_filename,
+    "category": CategoryDB.name,
+}
+
+BULK_IMPORT_BATCH_SIZE = int(os.getenv("BULK_IMPORT_BATCH_SIZE", "500"))
+BULK_IMPORT_MAX_BYTES = int(os.getenv("BULK_IMPORT_MAX_BYTES", str(200 * 1024 * 1024)))
+
+def iter_import_rows(text, fmt: str):
+    """Filas del archivo como dict (o la excepción de parseo si la fila está mal formada)."""
+    if fmt == "csv":
+        for row in csv.DictReader(text):
+            yield {k.strip(): (v.strip() if isinstance(v, str) else v) for k, v in row.items() if k}
+    else:
+        for line in text:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                yield e
+
+def insert_products_chunk(db: Session, rows: List[dict]) -> List[Optional[int]]:
+    """
+    INSERT masivo en una transacción, con el movimiento de stock inicial de cada producto; si choca
+    con el UNIQUE de name, reintenta fila a fila. Devuelve el id asignado a cada fila, o None si no se insertó.
+    """
+    ids = {}
+
+    def insert_rows(chunk: List[dict]):
+        db.execute(insert(ProductDB), chunk)
+        inserted = dict(
+            db.query(ProductDB.name, ProductDB.id).filter(ProductDB.name.in_([r["name"] for r in chunk])).all()
+        )
+        record_stock_movements(db, [(inserted[r["name"]], r["stock"]) for r in chunk],
+                               STOCK_OPENING_DESCRIPTION, keep_zero=True)
+        db.commit()
+        ids.update(inserted)
+
+    try:
+        insert_rows(rows)
+    except IntegrityError:
+        db.rollback()
+        for row in rows:
+            try:
+                insert_rows([row])
+            except IntegrityError:
+                db.rollback()
+    return [ids.get(row["name"]) for row in rows]
+
+def read_import_batch(rows) -> List[tuple]:
+    """Siguiente lote de (nro de fila, fila); un archivo con encoding o CSV inválido es un 400."""
+    try:
+        return list(itertools.islice(rows, BULK_IMPORT_BATCH_SIZE))
+    except UnicodeDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"El archivo no es UTF-8 válido: {str(e)}")
+    except csv.Error as e:
+        raise HTTPException(status_code=400, detail=f"CSV mal formado: {str(e)}")
+
+def parse_import_batch(batch: List[tuple], categories: dict, results: dict) -> List[tuple]:
+    """Valida las filas del lote; deja las inválidas en results y devuelve [(nro de fila, ProductCreate)]."""
+    valid = []
+    for row_number, raw in batch:
+        if not isinstance(raw, dict):
+            results[row_number] = {"status": "invalid", "errores": [f"Fila mal formada: {raw}"]}
+            continue
+        if raw.get("image_filename") == "":
+            raw["image_filename"] = None
+        try:
+            product = ProductCreate(**raw)
+        except ValidationError as e:
+            results[row_number] = {
+                "status": "invalid",
+                "errores": [f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()]
+            }
+            continue
+        if product.category_id not in categories:
+            results[row_number] = {"status": "invalid", "errores": ["Categoría no encontrada"]}
+            continue
+        product.name = re.sub(r"[<>\"']", "", product.name)
+        if product.image_filename:
+            product.image_filename = re.sub(r"[<>\"']", "", product.image_filename)
+        valid.append((row_number, product))
+    return valid
+
+async def lambda_check_import_batch(valid: List[tuple], results: dict) -> List[tuple]:
+    """
+    Validación vía Lambda: una llamada por par (precio, stock) distinto.
+    Solo un 400 marca filas como inválidas; cualquier otro error (503 con el circuito abierto o la
+    Lambda caída) corta la importación en vez de rechazar filas que pueden ser válidas.
+    """
+    pairs = list({(p.price, p.stock) for _, p in valid})
+    outcomes = await asyncio.gather(
+        *[validate_product_lambda(price, stock) for price, stock in pairs],
+        return_exceptions=True
+    )
+    for outcome in outcomes:
+        if isinstance(outcome, Exception) and not (isinstance(outcome, HTTPException) and outcome.status_code == 400):
+            raise outcome
+    rejected = {pair: out.detail for pair, out in zip(pairs, outcomes) if isinstance(out, HTTPException)}
+    checked = []
+    for row_number, product in valid:
+        detail = rejected.get((product.price, product.stock))
+        if detail is not None:
+            results[row_number] = {"status": "invalid", "errores": detail if isinstance(detail, list) else [detail]}
+        else:
+            checked.append((row_number, product))
+    return checked
+
+def store_import_batch(db: Session, batch: List[tuple], checked: List[tuple], categories: dict,
+                       confirmado: bool, results: dict, report) -> dict:
+    """Descarta duplicados, inserta lo aceptado y escribe el reporte del lote (CPU + DB: va al threadpool)."""
+    counts = {"accepted": 0, "duplicate": 0, "invalid": 0}
+
+    # Duplicados contra el catálogo y dentro del mismo lote, en una sola pasada vectorizada
+    accepted = []
+    if checked and not confirmado:
+        names = [p.name for _, p in checked]
+        similar_in_catalog = product_name_index.find_similar_batch(names)
+        lowered = [n.lower() for n in names]
+        in_batch = process.cdist(lowered, lowered, scorer=fuzz.ratio,
+                                 score_cutoff=SIMILARITY_THRESHOLD, dtype=np.float32)
+        accepted_idx = []
+        for i, (row_number, product) in enumerate(checked):
+            similar = similar_in_catalog[i]
+            if similar is None:
+                earlier = [j for j in accepted_idx if in_batch[i, j] > 0]
+                if earlier:
+                    similar = checked[earlier[0]][1].name
+            if similar is not None:
+                results[row_number] = {"status": "duplicate", "producto_similar": similar}
+            else:
+                accepted_idx.append(i)
+                accepted.append((row_number, product))
+    else:
+        accepted = checked
+
+    if accepted:
+        ids = insert_products_chunk(db, [
+            {"name": p.name, "price": p.price, "stock": p.stock,
+             "image_filename": p.image_filename, "category_id": p.category_id}
+            for _, p in accepted
+        ])
+        for (row_number, product), product_id in zip(accepted, ids):
+            if product_id is None:
+                results[row_number] = {"status": "duplicate", "producto_similar": product.name}
+                continue
+            product_written(product_id, product.name, categories[product.category_id])
+            image_uploaded(product.image_filename)
+            results[row_number] = {"status": "accepted", "id": product_id}
+
+    for row_number, _ in batch:
+        entry = {"row": row_number, **results[row_number]}
+        counts[entry["status"]] += 1
+        report.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    return counts
+
+async def import_products_batch(db: Session, batch: List[tuple], categories: dict,
+                                confirmado: bool, report) -> dict:
+    results = {}   # nro de fila -> entrada del reporte
+    valid = await run_in_threadpool(parse_import_batch, batch, categories, results)
+    checked = await lambda_check_import_batch(valid, results)
+    return await run_in_threadpool(store_import_batch, db, batch, checked, categories, confirmado, results, report)
+
+@app.post("/products/bulk", dependencies=[Depends(verify_role(["admin", "almacenista"]))])
+async def bulk_import_products(
+    request: Request,
+    format: Optional[str] = Query(None, pattern="^(csv|jsonl)$"),
+    confirmado: Optional[bool] = Query(False),
+    db: Session = Depends(get_db)
+):
+    """
+    Importación masiva de productos desde CSV (name,stock,price,category_id[,image_filename]) o JSONL.
+    - El cuerpo se recibe en streaming a un archivo temporal y se procesa por lotes.
+    - Devuelve un reporte NDJSON por fila (accepted / duplicate / invalid) y una línea final de resumen.
+    - Con confirmado=true se aceptan nombres similares (no idénticos) a los existentes.
+    """
+    if format is None:
+        content_type = request.headers.get("content-type", "")
+        if "csv" in content_type:
+            format = "csv"
+        elif "ndjson" in content_type or "jsonl" in content_type:
+            format = "jsonl"
+        else:
+            raise HTTPException(status_code=415, detail="Formato no soportado: usa text/csv o application/x-ndjson")
+
+    upload = tempfile.TemporaryFile()
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > BULK_IMPORT_MAX_BYTES:
+            upload.close()
+            raise HTTPException(status_code=413, detail="Archivo demasiado grande")
+        upload.write(chunk)
+    upload.seek(0)
+
+    def load_import_context():
+        product_name_index.ensure_built(db)
+        return dict(db.query(CategoryDB.id, CategoryDB.name).all())
+
+    categories = await run_in_threadpool(load_import_context)
+    report = tempfile.TemporaryFile(mode="w+", encoding="utf-8")
+    totals = {"accepted": 0, "duplicate": 0, "invalid": 0}
+    try:
+        rows = enumerate(iter_import_rows(io.TextIOWrapper(upload, encoding="utf-8-sig", newline=""), format), start=1)
+        while True:
+            batch = await run_in_threadpool(read_import_batch, rows)
+            if not batch:
+                break
+            try:
+                counts = await import_products_batch(db, batch, categories, confirmado, report)
+            except HTTPException as e:
+                if e.status_code != 503:
+                    raise
+                raise HTTPException(
+                    status_code=503,
+                    detail=f"{e.detail}. Importación detenida en la fila {batch[0][0]}; "
+                           f"filas anteriores ya importadas: {totals['accepted']}",
+                    headers={"Retry-After": "30"}
+                )
+            for key, value in counts.items():
+                totals[key] += value
+    except Exception:
+        report.close()
+        raise
+    finally:
+        upload.close()
+    report.write(json.dumps({"summary": totals}) + "\n")
+    report.seek(0)
+
+    def stream_report():
+        try:
+            yield from report
+        finally:
+            report.close()
+
+    return StreamingResponse(stream_report(), media_type="application/x-ndjson")
+
+@app.get("/products/")
+async def list_products(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    cursor: Optional[int] = Query(None, description="ID del último producto de la página anterior"),
+    category_id: Optional[int] = Query(None),
+    min_price: Optional[int] = Query(None),
+    max_price: Optional[int] = Query(None),
+    in_stock: Optional[bool] = Query(None),
+    name_prefix: Optional[str] = Query(None, max_length=100),
+    fields: Optional[str] = Query(None, description="Campos separados por comas, ej: id,name,price"),
+    db: Session = Depends(get_db)
+):
+    """
+    Listar productos.
+    - Sin parámetros devuelve el catálogo completo (lista) desde el snapshot en cache.
+    - Con paginación/filtros/fields devuelve {"items": [...], "next_cursor": id | null},
+      paginando por id (keyset) y consultando solo las columnas pedidas.
+    """
+    paginated = any(v is not None for v in (
+        limit, cursor, category_id, min_price, max_price, in_stock, name_prefix, fields
+    ))
+    if paginated:
+        return list_products_page(
+            db, limit or 50, cursor, category_id, min_price, max_price, in_stock, name_prefix, fields
+        )
+
+    body, etag = catalog_snapshot.get(db)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match == "*" or etag in [t.strip() for t in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def list_products_page(db: Session, limit: int, cursor: Optional[int], category_id: Optional[int],
+                       min_price: Optional[int], max_price: Optional[int], in_stock: Optional[bool],
+                       name_prefix: Optional[str], fields: Optional[str]) -> dict:
+    if fields:
+        selected = [f.strip() for f in fields.split(",") if f.strip()]
+        invalid = [f for f in selected if f not in PRODUCT_FIELDS]
+        if invalid:
+            raise HTTPException(status_code=400, detail=f"Campos inválidos: {invalid}")
+    else:
+        selected = list(PRODUCT_FIELDS)
+    # El id siempre se consulta: es la llave del cursor
+    columns = ["id"] + [f for f in selected if f != "id"]
+
+    query = db.query(*[PRODUCT_FIELDS[f] for f in columns])
+    if "category" in columns:
+        query = query.outerjoin(CategoryDB, ProductDB.category_id == CategoryDB.id)
+    if cursor is not None:
+        query = query.filter(ProductDB.id > cursor)
+    if category_id is not None:
+        query = query.filter(ProductDB.category_id == category_id)
+    if min_price is not None:
+        query = query.filter(ProductDB.price >= min_price)
+    if max_price is not None:
+        query = query.filter(ProductDB.price <= max_price)
+    if in_stock is not None:
+        query = query.filter(ProductDB.stock > 0 if in_stock else ProductDB.stock <= 0)
+    if name_prefix:
+        escaped = name_prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        query = query.filter(ProductDB.name.like(escaped + "%", escape="\\"))
+
+    rows = query.order_by(ProductDB.id).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    positions = [(f, columns.index(f)) for f in selected]
+    items = [{f: row[i] for f, i in positions} for row in rows]
+    if "image_filename" in selected:
+        for item in items:
+            item["image_variants"] = image_variants(item["image_filename"])
+    return {"items": items, "next_cursor": rows[-1][0] if has_more else None}
+
+@app.get("/products/search")
+async def search_products(
+    q: str = Query(..., min_length=1, max_length=100),
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_db)
+):
+    """Búsqueda de productos por nombre y categoría, tolerante a tildes, prefijos y errores de tipeo."""
+    ranked = product_search_index.search(db, q, limit)
+    if not ranked:
+        return []
+    rows = (
+        db.query(ProductDB.id, ProductDB.name, ProductDB.stock, ProductDB.price,
+                 ProductDB.image_filename, CategoryDB.name)
+        .outerjoin(CategoryDB, ProductDB.category_id == CategoryDB.id)
+        .filter(ProductDB.id.in_([pid for pid, _ in ranked]))
+        .all()
+    )
+    by_id = {
+        pid: {"id": pid, "name": name, "stock": stock, "price": price,
+              "image_filename": image_filename, "image_variants": image_variants(image_filename),
+              "category": category}
+        for pid, name, stock, price, image_filename, category in rows
+    }
+    return [{**by_id[pid], "score": score} for pid, score in ranked if pid in by_id]
+
+EXPORT_BATCH_SIZE = 1000
+
+def stream_query_rows(stmt, batch_size: int = EXPORT_BATCH_SIZE):
+    """Lotes de filas leídos con cursor del lado del servidor; abre su propia sesión para vivir durante el streaming."""
+    db = SessionLocal()
+    try:
+        result = db.execute(stmt.execution_options(yield_per=batch_size))
+        for partition in result.partitions():
+            yield partition
+    finally:
+        db.close()
+
+def json_default(value):
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+def encode_rows(batches, fmt: str, columns: List[str]):
+    """Serializa lotes de filas como NDJSON o CSV (con encabezado)."""
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for rows in batches:
+            writer.writerows(rows)
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue().encode("utf-8")
+    else:
+        for rows in batches:
+            yield "".join(
+                json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=json_default) + "\n" for row in rows
+            ).encode("utf-8")
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)  # formato gzip
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def export_response(chunks, fmt: str, filename: str, compress: bool) -> StreamingResponse:
+    media_type = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    filename = f"{filename}.{fmt}"
+    if compress:
+        chunks = gzip_chunks(chunks)
+        media_type = "application/gzip"
+        filename += ".gz"
+    return StreamingResponse(
+        chunks,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@app.get("/products/export", dependencies=[Depends(verify_role(["admin", "almacenista"]))])
+def export_products(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    compress: bool = Query(False, alias="gzip")
+):
+    """Exporta catálogo y lista de precios en streaming (memoria constante sin importar el tamaño)."""
+    columns = ["id", "name", "stock", "price", "category", "image_filename"]
+    stmt = (
+        select(ProductDB.id, ProductDB.name, ProductDB.stock, ProductDB.price,
+               CategoryDB.name, ProductDB.image_filename)
+        .outerjoin(CategoryDB, ProductDB.category_id == CategoryDB.id)
+        .order_by(ProductDB.id)
+    )
+    chunks = encode_rows(stream_query_rows(stmt), format, columns)
+    return export_response(chunks, format, "catalogo", compress)
 
 @app.get("/products/{id}", response_model=Product)
 async def get_product(id: int, db: Session = Depends(get_db)):
@@ -735,6 +1900,7 @@ async def get_product(id: int, db: Session = Depends(get_db)):
         "stock": product.stock,
         "price": product.price,
         "image_filename": product.image_filename,
+        "image_variants": image_variants(product.image_filename),
         "category": product.category.name if product.category else None
     }
 
@@ -762,35 +1928,21 @@ async def update_product(
         raise HTTPException(status_code=413, detail="Payload demasiado grande (máx. 1 MB)")
 
     # 3) Validación del producto vía Lambda (solo precio y stock)
-    try:
-        lambda_response = requests.post(
-            LAMBDA_URL_PRODUCTO,
-            json={"precio": product.price, "stock": product.stock},
-            timeout=5
-        )
-        if lambda_response.status_code == 400:
-            errores = json.loads(lambda_response.json()["body"])["errores"]
-            raise HTTPException(status_code=400, detail=errores)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error en validación de producto: {str(e)}")
+    await validate_product_lambda(product.price, product.stock)
 
     # 4) Verificar similitudes con productos ya existentes usando RapidFuzz (ignora el mismo producto)
-    productos = db.query(ProductDB).filter(ProductDB.id != product_id).all()
-    for existente in productos:
-        similitud = fuzz.ratio(product.name.lower(), existente.name.lower())
-        logging.debug(f"Similitud con el producto '{existente.name}': {similitud}")
-        if similitud >= 70:
-            if not confirmado:
-                logging.debug(f"Similitud alta detectada: {existente.name}, se necesita confirmación.")
-                return JSONResponse(
-                    status_code=409,
-                    content={
-                        "mensaje": "Este producto es similar a uno ya existente.",
-                        "producto_similar": existente.name,
-                        "confirmacion_requerida": True
-                    }
-                )
-            break
+    if not confirmado:
+        similar = product_name_index.find_similar(db, product.name, exclude_id=product_id)
+        if similar is not None:
+            logging.debug("Similitud alta detectada: %s, se necesita confirmación.", similar)
+            return JSONResponse(
+                status_code=409,
+                content={
+                    "mensaje": "Este producto es similar a uno ya existente.",
+                    "producto_similar": similar,
+                    "confirmacion_requerida": True
+                }
+            )
 
     # 5) Busca la categoría
     category = db.query(CategoryDB).filter(CategoryDB.id == product.category_id).first()
@@ -803,7 +1955,10 @@ async def update_product(
 
     sanitized = {k: sanitize(v) for k, v in product.dict().items()}
 
-    # 7) Actualizar los campos
+    # 7) Actualizar los campos; el stock se relee bloqueado para asentar la diferencia exacta en el libro
+    db.refresh(existing_product, with_for_update=True)
+    record_stock_movements(db, [(existing_product.id, sanitized["stock"] - (existing_product.stock or 0))],
+                           STOCK_EDIT_DESCRIPTION)
     existing_product.name = sanitized["name"]
     existing_product.price = sanitized["price"]
     existing_product.stock = sanitized["stock"]
@@ -814,6 +1969,8 @@ async def update_product(
         existing_product.image_filename = sanitized["image_filename"]
 
     db.commit()
+    product_written(existing_product.id, existing_product.name, category.name)
+    image_uploaded(sanitized.get("image_filename"))
 
     logging.debug("Producto actualizado exitosamente.")
     return {"message": "Producto actualizado exitosamente"}
@@ -826,6 +1983,7 @@ async def delete_product(id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Producto no encontrado")
     db.delete(product)
     db.commit()
+    product_removed(id)
     return {"message": "Producto eliminado exitosamente"}
 
 @app.delete("/products/out-of-stock", dependencies=[Depends(verify_role(["admin", "almacenista"]))])
@@ -833,6 +1991,7 @@ async def delete_out_of_stock_products(db: Session = Depends(get_db)):
     """Eliminar productos sin stock."""
     db.query(ProductDB).filter(ProductDB.stock == 0).delete()
     db.commit()
+    products_bulk_changed()
     return {"message": "Productos sin stock eliminados exitosamente"}
 
 @app.get("/categories/")
@@ -840,200 +1999,579 @@ async def list_categories(db: Session = Depends(get_db)):
     return db.query(CategoryDB).all()
 
 # -----------------------------
-# Endpoints de Órdenes
+# Motor de promociones
 # -----------------------------
-def get_order(db: Session, order_id: int) -> OrderDB:
-    return (
-        db.query(OrderDB)
-        .options(joinedload(OrderDB.items).joinedload(OrderItemDB.product))
-        .filter(OrderDB.id == order_id)
-        .first()
-    )
+class PromotionRule(NamedTuple):
+    id: int
+    type: str
+    title: str
+    description: Optional[str]
+    discount_percent: Optional[float]
+    fixed_discount: Optional[float]
+    offer_quantity: Optional[int]
+    offer_pay: Optional[int]
+    product_id: Optional[int]
+    category_id: Optional[int]
+    active: bool
+    start_date: datetime
+    end_date: datetime
 
-@app.post("/orders/")
-async def create_order(order: OrderCreateRequest, db: Session = Depends(get_db), 
-                       current_user: UserDB = Depends(verify_role(["cliente", "admin"]))):
-    if not order.items:
-        raise HTTPException(status_code=400, detail="La orden debe contener al menos un producto")
-    
-    address = db.query(AddressDB).filter(AddressDB.id == order.address_id, AddressDB.user_id == current_user.id).first()
-    if not address:
-        raise HTTPException(400, "Dirección de envío inválida")
+def promotion_info(promo) -> Optional[dict]:
+    if promo is None:
+        return None
+    return {
+        "id": promo.id,
+        "type": promo.type,
+        "title": promo.title,
+        "description": promo.description,
+        "discount_percent": promo.discount_percent,
+        "fixed_discount": promo.fixed_discount,
+        "offer_quantity": promo.offer_quantity,
+        "offer_pay": promo.offer_pay,
+    }
 
-    new_order = OrderDB(client_id=current_user.id, address_id=order.address_id, total=0,
-                        delivery_status="pendiente")
-    db.add(new_order)
-    db.commit()
+def price_line(unit_price, quantity: int, promo) -> dict:
+    """Precio de una línea con la promoción aplicada ("promocion": % y/o fijo por unidad, "oferta": lleve N pague M)."""
+    original_price = unit_price * quantity
+    final_price = original_price
+    if promo is not None:
+        if promo.type == "promocion":
+            price_with_discount = unit_price
+            if promo.discount_percent:
+                price_with_discount -= price_with_discount * (promo.discount_percent / 100)
+            if promo.fixed_discount:
+                price_with_discount -= promo.fixed_discount
+            price_with_discount = max(price_with_discount, 0)
+            final_price = price_with_discount * quantity
+        elif promo.type == "oferta" and promo.offer_quantity and promo.offer_pay:
+            full_offers = quantity // promo.offer_quantity
+            rest = quantity % promo.offer_quantity
+            final_price = (full_offers * promo.offer_pay + rest) * unit_price
+    return {
+        "unit_price": unit_price,
+        "original_price": original_price,
+        "discount_applied": original_price - final_price,
+        "final_price": final_price,
+        "promotion": promotion_info(promo)
+    }
 
-    total_price = 0
-    detailed_items = []
+def pick_promotion(candidates, product_id: int, unit_price, quantity: int):
+    """Desempate determinista: la del producto sobre la de categoría, luego el menor precio final, luego el menor id."""
+    return min(
+        candidates,
+        key=lambda r: (r.product_id != product_id, price_line(unit_price, quantity, r)["final_price"], r.id),
+        default=None
+    )
 
-    for item in order.items:
-        product = db.query(ProductDB).filter(ProductDB.id == item.product_id).first()
-        if not product or product.stock < item.quantity:
-            raise HTTPException(status_code=400, detail=f"Stock insuficiente para el producto {product.name}")
+class PromotionEngine:
+    """
+    Promociones activas y próximas en memoria, indexadas por producto y por categoría.
+    Se recarga sola en el siguiente inicio/fin de alguna promoción, al escribir promociones
+    y cada PROMOTION_REFRESH_SECONDS (para ver cambios de otros workers).
+    """
 
+    def __init__(self, horizon: timedelta, max_age: float):
+        self.horizon = horizon
+        self.max_age = max_age
+        self._by_product = {}   # product_id -> [PromotionRule] ordenadas por start_date
+        self._by_category = {}  # category_id -> [PromotionRule] ordenadas por start_date
+        self._all = []
+        self._boundaries = []   # instantes (ordenados) en que cambia el conjunto de promociones activas
+        self._refresh_at = None
+        self._lock = threading.Lock()
+
+    def load(self, db: Session):
         now = datetime.utcnow()
-        promo = db.query(PromotionDB).filter(
+        rows = db.query(PromotionDB).filter(
             PromotionDB.active == True,
-            PromotionDB.start_date <= now,
             PromotionDB.end_date >= now,
-            ((PromotionDB.product_id == product.id) |
-             (PromotionDB.category_id == product.category_id))
-        ).first()
-
-        unit_price = product.price
-        original_price = product.price * item.quantity
-        discount_applied = 0
-        promo_info = None
-
-        if promo:
-            promo_info = {
-                "id": promo.id,
-                "type": promo.type,
-                "title": promo.title,
-                "description": promo.description,
-                "discount_percent": promo.discount_percent,
-                "fixed_discount": promo.fixed_discount,
-                "offer_quantity": promo.offer_quantity,
-                "offer_pay": promo.offer_pay,
-            }
-
-            if promo.type == "promocion":
-                price_with_discount = unit_price
-                if promo.discount_percent:
-                    price_with_discount -= price_with_discount * (promo.discount_percent / 100)
-                if promo.fixed_discount:
-                    price_with_discount -= promo.fixed_discount
-                price_with_discount = max(price_with_discount, 0)
-                total_line = price_with_discount * item.quantity
-                discount_applied = original_price - total_line
-                total_price += total_line
-
-            elif promo.type == "oferta" and promo.offer_quantity and promo.offer_pay:
-                full_offers = item.quantity // promo.offer_quantity
-                rest = item.quantity % promo.offer_quantity
-                total_line = (full_offers * promo.offer_pay + rest) * unit_price
-                discount_applied = original_price - total_line
-                total_price += total_line
+            PromotionDB.start_date <= now + self.horizon
+        ).all()
+        rules = sorted(
+            (PromotionRule(**{f: getattr(r, f) for f in PromotionRule._fields}) for r in rows),
+            key=lambda r: (r.start_date, r.id)
+        )
+        by_product, by_category = {}, {}
+        for rule in rules:
+            if rule.product_id is not None:
+                by_product.setdefault(rule.product_id, []).append(rule)
+            if rule.category_id is not None:
+                by_category.setdefault(rule.category_id, []).append(rule)
+        boundaries = sorted(
+            {r.start_date for r in rules if r.start_date > now} |
+            {r.end_date + timedelta(microseconds=1) for r in rules}
+        )
+        refresh_at = now + timedelta(seconds=self.max_age)
+        if boundaries:
+            refresh_at = min(refresh_at, boundaries[0])
+        with self._lock:
+            self._by_product, self._by_category, self._all = by_product, by_category, rules
+            self._boundaries = boundaries
+            self._refresh_at = refresh_at
+
+    def invalidate(self):
+        with self._lock:
+            self._refresh_at = None
+
+    def _ensure_fresh(self, db: Session, now: datetime):
+        if self._refresh_at is None or now >= self._refresh_at:
+            self.load(db)
+
+    @staticmethod
+    def _active(rules: List[PromotionRule], now: datetime) -> List[PromotionRule]:
+        # Las reglas están ordenadas por inicio: se descartan las que aún no empiezan
+        end = bisect.bisect_right(rules, now, key=lambda r: r.start_date)
+        return [r for r in rules[:end] if r.end_date >= now]
+
+    def active(self, db: Session, product_id: int = None, category_id: int = None,
+               now: datetime = None) -> List[PromotionRule]:
+        """Promociones vigentes para un producto y/o su categoría: primero las del producto, luego por id."""
+        now = now or datetime.utcnow()
+        self._ensure_fresh(db, now)
+        with self._lock:
+            if product_id is None and category_id is None:
+                candidates = self._active(self._all, now)
             else:
-                total_price += original_price
-        else:
-            total_price += original_price
+                candidates = self._active(self._by_product.get(product_id, []), now)
+                seen = {r.id for r in candidates}
+                candidates += [r for r in self._active(self._by_category.get(category_id, []), now)
+                               if r.id not in seen]
+        return sorted(candidates, key=lambda r: (r.product_id is None, r.id))
+
+    def resolve_cart(self, db: Session, lines: List[tuple], now: datetime = None) -> List[Optional[PromotionRule]]:
+        """
+        Promoción aplicable a cada línea (product_id, category_id, unit_price, quantity), ver pick_promotion.
+        """
+        now = now or datetime.utcnow()
+        return [
+            pick_promotion(self.active(db, product_id, category_id, now), product_id, unit_price, quantity)
+            for product_id, category_id, unit_price, quantity in lines
+        ]
 
-        product.stock -= item.quantity
-        order_item = OrderItemDB(order_id=new_order.id, product_id=product.id, quantity=item.quantity)
-        db.add(order_item)
+    def stats(self) -> dict:
+        return {"rules": len(self._all), "next_refresh": self._refresh_at}
 
-        detailed_items.append({
-            "product_id": product.id,
-            "name": product.name,
-            "quantity": item.quantity,
-            "unit_price": unit_price,
-            "original_price": original_price,
-            "discount_applied": discount_applied,
-            "final_price": original_price - discount_applied,
-            "promotion": promo_info
-        })
+promotion_engine = PromotionEngine(
+    horizon=timedelta(days=int(os.getenv("PROMOTION_HORIZON_DAYS", "7"))),
+    max_age=float(os.getenv("PROMOTION_REFRESH_SECONDS", "60"))
+)
 
-    new_order.total = total_price
-    db.commit()
+# -----------------------------
+# Idempotencia (header Idempotency-Key)
+# -----------------------------
+IDEMPOTENCY_TTL = timedelta(hours=int(os.getenv("IDEMPOTENCY_TTL_HOURS", "24")))
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv("IDEMPOTENCY_LOCK_SECONDS", "120"))
+IDEMPOTENCY_PURGE_SECONDS = int(os.getenv("IDEMPOTENCY_PURGE_SECONDS", "3600"))
+# Cache local de respuestas ya completadas: (user_id, endpoint, key) -> (fingerprint, status, body)
+idempotency_cache = TTLCache(maxsize=10000, ttl=min(IDEMPOTENCY_TTL.total_seconds(), 3600))
+
+def request_fingerprint(payload) -> str:
+    return hashlib.sha256(json.dumps(jsonable_encoder(payload), sort_keys=True).encode()).hexdigest()
+
+def idempotent_replay(fingerprint: str, stored: tuple) -> JSONResponse:
+    stored_fingerprint, status_code, body = stored
+    if stored_fingerprint != fingerprint:
+        raise HTTPException(status_code=422, detail="Idempotency-Key ya usada con un cuerpo distinto")
+    return JSONResponse(status_code=status_code, content=json.loads(body), headers={"Idempotent-Replayed": "true"})
+
+def reserve_idempotency_key(user_id: int, endpoint: str, key: str, fingerprint: str) -> tuple:
+    """
+    Reserva la llave antes de ejecutar la operación. Devuelve (None, reserved_at) si esta request debe
+    ejecutarse, o (respuesta guardada, None) si es un reintento. El UNIQUE de la tabla resuelve los
+    duplicados concurrentes; reserved_at identifica esta reserva frente a un relevo posterior.
+    """
+    cache_key = (user_id, endpoint, key)
+    cached = idempotency_cache.get(cache_key)
+    if cached is not None:
+        return idempotent_replay(fingerprint, cached), None
 
-    # Gamificación
-    level, points = add_points_and_check_level(db, current_user.id, total_price)
-    check_and_complete_missions(db, current_user.id, new_order)
+    db = SessionLocal()
+    try:
+        for _ in range(2):
+            # Sin microsegundos: DATETIME de MySQL los trunca y reserved_at se compara por igualdad
+            now = datetime.utcnow().replace(microsecond=0)
+            db.add(IdempotencyKeyDB(
+                key=key, user_id=user_id, endpoint=endpoint, fingerprint=fingerprint,
+                status="processing", created_at=now, expires_at=now + IDEMPOTENCY_TTL
+            ))
+            try:
+                db.commit()
+                return None, now
+            except IntegrityError:
+                db.rollback()
+
+            record = db.query(IdempotencyKeyDB).filter_by(user_id=user_id, endpoint=endpoint, key=key).first()
+            if record is None or record.expires_at < now:
+                # Expirada (o purgada entre medio): se descarta y se reintenta la reserva
+                if record is not None:
+                    db.delete(record)
+                    db.commit()
+                continue
+            if record.fingerprint != fingerprint:
+                raise HTTPException(status_code=422, detail="Idempotency-Key ya usada con un cuerpo distinto")
+            if record.status == "completed":
+                stored = (record.fingerprint, record.response_code, record.response_body)
+                idempotency_cache.set(cache_key, stored)
+                return idempotent_replay(fingerprint, stored), None
+
+            # Otra request con la misma llave está en curso; si quedó abandonada se toma el relevo
+            taken = db.query(IdempotencyKeyDB).filter(
+                IdempotencyKeyDB.id == record.id,
+                IdempotencyKeyDB.status == "processing",
+                IdempotencyKeyDB.created_at < now - timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)
+            ).update({"created_at": now, "expires_at": now + IDEMPOTENCY_TTL}, synchronize_session=False)
+            db.commit()
+            if taken:
+                return None, now
+            break
+        raise HTTPException(
+            status_code=409,
+            detail="Ya hay una solicitud en proceso con esta Idempotency-Key",
+            headers={"Retry-After": "1"}
+        )
+    finally:
+        db.close()
 
-    return {
-        "message": "Pedido creado exitosamente",
-        "order_id": new_order.id,
-        "total": total_price,
-        "items": detailed_items,
-        "user_level": level,
-        "user_points": points
-    }
+def complete_idempotency_key(db: Session, user_id: int, endpoint: str, key: str, reserved_at: datetime,
+                             content, status_code: int = 200) -> str:
+    """
+    Guarda la respuesta en la llave dentro de la transacción del llamador (sin commit): queda completada
+    junto con los cambios de la operación o no queda. Si otra request tomó el relevo de la reserva,
+    aborta con 409 en vez de confirmar la operación dos veces.
+    """
+    body = json.dumps(jsonable_encoder(content))
+    updated = db.query(IdempotencyKeyDB).filter_by(
+        user_id=user_id, endpoint=endpoint, key=key, status="processing", created_at=reserved_at
+    ).update({"status": "completed", "response_code": status_code, "response_body": body},
+             synchronize_session=False)
+    if not updated:
+        raise HTTPException(
+            status_code=409,
+            detail="Ya hay una solicitud en proceso con esta Idempotency-Key",
+            headers={"Retry-After": "1"}
+        )
+    return body
 
-@app.get("/orders/")
-async def list_orders(db: Session = Depends(get_db), current_user: UserDB = Depends(verify_role(["admin", "almacenista", "cliente"]))):
-    """Listar órdenes según rol del usuario."""
-    if current_user.role.name == "cliente":
-        return db.query(OrderDB).filter(OrderDB.client_id == current_user.id).all()
-    return db.query(OrderDB).all()
+def release_idempotency_key(user_id: int, endpoint: str, key: str, reserved_at: datetime):
+    """Si la operación falló se libera la llave (solo si sigue siendo nuestra reserva) para poder reintentar."""
+    db = SessionLocal()
+    try:
+        db.query(IdempotencyKeyDB).filter_by(
+            user_id=user_id, endpoint=endpoint, key=key, status="processing", created_at=reserved_at
+        ).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
 
-@app.get("/orders/{id}")
-async def get_order_details(id: int, db: Session = Depends(get_db), current_user: UserDB = Depends(verify_role(["admin", "almacenista", "cliente"]))):
+def run_idempotent(user_id: int, endpoint: str, key: Optional[str], payload, operation):
     """
-    Obtener detalles de una orden, incluyendo detalle de promociones/descuentos aplicados.
+    Ejecuta operation(complete) una sola vez por Idempotency-Key; los reintentos reciben la respuesta guardada.
+    La operación debe llamar complete(db, respuesta) justo antes de su commit: así la llave se completa en
+    la misma transacción que sus cambios y una caída después del commit no permite repetirla.
     """
-    order = get_order(db, id)
-    if not order:
-        raise HTTPException(status_code=404, detail="Pedido no encontrado")
-    if current_user.role.name == "cliente" and order.client_id != current_user.id:
-        raise HTTPException(status_code=403, detail="No tienes acceso a este pedido")
+    if not key:
+        return operation(lambda db, content: None)
+    fingerprint = request_fingerprint(payload)
+    replay, reserved_at = reserve_idempotency_key(user_id, endpoint, key, fingerprint)
+    if replay is not None:
+        return replay
+    completed = []
 
-    # Armar detalle de items con promociones/ahorro aplicado
-    detailed_items = []
-    total_price = 0
+    def complete(db: Session, content):
+        completed.append(complete_idempotency_key(db, user_id, endpoint, key, reserved_at, content))
 
-    for item in order.items:
-        product = db.query(ProductDB).filter(ProductDB.id == item.product_id).first()
-        if not product:
-            continue  # Producto eliminado, omitir
+    try:
+        result = operation(complete)
+    except Exception:
+        release_idempotency_key(user_id, endpoint, key, reserved_at)
+        raise
+    if completed:
+        idempotency_cache.set((user_id, endpoint, key), (fingerprint, 200, completed[-1]))
+    return result
 
-        # Buscar promoción/oferta activa (en el momento en que consultamos, no necesariamente la original)
-        # Si quieres guardar la promo "congelada" tendrías que persistir el detalle al crear la orden.
-        now = datetime.utcnow()
-        promo = db.query(PromotionDB).filter(
-            PromotionDB.active == True,
-            PromotionDB.start_date <= now,
-            PromotionDB.end_date >= now,
-            ((PromotionDB.product_id == product.id) |
-             (PromotionDB.category_id == product.category_id))
-        ).first()
-
-        unit_price = product.price
-        original_price = unit_price * item.quantity
-        discount_applied = 0
-        promo_info = None
-        final_price = original_price
-
-        if promo:
-            promo_info = {
-                "id": promo.id,
-                "type": promo.type,
-                "title": promo.title,
-                "description": promo.description,
-                "discount_percent": promo.discount_percent,
-                "fixed_discount": promo.fixed_discount,
-                "offer_quantity": promo.offer_quantity,
-                "offer_pay": promo.offer_pay,
-            }
-            if promo.type == "promocion":
-                price_with_discount = unit_price
-                if promo.discount_percent:
-                    price_with_discount -= price_with_discount * (promo.discount_percent / 100)
-                if promo.fixed_discount:
-                    price_with_discount -= promo.fixed_discount
-                price_with_discount = max(price_with_discount, 0)
-                final_price = price_with_discount * item.quantity
-                discount_applied = original_price - final_price
-            elif promo.type == "oferta" and promo.offer_quantity and promo.offer_pay:
-                full_offers = item.quantity // promo.offer_quantity
-                rest = item.quantity % promo.offer_quantity
-                final_price = (full_offers * promo.offer_pay + rest) * unit_price
-                discount_applied = original_price - final_price
-
-        total_price += final_price
+def purge_expired_idempotency_keys() -> int:
+    db = SessionLocal()
+    try:
+        deleted = db.query(IdempotencyKeyDB).filter(
+            IdempotencyKeyDB.expires_at < datetime.utcnow()
+        ).delete(synchronize_session=False)
+        db.commit()
+        return deleted
+    finally:
+        db.close()
+
+async def idempotency_purge_loop():
+    while True:
+        await asyncio.sleep(IDEMPOTENCY_PURGE_SECONDS)
+        try:
+            deleted = await run_in_threadpool(purge_expired_idempotency_keys)
+            logging.debug("Idempotency keys expiradas eliminadas: %d", deleted)
+        except Exception:
+            logging.exception("Error purgando idempotency keys")
+
+background_tasks = []
+
+@app.on_event("startup")
+async def start_idempotency_purge():
+    background_tasks.append(asyncio.create_task(idempotency_purge_loop()))
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    for task in background_tasks:
+        task.cancel()
+
+# -----------------------------
+# Endpoints de Órdenes
+# -----------------------------
+def get_order(db: Session, order_id: int) -> OrderDB:
+    return (
+        db.query(OrderDB)
+        .options(joinedload(OrderDB.items).joinedload(OrderItemDB.product))
+        .filter(OrderDB.id == order_id)
+        .first()
+    )
 
+@app.post("/orders/")
+async def create_order(order: OrderCreateRequest, db: Session = Depends(get_db), 
+                       current_user: Principal = Depends(verify_role(["cliente", "admin"])),
+                       idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=100)):
+    # place_order es síncrono (FOR UPDATE puede esperar locks): se ejecuta fuera del event loop
+    return await run_in_threadpool(
+        run_idempotent, current_user.id, "POST /orders/", idempotency_key, order,
+        lambda complete: place_order(order, db, current_user, complete)
+    )
+
+def place_order(order: OrderCreateRequest, db: Session, current_user: Principal, complete=None) -> dict:
+    """Crea la orden en una transacción; complete(db, respuesta) se llama antes del commit (idempotencia)."""
+    if not order.items:
+        raise HTTPException(status_code=400, detail="La orden debe contener al menos un producto")
+    if any(item.quantity <= 0 for item in order.items):
+        raise HTTPException(status_code=400, detail="La cantidad de cada producto debe ser mayor que 0")
+    
+    address = db.query(AddressDB).filter(AddressDB.id == order.address_id, AddressDB.user_id == current_user.id).first()
+    if not address:
+        raise HTTPException(400, "Dirección de envío inválida")
+
+    # Cantidad total pedida por producto (un producto puede venir en varias líneas)
+    requested = {}
+    for item in order.items:
+        requested[item.product_id] = requested.get(item.product_id, 0) + item.quantity
+
+    # Toda la orden en una sola transacción: se bloquean las filas de los productos
+    # (en orden de id para evitar deadlocks entre checkouts concurrentes)
+    try:
+        products = {
+            p.id: p for p in db.query(ProductDB)
+            .filter(ProductDB.id.in_(sorted(requested)))
+            .order_by(ProductDB.id)
+            .with_for_update()
+            .all()
+        }
+        for product_id, quantity in requested.items():
+            product = products.get(product_id)
+            if not product:
+                raise HTTPException(status_code=400, detail=f"Producto {product_id} no encontrado")
+            if product.stock < quantity:
+                raise HTTPException(status_code=400, detail=f"Stock insuficiente para el producto {product.name}")
+
+        # Promociones de todo el carrito resueltas en memoria
+        promos = promotion_engine.resolve_cart(db, [
+            (item.product_id, products[item.product_id].category_id,
+             products[item.product_id].price, item.quantity)
+            for item in order.items
+        ])
+
+        new_order = OrderDB(client_id=current_user.id, address_id=order.address_id, total=0,
+                            delivery_status="pendiente")
+        db.add(new_order)
+        db.flush()
+
+        # Descuento condicional de stock: nunca deja stock negativo aunque otro checkout se adelante
+        for product_id, quantity in requested.items():
+            result = db.execute(
+                update(ProductDB)
+                .where(ProductDB.id == product_id, ProductDB.stock >= quantity)
+                .values(stock=ProductDB.stock - quantity)
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount != 1:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Stock insuficiente para el producto {products[product_id].name}"
+                )
+
+        total_price = 0
+        detailed_items = []
+
+        for item, promo in zip(order.items, promos):
+            product = products[item.product_id]
+            line = price_line(product.price, item.quantity, promo)
+            total_price += line["final_price"]
+            detailed_items.append({
+                "product_id": product.id,
+                "name": product.name,
+                "quantity": item.quantity,
+                **line
+            })
+
+        # Líneas de la orden (con su precio congelado) en un solo INSERT masivo
+        db.execute(insert(OrderItemDB), [
+            {
+                "order_id": new_order.id,
+                "product_id": item.product_id,
+                "quantity": item.quantity,
+                "unit_price": line["unit_price"],
+                "discount_applied": line["discount_applied"],
+                "final_price": line["final_price"],
+                "promotion_id": promo.id if promo else None
+            }
+            for item, promo, line in zip(order.items, promos, detailed_items)
+        ])
+        new_order.total = total_price
+        # Gamificación y misiones se procesan en segundo plano; el evento se guarda en la misma transacción
+        bump_daily_rollup(db, new_order.created_at.date(), orders_count=1)
+        db.add(OutboxEventDB(
+            event_type="order_created",
+            payload=json.dumps({"order_id": new_order.id, "user_id": current_user.id, "total": total_price})
+        ))
+
+        # Nivel/puntos previos a esta orden si están en cache; si no, el cliente debe consultarlos luego
+        level, points = gamification_cache.get(current_user.id) or ("pending", "pending")
+        response = {
+            "message": "Pedido creado exitosamente",
+            "order_id": new_order.id,
+            "total": total_price,
+            "items": detailed_items,
+            "user_level": level,
+            "user_points": points
+        }
+        if complete is not None:
+            complete(db, response)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    catalog_snapshot.invalidate()  # cambió el stock
+    outbox_worker.notify()
+    return response
+
+def parse_keyset_cursor(cursor: str):
+    """Cursor "<datetime ISO>_<id>" usado por los listados paginados por (fecha, id)."""
+    try:
+        cursor_ts, cursor_id = cursor.rsplit("_", 1)
+        return datetime.fromisoformat(cursor_ts), int(cursor_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+ORDER_SUMMARY_COLUMNS = [
+    OrderDB.id, OrderDB.client_id, OrderDB.address_id, OrderDB.status, OrderDB.delivery_status,
+    OrderDB.total, OrderDB.created_at, OrderDB.stripe_payment_intent_id, OrderDB.payment_status,
+]
+
+def order_summary(row) -> dict:
+    summary = {column.key: value for column, value in zip(ORDER_SUMMARY_COLUMNS, row)}
+    summary["client"] = {"id": row.client_id, "username": row.client_username}
+    return summary
+
+ORDERS_PAGE_SIZE = 50
+
+@app.get("/orders/")
+async def list_orders(
+    limit: int = Query(ORDERS_PAGE_SIZE, ge=1, le=500),
+    cursor: Optional[str] = Query(None, description="next_cursor de la página anterior"),
+    status_filter: Optional[str] = Query(None, alias="status"),
+    payment_status: Optional[str] = Query(None),
+    delivery_status: Optional[str] = Query(None),
+    client_id: Optional[int] = Query(None),
+    date_from: Optional[datetime] = Query(None, alias="from"),
+    date_to: Optional[datetime] = Query(None, alias="to"),
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(verify_role(["admin", "almacenista", "cliente"]))
+):
+    """
+    Listar órdenes según rol del usuario (resumen sin cargar relaciones).
+    Devuelve {"items": [...], "next_cursor": str | null}, de la más reciente a la más antigua,
+    paginando por (created_at, id); la siguiente página se pide con cursor=next_cursor.
+    """
+    query = (
+        db.query(*ORDER_SUMMARY_COLUMNS, UserDB.username.label("client_username"))
+        .outerjoin(UserDB, OrderDB.client_id == UserDB.id)
+    )
+    if current_user.role == "cliente":
+        client_id = current_user.id
+    if client_id is not None:
+        query = query.filter(OrderDB.client_id == client_id)
+    if status_filter is not None:
+        query = query.filter(OrderDB.status == status_filter)
+    if payment_status is not None:
+        query = query.filter(OrderDB.payment_status == payment_status)
+    if delivery_status is not None:
+        query = query.filter(OrderDB.delivery_status == delivery_status)
+    if date_from is not None:
+        query = query.filter(OrderDB.created_at >= date_from)
+    if date_to is not None:
+        query = query.filter(OrderDB.created_at <= date_to)
+
+    if cursor:
+        cursor_created, cursor_id = parse_keyset_cursor(cursor)
+        query = query.filter(
+            (OrderDB.created_at < cursor_created) |
+            ((OrderDB.created_at == cursor_created) & (OrderDB.id < cursor_id))
+        )
+    rows = query.order_by(OrderDB.created_at.desc(), OrderDB.id.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = f"{rows[-1].created_at.isoformat()}_{rows[-1].id}" if has_more else None
+    return {"items": [order_summary(row) for row in rows], "next_cursor": next_cursor}
+
+@app.get("/orders/{id}")
+async def get_order_details(id: int, db: Session = Depends(get_db), current_user: Principal = Depends(verify_role(["admin", "almacenista", "cliente"]))):
+    """
+    Obtener detalles de una orden, incluyendo detalle de promociones/descuentos aplicados.
+    """
+    order = (
+        db.query(OrderDB)
+        .options(
+            joinedload(OrderDB.items).joinedload(OrderItemDB.product),
+            joinedload(OrderDB.items).joinedload(OrderItemDB.promotion)
+        )
+        .filter(OrderDB.id == id)
+        .first()
+    )
+    if not order:
+        raise HTTPException(status_code=404, detail="Pedido no encontrado")
+    if current_user.role == "cliente" and order.client_id != current_user.id:
+        raise HTTPException(status_code=403, detail="No tienes acceso a este pedido")
+
+    # Armar detalle de items con el precio/promoción congelados al crear la orden
+    items = [item for item in order.items if item.product]  # Productos eliminados se omiten
+    # Órdenes antiguas aún sin backfill: promoción vigente en el momento de la consulta
+    legacy = [item for item in items if item.unit_price is None]
+    legacy_promos = dict(zip(
+        (item.id for item in legacy),
+        promotion_engine.resolve_cart(db, [
+            (item.product_id, item.product.category_id, item.product.price, item.quantity) for item in legacy
+        ])
+    ))
+    detailed_items = []
+    for item in items:
+        if item.unit_price is None:
+            line = price_line(item.product.price, item.quantity, legacy_promos[item.id])
+        else:
+            line = {
+                "unit_price": item.unit_price,
+                "original_price": item.unit_price * item.quantity,
+                "discount_applied": item.discount_applied,
+                "final_price": item.final_price,
+                "promotion": promotion_info(item.promotion)
+            }
         detailed_items.append({
-            "product_id": product.id,
-            "name": product.name,
+            "product_id": item.product.id,
+            "name": item.product.name,
             "quantity": item.quantity,
-            "unit_price": unit_price,
-            "original_price": original_price,
-            "discount_applied": discount_applied,
-            "final_price": final_price,
-            "promotion": promo_info
+            **line
         })
+    total_price = order.total if not legacy else sum(line["final_price"] for line in detailed_items)
 
     return {
         "order_id": order.id,
@@ -1047,9 +2585,61 @@ async def get_order_details(id: int, db: Session = Depends(get_db), current_user
         "items": detailed_items
     }
 
+def backfill_order_item_snapshots(db: Session, batch_size: int = 500) -> int:
+    """
+    Congela precio/promoción de líneas históricas (unit_price NULL), por lotes.
+    Usa el precio actual del producto y la promoción vigente en la fecha de la orden: es una aproximación.
+    """
+    updated = 0
+    last_id = 0
+    while True:
+        items = (
+            db.query(OrderItemDB)
+            .options(joinedload(OrderItemDB.product), joinedload(OrderItemDB.order))
+            .filter(OrderItemDB.unit_price.is_(None), OrderItemDB.id > last_id)
+            .order_by(OrderItemDB.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not items:
+            break
+        last_id = items[-1].id
+        dated = [item for item in items if item.product and item.order and item.order.created_at]
+        if dated:
+            lo = min(item.order.created_at for item in dated)
+            hi = max(item.order.created_at for item in dated)
+            promos = (
+                db.query(PromotionDB)
+                .filter(PromotionDB.start_date <= hi, PromotionDB.end_date >= lo)
+                .all()
+            )
+        for item in dated:
+            at, product = item.order.created_at, item.product
+            candidates = [
+                p for p in promos
+                if p.start_date <= at <= p.end_date and (
+                    p.product_id == product.id or
+                    (product.category_id is not None and p.category_id == product.category_id)
+                )
+            ]
+            promo = pick_promotion(candidates, product.id, product.price, item.quantity)
+            line = price_line(product.price, item.quantity, promo)
+            item.unit_price = line["unit_price"]
+            item.discount_applied = line["discount_applied"]
+            item.final_price = line["final_price"]
+            item.promotion_id = promo.id if promo else None
+            updated += 1
+        db.commit()
+    return updated
+
+@app.post("/admin/jobs/backfill-order-items", dependencies=[Depends(verify_role(["admin"]))])
+def run_backfill_order_items(db: Session = Depends(get_db)):
+    """Backfill de precios congelados para órdenes creadas antes de guardar el snapshot por línea."""
+    return {"updated": backfill_order_item_snapshots(db)}
+
 @app.put("/orders/{id}")
 async def update_order(id: int, order_data: OrderCreateRequest, db: Session = Depends(get_db),
-                       current_user: UserDB = Depends(verify_role(["admin", "almacenista", "cliente"]))):
+                       current_user: Principal = Depends(verify_role(["admin", "almacenista", "cliente"]))):
     """
     Actualizar una orden.
     Nota: No se permite modificar el comprador; la lógica para actualizar items deberá definirse según el caso de uso.
@@ -1057,7 +2647,7 @@ async def update_order(id: int, order_data: OrderCreateRequest, db: Session = De
     order = get_order(db, id)
     if not order:
         raise HTTPException(status_code=404, detail="Pedido no encontrado")
-    if current_user.role.name == "cliente" and order.client_id != current_user.id:
+    if current_user.role == "cliente" and order.client_id != current_user.id:
         raise HTTPException(status_code=403, detail="No tienes permiso para actualizar este pedido")
     # Se mantiene el cliente original y se omite la actualización de items en este ejemplo.
     db.commit()
@@ -1065,80 +2655,456 @@ async def update_order(id: int, order_data: OrderCreateRequest, db: Session = De
 
 @app.delete("/orders/{id}")
 async def cancel_order(id: int, db: Session = Depends(get_db), 
-                       current_user: UserDB = Depends(verify_role(["admin", "cliente"]))):
+                       current_user: Principal = Depends(verify_role(["admin", "cliente"]))):
     """Cancelar una orden pendiente (se elimina si no está confirmada)."""
     order = get_order(db, id)
     if not order or order.status != "pending":
         raise HTTPException(status_code=400, detail="El pedido no puede ser cancelado")
-    if current_user.role.name == "cliente" and order.client_id != current_user.id:
+    if current_user.role == "cliente" and order.client_id != current_user.id:
         raise HTTPException(status_code=403, detail="No puedes cancelar este pedido")
+    bump_daily_rollup(db, order.created_at.date(), orders_count=-1)
     db.delete(order)
     db.commit()
     return {"message": "Pedido cancelado"}
 
+ORDER_CONFIRM_CHUNK_SIZE = int(os.getenv("ORDER_CONFIRM_CHUNK_SIZE", "200"))
+ORDER_CONFIRMED_STOCK_DESCRIPTION = "Stock disminuido por orden confirmada"
+ORDER_CONFIRM_MAX_IDS = int(os.getenv("ORDER_CONFIRM_MAX_IDS", "2000"))
+
+def confirm_orders_chunk(db: Session, order_ids: List[int], current_user: Principal) -> List[dict]:
+    """
+    Confirma un grupo de órdenes en una sola transacción: UPDATE con guarda sobre payment_status
+    y movimientos financieros/de stock con INSERT masivos. Devuelve el resultado de cada orden.
+    Permite: cliente dueño de la orden, admin o almacenista.
+    """
+    outcomes = {}
+    try:
+        rows = db.execute(
+            select(OrderDB.id, OrderDB.client_id, OrderDB.total, OrderDB.payment_status, OrderDB.created_at)
+            .where(OrderDB.id.in_(order_ids))
+            .order_by(OrderDB.id)
+            .with_for_update()
+        ).all()
+        found = {r.id: r for r in rows}
+        eligible = []
+        for order_id in order_ids:
+            row = found.get(order_id)
+            if row is None:
+                outcomes[order_id] = {"status": "not_found", "detail": "Pedido no encontrado"}
+            elif not (current_user.role in ["admin", "almacenista"]
+                      or (current_user.role == "cliente" and row.client_id == current_user.id)):
+                outcomes[order_id] = {"status": "forbidden", "detail": "No tienes permiso para confirmar este pedido"}
+            elif row.payment_status == "paid":
+                outcomes[order_id] = {"status": "already_paid", "detail": "Pedido ya pagado"}
+            else:
+                eligible.append(order_id)
+
+        if eligible:
+            updated = db.execute(
+                update(OrderDB)
+                .where(OrderDB.id.in_(eligible), func.coalesce(OrderDB.payment_status, "") != "paid")
+                .values(payment_status="paid", status="confirmed")
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if updated != len(eligible):
+                # No debería ocurrir con las filas bloqueadas; se aborta el grupo antes que duplicar movimientos
+                raise RuntimeError("Otra transacción confirmó pedidos de este grupo")
+
+            now = datetime.utcnow()
+            items = db.execute(
+                select(OrderItemDB.product_id, OrderItemDB.quantity)
+                .where(OrderItemDB.order_id.in_(eligible))
+                .order_by(OrderItemDB.order_id, OrderItemDB.id)
+            ).all()
+            db.execute(insert(FinancialMovementDB), [
+                {"order_id": order_id, "timestamp": now, "amount": found[order_id].total,
+                 "description": "Orden confirmada"}
+                for order_id in eligible
+            ])
+            paid_by_day = {}
+            for order_id in eligible:
+                day = found[order_id].created_at.date()
+                count, amount = paid_by_day.get(day, (0, 0.0))
+                paid_by_day[day] = (count + 1, amount + (found[order_id].total or 0.0))
+            for day, (count, amount) in paid_by_day.items():
+                bump_daily_rollup(db, day, paid_orders_count=count, paid_revenue=amount)
+            if items:
+                db.execute(insert(StockMovementDB), [
+                    {"product_id": item.product_id, "timestamp": now, "change": -item.quantity,
+                     "description": ORDER_CONFIRMED_STOCK_DESCRIPTION}
+                    for item in items
+                ])
+        db.commit()
+        for order_id in eligible:
+            outcomes[order_id] = {"status": "confirmed"}
+    except Exception as exc:
+        db.rollback()
+        logging.exception("Error confirmando pedidos %s", order_ids)
+        for order_id in order_ids:
+            if order_id not in outcomes or outcomes[order_id]["status"] == "confirmed":
+                outcomes[order_id] = {"status": "error", "detail": str(exc)}
+    return [{"order_id": order_id, **outcomes[order_id]} for order_id in order_ids]
+
+@app.post("/orders/confirm")
+def confirm_orders(
+    data: OrderConfirmBatchRequest,
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)
+):
+    """Confirmar varias órdenes a la vez, en transacciones de ORDER_CONFIRM_CHUNK_SIZE órdenes."""
+    order_ids = list(dict.fromkeys(data.order_ids))  # sin duplicados, manteniendo el orden
+    if not order_ids:
+        raise HTTPException(status_code=400, detail="Debe indicar al menos un pedido")
+    if len(order_ids) > ORDER_CONFIRM_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"Máximo {ORDER_CONFIRM_MAX_IDS} pedidos por solicitud")
+
+    results = []
+    for start in range(0, len(order_ids), ORDER_CONFIRM_CHUNK_SIZE):
+        results.extend(confirm_orders_chunk(db, order_ids[start:start + ORDER_CONFIRM_CHUNK_SIZE], current_user))
+    return {
+        "confirmed": sum(1 for r in results if r["status"] == "confirmed"),
+        "results": results
+    }
+
 @app.post("/orders/{id}/confirm")
-async def confirm_order(
+def confirm_order(
     id: int,
     db: Session = Depends(get_db),
-    current_user: UserDB = Depends(get_current_user)
+    current_user: Principal = Depends(get_current_user)
 ):
     """
     Confirmar una orden y registrar los movimientos económicos correspondientes.
     Permite: cliente dueño de la orden, admin o almacenista.
     """
-    order = get_order(db, id)
-    if not order:
-        raise HTTPException(status_code=404, detail="Pedido no encontrado")
+    outcome = confirm_orders_chunk(db, [id], current_user)[0]
+    error_codes = {"not_found": 404, "forbidden": 403, "already_paid": 400, "error": 500}
+    if outcome["status"] in error_codes:
+        raise HTTPException(status_code=error_codes[outcome["status"]], detail=outcome["detail"])
+    return {"message": "Pedido confirmado"}
+
+# -----------------------------
+# Endpoints de Movimientos Económicos
+# -----------------------------
+FINANCIAL_MOVEMENT_COLUMNS = ["id", "order_id", "timestamp", "amount", "description"]
+STOCK_MOVEMENT_COLUMNS = ["id", "product_id", "timestamp", "change", "description"]
+LEDGER_PAGE_SIZE = 100
 
-    # Solo el cliente dueño, admin o almacenista pueden confirmar
-    is_client_owner = current_user.role.name == "cliente" and order.client_id == current_user.id
-    is_admin_or_almacenista = current_user.role.name in ["admin", "almacenista"]
+def ledger_response(db: Session, model, columns: List[str], filters: list, limit: int,
+                    cursor: Optional[str], fmt: Optional[str], compress: bool, filename: str):
+    """
+    Listado de un libro de movimientos en orden cronológico, paginado por (timestamp, id).
+    - Con format=ndjson se transmite todo el rango filtrado en streaming.
+    - En otro caso devuelve {"items": [...], "next_cursor": str | null}.
+    """
+    stmt = select(*[getattr(model, c) for c in columns])
+    for condition in filters:
+        stmt = stmt.where(condition)
+    if cursor:
+        cursor_ts, cursor_id = parse_keyset_cursor(cursor)
+        stmt = stmt.where(
+            (model.timestamp > cursor_ts) |
+            ((model.timestamp == cursor_ts) & (model.id > cursor_id))
+        )
 
-    if not (is_client_owner or is_admin_or_almacenista):
-        raise HTTPException(status_code=403, detail="No tienes permiso para confirmar este pedido")
+    if fmt == "ndjson":
+        stmt = stmt.order_by(model.timestamp, model.id)
+        return export_response(encode_rows(stream_query_rows(stmt), "ndjson", columns), "ndjson", filename, compress)
+
+    rows = db.execute(stmt.order_by(model.timestamp, model.id).limit(limit + 1)).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = f"{rows[-1].timestamp.isoformat()}_{rows[-1].id}" if has_more else None
+    return {"items": [dict(row._mapping) for row in rows], "next_cursor": next_cursor}
+
+@app.get("/financial_movements/")
+def list_financial_movements(
+    limit: int = Query(LEDGER_PAGE_SIZE, ge=1, le=1000),
+    cursor: Optional[str] = Query(None, description="next_cursor de la página anterior"),
+    date_from: Optional[datetime] = Query(None, alias="from"),
+    date_to: Optional[datetime] = Query(None, alias="to"),
+    order_id: Optional[int] = Query(None),
+    format: Optional[str] = Query(None, pattern="^ndjson$"),
+    compress: bool = Query(False, alias="gzip"),
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(verify_role(["admin", "almacenista"]))
+):
+    """Listar movimientos financieros."""
+    filters = []
+    if date_from is not None:
+        filters.append(FinancialMovementDB.timestamp >= date_from)
+    if date_to is not None:
+        filters.append(FinancialMovementDB.timestamp <= date_to)
+    if order_id is not None:
+        filters.append(FinancialMovementDB.order_id == order_id)
+    return ledger_response(db, FinancialMovementDB, FINANCIAL_MOVEMENT_COLUMNS, filters,
+                           limit, cursor, format, compress, "financial_movements")
+
+@app.get("/stock_movements/")
+def list_stock_movements(
+    limit: int = Query(LEDGER_PAGE_SIZE, ge=1, le=1000),
+    cursor: Optional[str] = Query(None, description="next_cursor de la página anterior"),
+    date_from: Optional[datetime] = Query(None, alias="from"),
+    date_to: Optional[datetime] = Query(None, alias="to"),
+    product_id: Optional[int] = Query(None),
+    format: Optional[str] = Query(None, pattern="^ndjson$"),
+    compress: bool = Query(False, alias="gzip"),
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(verify_role(["admin", "almacenista"]))
+):
+    """Listar movimientos de stock."""
+    filters = []
+    if date_from is not None:
+        filters.append(StockMovementDB.timestamp >= date_from)
+    if date_to is not None:
+        filters.append(StockMovementDB.timestamp <= date_to)
+    if product_id is not None:
+        filters.append(StockMovementDB.product_id == product_id)
+    return ledger_response(db, StockMovementDB, STOCK_MOVEMENT_COLUMNS, filters,
+                           limit, cursor, format, compress, "stock_movements")
 
-    if order.payment_status == "paid":
-        raise HTTPException(status_code=400, detail="Pedido ya pagado")
+# -----------------------------
+# Conciliación del libro de stock
+# -----------------------------
+RECONCILE_CHUNK_SIZE = int(os.getenv("RECONCILE_CHUNK_SIZE", "5000"))
+RECONCILE_REPORT_LIMIT = int(os.getenv("RECONCILE_REPORT_LIMIT", "1000"))
+RECONCILE_STALE_HOURS = int(os.getenv("RECONCILE_STALE_HOURS", "6"))
+STOCK_ADJUSTMENT_DESCRIPTION = "Ajuste por conciliación de inventario"
 
-    order.payment_status = "paid"
-    order.status = "confirmed"
+def reconcile_stock_ledger(db: Session, incremental: bool = True, fix: bool = False) -> dict:
+    """
+    Compara products.stock con el libro de movimientos. El stock esperado es la suma de movimientos
+    menos lo reservado por órdenes aún no pagadas (create_order descuenta stock, confirm registra el movimiento).
+
+    Los productos se recorren por bloques de ids y los totales de cada bloque se leen agrupados en la BD,
+    así que la memoria no depende del tamaño del libro ni queda un cursor abierto entre commits. Cada bloque
+    es una transacción que bloquea sus productos y las órdenes sin pagar que los reservan (FOR UPDATE) antes
+    de leer stock, reservas y movimientos: una orden creada o confirmada durante la corrida espera al commit
+    del bloque en vez de aparecer como diferencia (y, con fix, como ajuste falso).
+
+    En modo incremental solo se leen los movimientos posteriores al high-water mark de la última corrida
+    completa, sumados a los saldos guardados en stock_ledger_balances. Cada saldo guarda hasta qué movimiento
+    incluye (last_movement_id), así que no se vuelve a sumar lo ya sumado por un bloque posterior al
+    high-water mark o por una corrida fallida.
+    """
+    # Una corrida abandonada (proceso caído) libera el cupo pasado RECONCILE_STALE_HOURS
+    db.query(StockReconciliationRunDB).filter(
+        StockReconciliationRunDB.active_slot.isnot(None),
+        StockReconciliationRunDB.started_at <= datetime.utcnow() - timedelta(hours=RECONCILE_STALE_HOURS)
+    ).update({"status": "failed", "active_slot": None, "finished_at": datetime.utcnow()}, synchronize_session=False)
     db.commit()
 
-    # Registrar movimiento financiero
-    financial_movement = FinancialMovementDB(
-        order_id=order.id,
-        amount=order.total,
-        description="Orden confirmada"
+    last_run = None
+    if incremental:
+        last_run = (
+            db.query(StockReconciliationRunDB)
+            .filter(StockReconciliationRunDB.status == "completed")
+            .order_by(StockReconciliationRunDB.id.desc())
+            .first()
+        )
+    from_id = last_run.to_movement_id if last_run else 0
+    to_id = db.query(func.coalesce(func.max(StockMovementDB.id), 0)).scalar()
+    run = StockReconciliationRunDB(
+        incremental=last_run is not None, fix=fix, from_movement_id=from_id, to_movement_id=to_id, active_slot=1
     )
-    db.add(financial_movement)
-
-    # Registrar movimientos de stock para cada ítem de la orden
-    for item in order.items:
-        stock_movement = StockMovementDB(
-            product_id=item.product_id,
-            change=-item.quantity,
-            description="Stock disminuido por orden confirmada"
+    db.add(run)
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        running = db.query(StockReconciliationRunDB.id).filter(StockReconciliationRunDB.active_slot.isnot(None)).first()
+        raise HTTPException(
+            status_code=409,
+            detail=f"Ya hay una conciliación en curso (#{running.id})" if running else "Ya hay una conciliación en curso"
         )
-        db.add(stock_movement)
-    db.commit()
-    return {"message": "Pedido confirmado"}
 
-# -----------------------------
-# Endpoints de Movimientos Económicos
-# -----------------------------
-@app.get("/financial_movements/", response_model=List[FinancialMovement])
-async def list_financial_movements(db: Session = Depends(get_db), 
-                                   current_user: UserDB = Depends(verify_role(["admin", "almacenista"]))):
-    """Listar movimientos financieros."""
-    movements = db.query(FinancialMovementDB).all()
-    return movements
+    report = []
+    try:
+        last_product_id = 0
+        while True:
+            first_product_id = last_product_id
+            # Mismo orden de locks que create_order (productos por id); confirm solo bloquea órdenes
+            products = db.execute(
+                select(ProductDB.id, ProductDB.name, ProductDB.stock)
+                .where(ProductDB.id > last_product_id)
+                .order_by(ProductDB.id)
+                .limit(RECONCILE_CHUNK_SIZE)
+                .with_for_update()
+            ).all()
+            if not products:
+                db.commit()
+                break
+            last_product_id = products[-1].id
+            ids = [p.id for p in products]
+
+            # Unidades descontadas por órdenes sin pagar del bloque (pocas filas), con las órdenes bloqueadas
+            reserved = {}
+            for product_id, quantity in db.execute(
+                select(OrderItemDB.product_id, OrderItemDB.quantity)
+                .join(OrderDB, OrderItemDB.order_id == OrderDB.id)
+                .where(OrderItemDB.product_id.in_(ids), func.coalesce(OrderDB.payment_status, "") != "paid")
+                .with_for_update()
+            ):
+                reserved[product_id] = reserved.get(product_id, 0) + (quantity or 0)
+
+            # Con los bloqueos tomados, el libro de estos productos ya no cambia hasta el commit del bloque
+            chunk_to_id = db.query(func.coalesce(func.max(StockMovementDB.id), 0)).scalar()
+            deltas = {
+                product_id: int(total or 0)
+                for product_id, total in db.query(StockMovementDB.product_id, func.sum(StockMovementDB.change))
+                .filter(StockMovementDB.id > from_id, StockMovementDB.id <= chunk_to_id,
+                        StockMovementDB.product_id > first_product_id, StockMovementDB.product_id <= last_product_id)
+                .group_by(StockMovementDB.product_id)
+            }
 
-@app.get("/stock_movements/", response_model=List[StockMovement])
-async def list_stock_movements(db: Session = Depends(get_db), 
-                               current_user: UserDB = Depends(verify_role(["admin", "almacenista"]))):
-    """Listar movimientos de stock."""
-    movements = db.query(StockMovementDB).all()
-    return movements
+            balances = {}
+            if run.incremental:
+                ahead = {}  # last_movement_id -> productos cuyo saldo ya incluye movimientos posteriores a from_id
+                for product_id, balance, last_movement_id in (
+                    db.query(StockLedgerBalanceDB.product_id, StockLedgerBalanceDB.balance,
+                             StockLedgerBalanceDB.last_movement_id)
+                    .filter(StockLedgerBalanceDB.product_id.in_(ids))
+                ):
+                    balances[product_id] = balance
+                    if last_movement_id is not None and last_movement_id > from_id:
+                        ahead.setdefault(last_movement_id, []).append(product_id)
+                # Se descuenta lo que una corrida fallida ya sumó a esos saldos (pocos productos)
+                for last_movement_id, product_ids in ahead.items():
+                    for product_id, applied in (
+                        db.query(StockMovementDB.product_id, func.sum(StockMovementDB.change))
+                        .filter(StockMovementDB.product_id.in_(product_ids),
+                                StockMovementDB.id > from_id, StockMovementDB.id <= last_movement_id)
+                        .group_by(StockMovementDB.product_id)
+                    ):
+                        deltas[product_id] = deltas.get(product_id, 0) - int(applied or 0)
+            else:
+                db.query(StockLedgerBalanceDB).filter(
+                    StockLedgerBalanceDB.product_id.in_(ids)
+                ).delete(synchronize_session=False)
+
+            now = datetime.utcnow()
+            new_balances, changed_balances, corrections = [], [], []
+            for product in products:
+                previous = balances.get(product.id)
+                balance = (previous or 0) + deltas.get(product.id, 0)
+                row = {"product_id": product.id, "balance": balance, "last_movement_id": chunk_to_id, "updated_at": now}
+                if previous is None:
+                    new_balances.append(row)
+                elif balance != previous:
+                    changed_balances.append(row)
+
+                expected = balance - reserved.get(product.id, 0)
+                difference = (product.stock or 0) - expected
+                if difference:
+                    run.discrepancies += 1
+                    if len(report) < RECONCILE_REPORT_LIMIT:
+                        report.append({
+                            "product_id": product.id,
+                            "name": product.name,
+                            "stock": product.stock,
+                            "ledger_balance": balance,
+                            "reserved_unpaid": reserved.get(product.id, 0),
+                            "difference": difference
+                        })
+                    if fix:
+                        # El ajuste queda en el libro con id > chunk_to_id: la próxima corrida incremental lo suma
+                        corrections.append({
+                            "product_id": product.id, "timestamp": now, "change": difference,
+                            "description": STOCK_ADJUSTMENT_DESCRIPTION
+                        })
+            if new_balances:
+                db.execute(insert(StockLedgerBalanceDB), new_balances)
+            if changed_balances:
+                db.execute(update(StockLedgerBalanceDB), changed_balances)
+            if corrections:
+                db.execute(insert(StockMovementDB), corrections)
+                run.corrected += len(corrections)
+            run.products_checked += len(products)
+            db.commit()
+
+        run.status = "completed"
+    except Exception:
+        db.rollback()
+        run.status = "failed"
+        raise
+    finally:
+        run.finished_at = datetime.utcnow()
+        run.active_slot = None
+        db.commit()
+
+    return {
+        "run_id": run.id,
+        "incremental": run.incremental,
+        "from_movement_id": run.from_movement_id,
+        "to_movement_id": run.to_movement_id,
+        "products_checked": run.products_checked,
+        "discrepancies": run.discrepancies,
+        "corrected": run.corrected,
+        "items": report,
+        "truncated": run.discrepancies > len(report)
+    }
+
+def backfill_opening_stock(db: Session, batch_size: int = 500) -> int:
+    """
+    Asienta el movimiento de apertura de los productos creados antes de registrarlo (sin STOCK_OPENING_DESCRIPTION):
+    apertura = stock + reservado por órdenes sin pagar - suma de sus movimientos, que es lo que cuadra la
+    conciliación hoy. Por lotes bloqueados como en reconcile_stock_ledger; volver a correrlo no duplica aperturas.
+    """
+    created = 0
+    last_id = 0
+    while True:
+        products = db.execute(
+            select(ProductDB.id, ProductDB.stock)
+            .where(ProductDB.id > last_id)
+            .order_by(ProductDB.id)
+            .limit(batch_size)
+            .with_for_update()
+        ).all()
+        if not products:
+            db.commit()
+            break
+        last_id = products[-1].id
+        opened = {
+            product_id for (product_id,) in db.query(StockMovementDB.product_id).filter(
+                StockMovementDB.product_id.in_([p.id for p in products]),
+                StockMovementDB.description == STOCK_OPENING_DESCRIPTION
+            ).distinct()
+        }
+        pending = [p for p in products if p.id not in opened]
+        if pending:
+            ids = [p.id for p in pending]
+            reserved = {}
+            for product_id, quantity in db.execute(
+                select(OrderItemDB.product_id, OrderItemDB.quantity)
+                .join(OrderDB, OrderItemDB.order_id == OrderDB.id)
+                .where(OrderItemDB.product_id.in_(ids), func.coalesce(OrderDB.payment_status, "") != "paid")
+                .with_for_update()
+            ):
+                reserved[product_id] = reserved.get(product_id, 0) + (quantity or 0)
+            ledger = dict(
+                db.query(StockMovementDB.product_id, func.sum(StockMovementDB.change))
+                .filter(StockMovementDB.product_id.in_(ids))
+                .group_by(StockMovementDB.product_id)
+            )
+            record_stock_movements(db, [
+                (p.id, (p.stock or 0) + reserved.get(p.id, 0) - int(ledger.get(p.id) or 0)) for p in pending
+            ], STOCK_OPENING_DESCRIPTION, keep_zero=True)
+            created += len(pending)
+        db.commit()
+    return created
+
+@app.post("/admin/jobs/backfill-opening-stock", dependencies=[Depends(verify_role(["admin"]))])
+def run_backfill_opening_stock(db: Session = Depends(get_db)):
+    """Movimiento de stock inicial para productos creados antes de asentarlo en el libro."""
+    return {"created": backfill_opening_stock(db)}
+
+@app.post("/admin/jobs/reconcile-stock", dependencies=[Depends(verify_role(["admin"]))])
+def run_reconcile_stock(
+    incremental: bool = Query(True, description="Solo movimientos posteriores a la última corrida completa"),
+    fix: bool = Query(False, description="Registrar movimientos de ajuste para cada diferencia"),
+    db: Session = Depends(get_db)
+):
+    """Conciliación de products.stock contra stock_movements."""
+    return reconcile_stock_ledger(db, incremental=incremental, fix=fix)
 
 @app.get("/upload-url")
 def generate_upload_url(
@@ -1160,41 +3126,408 @@ def generate_upload_url(
         print(f"\n🚨 ERROR EN /upload-url 🚨\n{e}\n")
         raise HTTPException(status_code=500, detail=f"Error al generar URL: {str(e)}")
 
-@app.get("/imagen/{filename}")
-def get_image_url(filename: str, token: str = Depends(oauth2_scheme)):
-    try:
+IMAGE_URL_EXPIRES = int(os.getenv("IMAGE_URL_EXPIRES", "300"))
+# Una URL se reutiliza hasta que le queden IMAGE_URL_MIN_REMAINING segundos de validez
+IMAGE_URL_MIN_REMAINING = int(os.getenv("IMAGE_URL_MIN_REMAINING", "120"))
+IMAGE_BATCH_MAX_KEYS = int(os.getenv("IMAGE_BATCH_MAX_KEYS", "200"))
+# Cubre las páginas de /admin/s3-images y las imágenes del catálogo que se piden juntas, no el bucket entero
+image_url_cache = TTLCache(
+    maxsize=int(os.getenv("IMAGE_URL_CACHE_SIZE", "20000")),
+    ttl=IMAGE_URL_EXPIRES - IMAGE_URL_MIN_REMAINING
+)
+
+def presigned_image_url(key: str) -> str:
+    url = image_url_cache.get(key)
+    if url is None:
         url = s3.generate_presigned_url(
             ClientMethod="get_object",
             Params={
                 "Bucket": BUCKET_NAME,
-                "Key": filename,
+                "Key": key,
             },
-            ExpiresIn=300
+            ExpiresIn=IMAGE_URL_EXPIRES
         )
-        return {"image_url": url}
+        image_url_cache.set(key, url)
+    return url
+
+def image_url_headers() -> dict:
+    # El navegador puede reutilizar la respuesta mientras la URL siga siendo válida con margen
+    return {"Cache-Control": f"private, max-age={max(IMAGE_URL_MIN_REMAINING // 2, 0)}"}
+
+@app.get("/imagen/{filename}")
+def get_image_url(filename: str, token: str = Depends(oauth2_scheme)):
+    try:
+        return JSONResponse({"image_url": presigned_image_url(filename)}, headers=image_url_headers())
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al generar URL de imagen: {str(e)}")
 
+@app.post("/imagenes/batch")
+async def get_image_urls(data: ImageBatchRequest, current_user: Principal = Depends(get_current_user)):
+    """
+    URLs firmadas de varias imágenes en una sola respuesta: {"images": {key: url}}.
+    Con variant, URLs de la variante (generándola si aún no existe); null si la imagen original no existe.
+    """
+    keys = list(dict.fromkeys(data.keys))
+    if len(keys) > IMAGE_BATCH_MAX_KEYS:
+        raise HTTPException(status_code=400, detail=f"Máximo {IMAGE_BATCH_MAX_KEYS} imágenes por solicitud")
+    if data.variant is not None and data.variant not in IMAGE_VARIANTS:
+        raise HTTPException(status_code=400, detail=f"Variante inválida; opciones: {list(IMAGE_VARIANTS)}")
+    try:
+        if data.variant is None:
+            images = {key: presigned_image_url(key) for key in keys}
+        else:
+            urls = await asyncio.gather(
+                *[image_derivatives.url(key, data.variant) for key in keys], return_exceptions=True
+            )
+            images = {}
+            for key, url in zip(keys, urls):
+                if isinstance(url, HTTPException) and url.status_code == 404:
+                    url = None
+                elif isinstance(url, Exception):
+                    raise url
+                images[key] = url
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al generar URL de imagen: {str(e)}")
+    return JSONResponse({"images": images}, headers=image_url_headers())
+
+S3_INVENTORY_TTL = float(os.getenv("S3_INVENTORY_TTL", "300"))
+S3_SIGNING_WORKERS = int(os.getenv("S3_SIGNING_WORKERS", "8"))
+signing_executor = ThreadPoolExecutor(max_workers=S3_SIGNING_WORKERS, thread_name_prefix="s3-sign")
+
+class S3ImageInventory:
+    """
+    Inventario en memoria del bucket (key, tamaño, ETag, fecha), con las keys ordenadas para paginar
+    y filtrar por prefijo con bisect. El listado completo recorre el bucket con ContinuationToken; cuando
+    vence el TTL se rehace en segundo plano mientras se sigue sirviendo el anterior. Las imágenes que el
+    frontend sube con URL firmada se agregan al momento (confirm) cuando se asocian a un producto. La app
+    no borra objetos del bucket: lo que se borre por fuera desaparece del inventario en el siguiente refresco.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self.keys = []
+        self.objects = {}
+        self.loaded_at = None
+        self._refresh_started = None
+        self._recent_writes = []  # (key, objeto) recibidas durante un refresco en curso
+        self.refreshes = 0
+
+    @staticmethod
+    def _describe(obj: dict) -> dict:
+        return {
+            "size": obj.get("Size"),
+            "etag": (obj.get("ETag") or "").strip('"'),
+            "last_modified": obj["LastModified"].isoformat() if obj.get("LastModified") else None,
+        }
+
+    def refresh(self, wait: bool = True):
+        if not self._refresh_lock.acquire(blocking=wait):
+            return  # ya hay otro refresco en curso
+        try:
+            started = time.monotonic()
+            with self._lock:
+                self._refresh_started = started
+            objects = {}
+            paginator = s3.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=BUCKET_NAME, PaginationConfig={"PageSize": 1000}):
+                for obj in page.get("Contents", []):
+                    if not is_image_derivative(obj["Key"]):
+                        objects[obj["Key"]] = self._describe(obj)
+            with self._lock:
+                # Escrituras hechas mientras se listaba el bucket: pueden no estar en el listado
+                for key, described in self._recent_writes:
+                    objects[key] = described
+                self._recent_writes = []
+                self._refresh_started = None
+                self.objects = objects
+                self.keys = sorted(objects)
+                self.loaded_at = started
+                self.refreshes += 1
+        finally:
+            self._refresh_lock.release()
+
+    def ensure_fresh(self):
+        if self.loaded_at is None:
+            self.refresh()
+        elif time.monotonic() - self.loaded_at > self.ttl and not self._refresh_lock.locked():
+            threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh(wait=False)
+        except Exception:
+            logging.exception("Error refrescando el inventario de S3")
+
+    def upsert(self, key: str, size: Optional[int] = None, etag: str = "", last_modified: Optional[datetime] = None):
+        described = self._describe({"Size": size, "ETag": etag, "LastModified": last_modified})
+        with self._lock:
+            if key not in self.objects:
+                bisect.insort(self.keys, key)
+            self.objects[key] = described
+            if self._refresh_started is not None:
+                self._recent_writes.append((key, described))
+
+    def confirm(self, key: str):
+        """Agrega (o actualiza) una key recién subida leyendo su HEAD; si no existe en el bucket no hace nada."""
+        try:
+            head = s3.head_object(Bucket=BUCKET_NAME, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return
+            raise
+        self.upsert(key, head.get("ContentLength"), head.get("ETag", ""), head.get("LastModified"))
+
+    def page(self, prefix: str = "", after: Optional[str] = None, limit: Optional[int] = None):
+        """Keys que empiezan con prefix, posteriores a after; devuelve (objetos, hay_más)."""
+        with self._lock:
+            keys = self.keys
+            start = bisect.bisect_right(keys, after) if after else 0
+            start = max(start, bisect.bisect_left(keys, prefix))
+            result = []
+            for key in itertools.islice(keys, start, None):
+                if not key.startswith(prefix):
+                    return result, False
+                if limit is not None and len(result) == limit:
+                    return result, True
+                result.append({"key": key, **self.objects[key]})
+            return result, False
+
+    def stats(self) -> dict:
+        return {
+            "objects": len(self.keys),
+            "refreshes": self.refreshes,
+            "age_seconds": round(time.monotonic() - self.loaded_at, 1) if self.loaded_at else None,
+        }
+
+s3_inventory = S3ImageInventory(S3_INVENTORY_TTL)
+
+def _confirm_uploaded_image(key: str):
+    try:
+        s3_inventory.confirm(key)
+    except Exception:
+        logging.exception("No se pudo registrar %s en el inventario de S3", key)
+
+def image_uploaded(key: Optional[str]):
+    """Un producto pasó a usar esta imagen: se registra en el inventario en segundo plano (un HEAD a S3)."""
+    if key and not is_image_derivative(key):
+        signing_executor.submit(_confirm_uploaded_image, key)
+
+@app.on_event("shutdown")
+def shutdown_signing_executor():
+    signing_executor.shutdown(wait=False, cancel_futures=True)
+
+S3_IMAGES_PAGE_SIZE = 100
+
 @app.get(
     "/admin/s3-images",
     dependencies=[Depends(verify_role(["admin", "almacenista"]))]
 )
-def list_s3_images_with_urls():
+def list_s3_images_with_urls(
+    limit: int = Query(S3_IMAGES_PAGE_SIZE, ge=1, le=1000),
+    cursor: Optional[str] = Query(None, description="next_cursor de la página anterior (última key devuelta)"),
+    prefix: str = Query("", max_length=1024),
+    refresh: bool = Query(False, description="Volver a listar el bucket antes de responder")
+):
+    """
+    Imágenes del bucket con URL firmada, en orden de key, por páginas: {"images": [...], "next_cursor": str | null}.
+    Solo se firman las keys de la página; prefix filtra (búsqueda por carpeta o inicio del nombre).
+    """
     try:
-        resp = s3.list_objects_v2(Bucket=BUCKET_NAME)
-        images = []
-        for obj in resp.get("Contents", []):
-            key = obj["Key"]
-            url = s3.generate_presigned_url(
-                ClientMethod="get_object",
-                Params={"Bucket": BUCKET_NAME, "Key": key},
-                ExpiresIn=300
-            )
-            images.append({"key": key, "url": url})
-        return {"images": images}
+        if refresh:
+            s3_inventory.refresh()
+        else:
+            s3_inventory.ensure_fresh()
     except ClientError as e:
         raise HTTPException(status_code=500, detail=f"Error listando imágenes: {e}")
 
+    objects, has_more = s3_inventory.page(prefix, cursor, limit)
+    # La firma es local (sin red); repartida en el pool y con cache para las páginas que se repiten
+    urls = signing_executor.map(presigned_image_url, [obj["key"] for obj in objects])
+    images = [{**obj, "url": url} for obj, url in zip(objects, urls)]
+    return {"images": images, "next_cursor": images[-1]["key"] if has_more else None}
+
+# -----------------------------
+# Variantes de imágenes (miniatura y mediana en WebP)
+# -----------------------------
+# nombre -> lado mayor en píxeles
+IMAGE_VARIANTS = {
+    "thumb": int(os.getenv("IMAGE_THUMB_SIZE", "200")),
+    "medium": int(os.getenv("IMAGE_MEDIUM_SIZE", "800")),
+}
+IMAGE_WEBP_QUALITY = int(os.getenv("IMAGE_WEBP_QUALITY", "80"))
+IMAGE_MAX_SOURCE_BYTES = int(os.getenv("IMAGE_MAX_SOURCE_BYTES", str(25 * 1024 * 1024)))
+IMAGE_RENDER_WORKERS = int(os.getenv("IMAGE_RENDER_WORKERS", "2"))
+IMAGE_STORAGE = os.getenv("IMAGE_STORAGE", "s3")  # "s3" o "local"
+IMAGE_LOCAL_ROOT = os.getenv("IMAGE_LOCAL_ROOT", "./imagenes")
+IMAGE_DERIVATIVE_RE = re.compile(r"\.(%s)\.webp$" % "|".join(IMAGE_VARIANTS))
+
+# Pillow libera el GIL solo en parte: el renderizado va a procesos aparte ("spawn", ver image_rendering.py)
+image_executor = image_rendering.create_executor(IMAGE_RENDER_WORKERS)
+
+@app.on_event("shutdown")
+def shutdown_image_executor():
+    image_executor.shutdown(wait=False, cancel_futures=True)
+
+def derivative_key(key: str, variant: str) -> str:
+    """La variante se guarda junto al original: productos/foto.jpg -> productos/foto.thumb.webp"""
+    return f"{os.path.splitext(key)[0]}.{variant}.webp"
+
+def is_image_derivative(key: str) -> bool:
+    return IMAGE_DERIVATIVE_RE.search(key) is not None
+
+def image_variants(filename: Optional[str]) -> Optional[dict]:
+    """Rutas de la API para cada variante; estables, así el snapshot del catálogo sigue siendo cacheable."""
+    if not filename:
+        return None
+    quoted = urllib.parse.quote(filename)
+    return {variant: f"/imagen/{quoted}/{variant}" for variant in IMAGE_VARIANTS}
+
+class S3ImageStorage:
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            obj = s3.get_object(Bucket=BUCKET_NAME, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None
+            raise
+        if obj.get("ContentLength", 0) > IMAGE_MAX_SOURCE_BYTES:
+            raise HTTPException(status_code=413, detail="Imagen original demasiado grande")
+        return obj["Body"].read()
+
+    def exists(self, key: str) -> bool:
+        try:
+            s3.head_object(Bucket=BUCKET_NAME, Key=key)
+            return True
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return False
+            raise
+
+    def put(self, key: str, data: bytes, content_type: str):
+        s3.put_object(
+            Bucket=BUCKET_NAME, Key=key, Body=data, ContentType=content_type,
+            CacheControl="public, max-age=31536000, immutable"
+        )
+
+    def url(self, key: str) -> str:
+        return presigned_image_url(key)
+
+class LocalImageStorage:
+    """Imágenes en disco (desarrollo sin S3); se sirven desde /imagenes/local/{key}."""
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+
+    def _path(self, key: str) -> str:
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise HTTPException(status_code=400, detail="Nombre de archivo inválido")
+        return path
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return None
+        if os.path.getsize(path) > IMAGE_MAX_SOURCE_BYTES:
+            raise HTTPException(status_code=413, detail="Imagen original demasiado grande")
+        with open(path, "rb") as f:
+            return f.read()
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self._path(key))
+
+    def put(self, key: str, data: bytes, content_type: str):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Escritura atómica: nadie lee un archivo a medio escribir
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def url(self, key: str) -> str:
+        return f"/imagenes/local/{urllib.parse.quote(key)}"
+
+class ImageDerivatives:
+    """
+    Genera variantes bajo demanda. Las peticiones concurrentes por la misma variante esperan la misma
+    tarea (un solo render por proceso); las que ya existen se recuerdan en una cache para no consultar
+    el almacenamiento en cada petición.
+    """
+
+    def __init__(self, storage, ttl: float = 3600):
+        self.storage = storage
+        self.known = TTLCache(maxsize=50000, ttl=ttl)
+        self._inflight = {}
+        self.renders = 0
+
+    async def ensure(self, key: str, variant: str) -> str:
+        if variant not in IMAGE_VARIANTS:
+            raise HTTPException(status_code=404, detail="Variante no encontrada")
+        if is_image_derivative(key):
+            raise HTTPException(status_code=400, detail="La imagen ya es una variante")
+        target = derivative_key(key, variant)
+        if self.known.get(target):
+            return target
+        task = self._inflight.get(target)
+        if task is None:
+            task = asyncio.ensure_future(self._generate(key, variant, target))
+            self._inflight[target] = task
+            task.add_done_callback(lambda _: self._inflight.pop(target, None))
+        # shield: si un cliente se desconecta, el render sigue para los demás que esperan
+        await asyncio.shield(task)
+        return target
+
+    async def _generate(self, key: str, variant: str, target: str):
+        if not await run_in_threadpool(self.storage.exists, target):
+            data = await run_in_threadpool(self.storage.get, key)
+            if data is None:
+                raise HTTPException(status_code=404, detail="Imagen no encontrada")
+            loop = asyncio.get_running_loop()
+            try:
+                rendered = await loop.run_in_executor(
+                    image_executor, image_rendering.render_image_variant, data, IMAGE_VARIANTS[variant], IMAGE_WEBP_QUALITY
+                )
+            except (OSError, Image.DecompressionBombError):
+                raise HTTPException(status_code=422, detail="El archivo no es una imagen válida")
+            await run_in_threadpool(self.storage.put, target, rendered, "image/webp")
+            self.renders += 1
+        self.known.set(target, True)
+
+    async def url(self, key: str, variant: str) -> str:
+        return await run_in_threadpool(self.storage.url, await self.ensure(key, variant))
+
+    def stats(self) -> dict:
+        return {**self.known.stats(), "renders": self.renders, "inflight": len(self._inflight)}
+
+image_storage = LocalImageStorage(IMAGE_LOCAL_ROOT) if IMAGE_STORAGE == "local" else S3ImageStorage()
+image_derivatives = ImageDerivatives(image_storage)
+
+@app.get("/imagen/{filename:path}/{variant}")
+async def get_image_variant_url(filename: str, variant: str, current_user: Principal = Depends(get_current_user)):
+    """Igual que /imagen/{filename}, pero para la variante "thumb" o "medium" (se genera la primera vez)."""
+    try:
+        url = await image_derivatives.url(filename, variant)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al generar variante de imagen: {str(e)}")
+    return JSONResponse({"image_url": url}, headers=image_url_headers())
+
+@app.get("/imagenes/local/{key:path}")
+def get_local_image(key: str):
+    if not isinstance(image_storage, LocalImageStorage):
+        raise HTTPException(status_code=404, detail="Imagen no encontrada")
+    path = image_storage._path(key)
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Imagen no encontrada")
+    media_type = "image/webp" if path.endswith(".webp") else None
+    return FileResponse(path, media_type=media_type, headers={"Cache-Control": "public, max-age=86400"})
+
 # SELENIUM ENDPOINTS
 
 @app.get(
@@ -1294,10 +3627,18 @@ def compare_price_scraping(product_id: int, db: Session = Depends(get_db)):
 
 @app.post("/create-payment-intent")
 def create_payment_intent(data: CreatePayment, db: Session = Depends(get_db),
-                          current_user: UserDB = Depends(verify_role(["cliente", "admin"]))):
+                          current_user: Principal = Depends(verify_role(["cliente", "admin"])),
+                          idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=100)):
+    return run_idempotent(
+        current_user.id, "POST /create-payment-intent", idempotency_key, data,
+        lambda complete: start_payment_intent(data, db, current_user, idempotency_key, complete)
+    )
+
+def start_payment_intent(data: CreatePayment, db: Session, current_user: Principal,
+                         idempotency_key: Optional[str] = None, complete=None) -> dict:
     # 1) Carga la orden
     order = db.query(OrderDB).filter(OrderDB.id == data.order_id).first()
-    if not order or (current_user.role.name == "cliente" and order.client_id != current_user.id):
+    if not order or (current_user.role == "cliente" and order.client_id != current_user.id):
         raise HTTPException(404, "Orden no encontrada")
     if order.payment_status == "paid":
         raise HTTPException(400, "Orden ya pagada")
@@ -1307,14 +3648,103 @@ def create_payment_intent(data: CreatePayment, db: Session = Depends(get_db),
         amount=int(order.total * 100),  # Stripe trabaja en centavos
         currency="cop",
         metadata={"order_id": order.id},
+        # Stripe también deduplica por su lado si el cliente reintenta
+        idempotency_key=f"payment-intent-{order.id}-{idempotency_key}" if idempotency_key else None,
     )
 
-    # 3) Guarda el ID en tu base
+    # 3) Guarda el ID en tu base (y la respuesta de la Idempotency-Key en la misma transacción)
     order.stripe_payment_intent_id = intent.id
+    response = {"clientSecret": intent.client_secret}
+    if complete is not None:
+        complete(db, response)
     db.commit()
 
     # 4) Devuelve al frontend el client_secret
-    return {"clientSecret": intent.client_secret}
+    return response
+
+# -------------------------------------------------------------------
+# Agregados diarios de ventas
+# -------------------------------------------------------------------
+ADMIN_SUMMARY_CACHE_TTL = float(os.getenv("ADMIN_SUMMARY_CACHE_TTL", "10"))
+admin_summary_cache = TTLCache(maxsize=1, ttl=ADMIN_SUMMARY_CACHE_TTL)
+
+def bump_daily_rollup(db: Session, day: date, orders_count: int = 0,
+                      paid_orders_count: int = 0, paid_revenue: float = 0.0):
+    """Suma deltas al agregado del día dentro de la transacción del llamador (UPDATE atómico o INSERT)."""
+    deltas = {
+        DailySalesRollupDB.orders_count: DailySalesRollupDB.orders_count + orders_count,
+        DailySalesRollupDB.paid_orders_count: DailySalesRollupDB.paid_orders_count + paid_orders_count,
+        DailySalesRollupDB.paid_revenue: DailySalesRollupDB.paid_revenue + paid_revenue,
+        DailySalesRollupDB.updated_at: datetime.utcnow(),
+    }
+    query = db.query(DailySalesRollupDB).filter(DailySalesRollupDB.day == day)
+    if query.update(deltas, synchronize_session=False):
+        return
+    try:
+        with db.begin_nested():
+            db.add(DailySalesRollupDB(
+                day=day, orders_count=orders_count, paid_orders_count=paid_orders_count,
+                paid_revenue=paid_revenue, updated_at=datetime.utcnow()
+            ))
+    except IntegrityError:
+        # Otra transacción creó el día entre medio
+        query.update(deltas, synchronize_session=False)
+
+def as_date(value) -> date:
+    # func.date() devuelve texto en SQLite y date en PostgreSQL/MySQL
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+def rebuild_daily_rollups(db: Session, day_from: Optional[date] = None, day_to: Optional[date] = None) -> int:
+    """Recalcula los agregados diarios desde orders (reparación). Devuelve la cantidad de días escritos."""
+    day_col = func.date(OrderDB.created_at)
+    query = db.query(
+        day_col.label("day"),
+        func.count(OrderDB.id),
+        func.sum(case((OrderDB.payment_status == "paid", 1), else_=0)),
+        func.sum(case((OrderDB.payment_status == "paid", OrderDB.total), else_=0.0)),
+    )
+    delete_query = db.query(DailySalesRollupDB)
+    if day_from is not None:
+        query = query.filter(OrderDB.created_at >= datetime.combine(day_from, datetime.min.time()))
+        delete_query = delete_query.filter(DailySalesRollupDB.day >= day_from)
+    if day_to is not None:
+        query = query.filter(OrderDB.created_at < datetime.combine(day_to + timedelta(days=1), datetime.min.time()))
+        delete_query = delete_query.filter(DailySalesRollupDB.day <= day_to)
+    rows = query.group_by(day_col).all()
+    try:
+        delete_query.delete(synchronize_session=False)
+        now = datetime.utcnow()
+        if rows:
+            db.execute(insert(DailySalesRollupDB), [
+                {"day": as_date(day), "orders_count": count, "paid_orders_count": int(paid_count or 0),
+                 "paid_revenue": float(revenue or 0.0), "updated_at": now}
+                for day, count, paid_count, revenue in rows
+            ])
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    admin_summary_cache.clear()
+    return len(rows)
+
+@app.on_event("startup")
+def seed_daily_rollups():
+    """Primera ejecución sobre una base con historial: se construyen los agregados una vez."""
+    db = SessionLocal()
+    try:
+        if db.query(DailySalesRollupDB.day).first() is None and db.query(OrderDB.id).first() is not None:
+            logging.info("Construyendo daily_sales_rollup desde orders: %d días", rebuild_daily_rollups(db))
+    finally:
+        db.close()
+
+@app.post("/admin/jobs/rebuild-sales-rollup", dependencies=[Depends(verify_role(["admin"]))])
+def run_rebuild_sales_rollup(
+    day_from: Optional[date] = Query(None, alias="from"),
+    day_to: Optional[date] = Query(None, alias="to"),
+    db: Session = Depends(get_db)
+):
+    """Reconstruye daily_sales_rollup desde orders (todo el historial o el rango indicado)."""
+    return {"days": rebuild_daily_rollups(db, day_from, day_to)}
 
 # -------------------------------------------------------------------
 # Endpoint de resumen administrativo
@@ -1324,21 +3754,14 @@ def create_payment_intent(data: CreatePayment, db: Session = Depends(get_db),
     response_model=AdminSummary,
     dependencies=[Depends(verify_role(["admin", "almacenista"]))]
 )
-async def admin_summary(db: Session = Depends(get_db)):
-    start_of_day = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-
-    # Pedidos nuevos hoy
-    new_orders = db.query(func.count(OrderDB.id)) \
-                   .filter(OrderDB.created_at >= start_of_day) \
-                   .scalar() or 0
-
-    # Ingresos hoy (pagados hoy)
-    revenue = db.query(func.coalesce(func.sum(OrderDB.total), 0.0)) \
-                .filter(
-                    OrderDB.created_at >= start_of_day,
-                    OrderDB.payment_status == "paid"
-                ) \
-                .scalar() or 0.0
+def admin_summary(db: Session = Depends(get_db)):
+    cached = admin_summary_cache.get("summary")
+    if cached is not None:
+        return cached
+
+    today = datetime.utcnow().date()
+    # Pedidos nuevos e ingresos de hoy (pagados, creados hoy)
+    today_rollup = db.query(DailySalesRollupDB).filter(DailySalesRollupDB.day == today).first()
 
     # Total usuarios
     total_users = db.query(func.count(UserDB.id)).scalar() or 0
@@ -1346,21 +3769,409 @@ async def admin_summary(db: Session = Depends(get_db)):
     # Total productos
     total_products = db.query(func.count(ProductDB.id)).scalar() or 0
 
-    # Ventas históricas (solo pedidos pagados)
-    historical_revenue = db.query(func.coalesce(func.sum(OrderDB.total), 0.0)) \
-                           .filter(OrderDB.payment_status == "paid") \
-                           .scalar() or 0.0
+    # Ventas históricas (solo pedidos pagados): una fila por día, no por pedido
+    historical_revenue = db.query(func.coalesce(func.sum(DailySalesRollupDB.paid_revenue), 0.0)).scalar() or 0.0
 
-    return AdminSummary(
-        new_orders=new_orders,
-        revenue=revenue,
+    summary = AdminSummary(
+        new_orders=today_rollup.orders_count if today_rollup else 0,
+        revenue=today_rollup.paid_revenue if today_rollup else 0.0,
         total_users=total_users,
         total_products=total_products,
         historical_revenue=historical_revenue
     )
+    admin_summary_cache.set("summary", summary)
+    return summary
+
+# -------------------------------------------------------------------
+# Analítica de ventas (agregación columnar con NumPy)
+# -------------------------------------------------------------------
+ANALYTICS_CACHE_TTL = float(os.getenv("ANALYTICS_CACHE_TTL", "300"))
+ANALYTICS_FETCH_BATCH = int(os.getenv("ANALYTICS_FETCH_BATCH", "50000"))
+analytics_cache = TTLCache(maxsize=128, ttl=ANALYTICS_CACHE_TTL)
+
+def fetch_columns(db: Session, stmt, columns: list) -> dict:
+    """
+    Ejecuta stmt en lotes y devuelve un arreglo NumPy por columna; columns = [(nombre, dtype), ...].
+    Cada lote se copia directo a arreglos preasignados (que crecen al doble), sin acumular
+    en Python las filas de todo el resultado.
+    """
+    arrays = [np.empty(ANALYTICS_FETCH_BATCH, dtype=dtype) for _, dtype in columns]
+    size = 0
+    result = db.execute(stmt.execution_options(yield_per=ANALYTICS_FETCH_BATCH))
+    for partition in result.partitions():
+        count = len(partition)
+        if size + count > len(arrays[0]):
+            capacity = max(2 * len(arrays[0]), size + count)
+            grown = [np.empty(capacity, dtype=array.dtype) for array in arrays]
+            for new, old in zip(grown, arrays):
+                new[:size] = old[:size]
+            arrays = grown
+        for i, ((_, dtype), array) in enumerate(zip(columns, arrays)):
+            if dtype == "datetime64[D]":
+                # datetime -> día; no hay fromiter para objetos datetime
+                array[size:size + count] = np.array([row[i] for row in partition], dtype="datetime64[us]")
+            else:
+                array[size:size + count] = np.fromiter((row[i] for row in partition), dtype=dtype, count=count)
+        size += count
+    return {name: array[:size] for (name, _), array in zip(columns, arrays)}
+
+def fetch_sales_columns(db: Session, start: datetime, end: datetime, paid_only: bool) -> dict:
+    """Una sola consulta orders × order_items × products, acumulada por columnas en arreglos NumPy."""
+    stmt = (
+        select(
+            OrderItemDB.order_id,
+            OrderItemDB.product_id,
+            func.coalesce(ProductDB.category_id, -1),
+            OrderItemDB.quantity,
+            # Líneas anteriores al precio congelado: se valoran al precio actual
+            func.coalesce(OrderItemDB.final_price, OrderItemDB.quantity * ProductDB.price, 0.0),
+            OrderDB.created_at,
+        )
+        .join(OrderDB, OrderItemDB.order_id == OrderDB.id)
+        .outerjoin(ProductDB, OrderItemDB.product_id == ProductDB.id)
+        .where(OrderDB.created_at >= start, OrderDB.created_at < end)
+    )
+    if paid_only:
+        stmt = stmt.where(OrderDB.payment_status == "paid")
+
+    return fetch_columns(db, stmt, [
+        ("order_id", np.int64), ("product_id", np.int64), ("category_id", np.int64),
+        ("quantity", np.int64), ("revenue", np.float64), ("day", "datetime64[D]"),
+    ])
+
+def group_codes(values: np.ndarray):
+    """
+    Equivalente a np.unique(values, return_inverse=True) para claves enteras. Si el rango de ids es
+    compacto (lo normal con ids autoincrementales) se resuelve en O(n) con bincount en vez de ordenar.
+    """
+    if values.size == 0:
+        return values[:0], np.zeros(0, dtype=np.int64)
+    low, high = int(values.min()), int(values.max())
+    if high - low > 4 * values.size + 1_000_000:
+        return np.unique(values, return_inverse=True)
+    offsets = values - low
+    present = np.flatnonzero(np.bincount(offsets, minlength=high - low + 1))
+    lookup = np.empty(high - low + 1, dtype=np.int64)
+    lookup[present] = np.arange(present.size)
+    return present + low, lookup[offsets]
+
+def aggregate_sales(columns: dict, top: int) -> dict:
+    """Agrupa con np.bincount sobre claves enteras (ids y días como enteros); sin bucles por fila en Python."""
+    revenue = columns["revenue"]
+    quantity = columns["quantity"]
+    order_count = int(group_codes(columns["order_id"])[0].size)
+
+    day_numbers, day_idx = group_codes(columns["day"].astype(np.int64))
+    days = day_numbers.astype("datetime64[D]")
+    categories, cat_idx = group_codes(columns["category_id"])
+    products, prod_idx = group_codes(columns["product_id"])
+
+    cells = len(days) * len(categories)
+    cell_key = day_idx * len(categories) + cat_idx
+    cell_revenue = np.bincount(cell_key, weights=revenue, minlength=cells).reshape(len(days), len(categories))
+    cell_units = np.bincount(cell_key, weights=quantity, minlength=cells).reshape(len(days), len(categories))
+
+    product_revenue = np.bincount(prod_idx, weights=revenue, minlength=len(products))
+    product_units = np.bincount(prod_idx, weights=quantity, minlength=len(products))
+    top = min(top, len(products))
+    if top:
+        best = np.argpartition(-product_revenue, top - 1)[:top]
+        best = best[np.lexsort((products[best], -product_revenue[best]))]
+    else:
+        best = np.array([], dtype=np.int64)
+
+    day_rows, cat_cols = np.nonzero(cell_units)
+    return {
+        "orders": order_count,
+        "lines": int(revenue.size),
+        "units": int(quantity.sum()),
+        "revenue": float(revenue.sum()),
+        "avg_basket": {
+            "revenue": float(revenue.sum() / order_count) if order_count else 0.0,
+            "units": float(quantity.sum() / order_count) if order_count else 0.0,
+            "lines": float(revenue.size / order_count) if order_count else 0.0,
+        },
+        "revenue_by_day": [
+            {"day": str(d), "revenue": float(r), "units": int(u)}
+            for d, r, u in zip(days, cell_revenue.sum(axis=1), cell_units.sum(axis=1))
+        ],
+        "revenue_by_category": [
+            {"category_id": int(c), "revenue": float(r), "units": int(u)}
+            for c, r, u in zip(categories, cell_revenue.sum(axis=0), cell_units.sum(axis=0))
+        ],
+        "revenue_by_day_category": [
+            {"day": str(days[d]), "category_id": int(categories[c]),
+             "revenue": float(cell_revenue[d, c]), "units": int(cell_units[d, c])}
+            for d, c in zip(day_rows, cat_cols)
+        ],
+        "top_products": [
+            {"product_id": int(products[i]), "revenue": float(product_revenue[i]), "units": int(product_units[i])}
+            for i in best
+        ],
+    }
+
+@app.get("/admin/analytics/sales", dependencies=[Depends(verify_role(["admin", "almacenista"]))])
+def sales_analytics(
+    day_from: Optional[date] = Query(None, alias="from", description="Por defecto, los últimos 7 días"),
+    day_to: Optional[date] = Query(None, alias="to", description="Inclusive; por defecto hoy"),
+    top: int = Query(10, ge=0, le=100),
+    paid_only: bool = Query(True),
+    db: Session = Depends(get_db)
+):
+    """Ingresos por día y categoría, productos más vendidos y canasta promedio en un rango de fechas."""
+    today = datetime.utcnow().date()
+    day_to = day_to or today
+    day_from = day_from or day_to - timedelta(days=6)
+    if day_from > day_to:
+        raise HTTPException(status_code=400, detail="'from' debe ser anterior o igual a 'to'")
+
+    cache_key = (day_from, day_to, top, paid_only)
+    cached = analytics_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    start = datetime.combine(day_from, datetime.min.time())
+    end = datetime.combine(day_to + timedelta(days=1), datetime.min.time())
+    result = aggregate_sales(fetch_sales_columns(db, start, end, paid_only), top)
+
+    # Nombres solo para lo que se devuelve
+    category_names = dict(db.query(CategoryDB.id, CategoryDB.name).all())
+    for row in result["revenue_by_category"] + result["revenue_by_day_category"]:
+        row["category"] = category_names.get(row["category_id"])
+    top_ids = [p["product_id"] for p in result["top_products"]]
+    product_names = dict(db.query(ProductDB.id, ProductDB.name).filter(ProductDB.id.in_(top_ids)).all()) if top_ids else {}
+    for row in result["top_products"]:
+        row["name"] = product_names.get(row["product_id"])
+
+    result = {"from": day_from.isoformat(), "to": day_to.isoformat(), "paid_only": paid_only, **result}
+    # Los rangos ya cerrados no cambian (salvo confirmaciones tardías): se guardan más tiempo
+    analytics_cache.set(cache_key, result, ttl=None if day_to >= today else ANALYTICS_CACHE_TTL * 12)
+    return result
+
+# -------------------------------------------------------------------
+# Pronóstico de demanda y sugerencias de reposición
+# -------------------------------------------------------------------
+FORECAST_HALF_LIFE_DAYS = float(os.getenv("FORECAST_HALF_LIFE_DAYS", "14"))
+FORECAST_WINDOW_DAYS = int(os.getenv("FORECAST_WINDOW_DAYS", "365"))
+FORECAST_LEAD_TIME_DAYS = float(os.getenv("FORECAST_LEAD_TIME_DAYS", "7"))
+FORECAST_TARGET_COVER_DAYS = float(os.getenv("FORECAST_TARGET_COVER_DAYS", "30"))
+# Cobertura máxima con fecha de quiebre: más allá la fecha no aporta (y desborda date con demanda ~0)
+FORECAST_MAX_COVER_DAYS = 3650
+FORECAST_REFRESH_SECONDS = float(os.getenv("FORECAST_REFRESH_SECONDS", "60"))
+FORECAST_REBUILD_SECONDS = float(os.getenv("FORECAST_REBUILD_SECONDS", "21600"))
+# Filas por debajo del high-water mark que se releen en cada refresco (ids asignados antes pero confirmados después)
+FORECAST_LOOKBACK_ROWS = int(os.getenv("FORECAST_LOOKBACK_ROWS", "5000"))
+
+class DemandForecaster:
+    """
+    Tasa de demanda diaria por producto con media móvil exponencial (EWMA), en arreglos indexados por id.
+
+    Se guarda S = Σ cantidad · d^(epoch - día) con d = 0.5^(1/vida media); la EWMA a la fecha T es
+    S · d^(T - epoch) normalizada por los pesos del período observado. Cada refresco suma las líneas de
+    pedido y movimientos con id mayor al último leído, y relee las últimas FORECAST_LOOKBACK_ROWS por debajo
+    de ese high-water mark: una transacción que tomó su id antes pero hizo commit después entra en el
+    siguiente refresco (los ids ya sumados de esa ventana se recuerdan para no contarlos dos veces). La
+    reconstrucción completa periódica descarta lo que ya no corresponde (pedidos cancelados, historia
+    fuera de la ventana).
+
+    Consumo = líneas de pedidos (en la fecha del pedido) + salidas de stock que no vienen de pedidos
+    (los movimientos de confirmación duplicarían las líneas).
+    """
+
+    def __init__(self, half_life_days: float, window_days: int):
+        self.decay = 0.5 ** (1.0 / half_life_days)
+        self.window_days = window_days
+        self._lock = threading.Lock()
+        self.weighted = np.zeros(0)
+        self.first_day = np.zeros(0, dtype=np.int64)
+        self.epoch = 0
+        self.item_hwm = 0
+        self.movement_hwm = 0
+        self.seen_items = np.zeros(0, dtype=np.int64)      # ids ya sumados dentro de la ventana de relectura
+        self.seen_movements = np.zeros(0, dtype=np.int64)
+        self.built_at = None
+        self.refreshed_at = 0.0
+        self.rebuilds = 0
+        self.refreshes = 0
+
+    @staticmethod
+    def today() -> int:
+        return int(np.datetime64(datetime.utcnow().date(), "D").astype(np.int64))
+
+    def _grow(self, size: int):
+        if size > self.weighted.size:
+            self.weighted = np.pad(self.weighted, (0, size - self.weighted.size))
+            self.first_day = np.pad(self.first_day, (0, size - self.first_day.size),
+                                    constant_values=np.iinfo(np.int64).max)
+
+    def _accumulate(self, product_ids: np.ndarray, quantities: np.ndarray, days: np.ndarray):
+        if product_ids.size == 0:
+            return
+        self._grow(int(product_ids.max()) + 1)
+        weights = quantities * np.power(self.decay, (self.epoch - days).astype(np.float64))
+        self.weighted += np.bincount(product_ids, weights=weights, minlength=self.weighted.size)
+        np.minimum.at(self.first_day, product_ids, days)
+
+    def _read(self, db: Session, stmt, seen: np.ndarray, hwm: int) -> np.ndarray:
+        """Suma las filas aún no vistas; devuelve los ids vistos que siguen dentro de la ventana de relectura."""
+        cols = fetch_columns(db, stmt, [("id", np.int64), ("product_id", np.int64), ("quantity", np.float64),
+                                        ("day", "datetime64[D]")])
+        fresh = ~np.isin(cols["id"], seen)
+        self._accumulate(cols["product_id"][fresh], cols["quantity"][fresh], cols["day"][fresh].astype(np.int64))
+        ids = np.concatenate([seen, cols["id"][fresh]])
+        return ids[ids > hwm - FORECAST_LOOKBACK_ROWS]
+
+    def _load(self, db: Session, since: Optional[datetime]):
+        item_max = db.query(func.coalesce(func.max(OrderItemDB.id), 0)).scalar()
+        movement_max = db.query(func.coalesce(func.max(StockMovementDB.id), 0)).scalar()
+
+        items_stmt = (
+            select(OrderItemDB.id, OrderItemDB.product_id, OrderItemDB.quantity, OrderDB.created_at)
+            .join(OrderDB, OrderItemDB.order_id == OrderDB.id)
+            .where(OrderItemDB.id > self.item_hwm - FORECAST_LOOKBACK_ROWS, OrderItemDB.id <= item_max,
+                   OrderItemDB.product_id.isnot(None), OrderItemDB.quantity > 0)
+        )
+        movements_stmt = (
+            select(StockMovementDB.id, StockMovementDB.product_id, -StockMovementDB.change, StockMovementDB.timestamp)
+            .where(StockMovementDB.id > self.movement_hwm - FORECAST_LOOKBACK_ROWS, StockMovementDB.id <= movement_max,
+                   StockMovementDB.product_id.isnot(None), StockMovementDB.change < 0,
+                   # Las confirmaciones ya cuentan como order_items; ajustes y ediciones de stock no son demanda
+                   func.coalesce(StockMovementDB.description, "").notin_(
+                       [ORDER_CONFIRMED_STOCK_DESCRIPTION, STOCK_ADJUSTMENT_DESCRIPTION, STOCK_EDIT_DESCRIPTION]))
+        )
+        if since is not None:
+            items_stmt = items_stmt.where(OrderDB.created_at >= since)
+            movements_stmt = movements_stmt.where(StockMovementDB.timestamp >= since)
+
+        self.seen_items = self._read(db, items_stmt, self.seen_items, item_max)
+        self.seen_movements = self._read(db, movements_stmt, self.seen_movements, movement_max)
+        self.item_hwm, self.movement_hwm = item_max, movement_max
+
+    def refresh(self, db: Session):
+        with self._lock:
+            now = time.monotonic()
+            if self.built_at is None or now - self.built_at > FORECAST_REBUILD_SECONDS:
+                self.weighted = np.zeros(0)
+                self.first_day = np.zeros(0, dtype=np.int64)
+                self.epoch = self.today()
+                self.item_hwm = self.movement_hwm = 0
+                self.seen_items = np.zeros(0, dtype=np.int64)
+                self.seen_movements = np.zeros(0, dtype=np.int64)
+                since = datetime.combine(datetime.utcnow().date() - timedelta(days=self.window_days), datetime.min.time())
+                self._load(db, since)
+                self.built_at = self.refreshed_at = now
+                self.rebuilds += 1
+            elif now - self.refreshed_at > FORECAST_REFRESH_SECONDS:
+                self._load(db, None)
+                self.refreshed_at = now
+                self.refreshes += 1
+
+    def rates(self, size: int) -> np.ndarray:
+        """Demanda diaria estimada para los ids 0..size-1."""
+        with self._lock:
+            weighted = np.zeros(size)
+            first_day = np.full(size, np.iinfo(np.int64).max, dtype=np.int64)
+            n = min(size, self.weighted.size)
+            weighted[:n] = self.weighted[:n]
+            first_day[:n] = self.first_day[:n]
+            epoch = self.epoch
+        today = self.today()
+        current = weighted * self.decay ** (today - epoch)
+        # Normalización por los días observados de cada producto (sin castigar a los productos nuevos)
+        observed = np.clip(today - np.minimum(first_day, today) + 1, 1, self.window_days)
+        norm = (1 - self.decay ** observed) / (1 - self.decay)
+        return current / norm
+
+    def invalidate(self):
+        with self._lock:
+            self.built_at = None
+
+    def stats(self) -> dict:
+        return {
+            "products": int(self.weighted.size),
+            "item_hwm": self.item_hwm,
+            "movement_hwm": self.movement_hwm,
+            "rebuilds": self.rebuilds,
+            "refreshes": self.refreshes,
+        }
+
+demand_forecaster = DemandForecaster(FORECAST_HALF_LIFE_DAYS, FORECAST_WINDOW_DAYS)
+forecast_cache = TTLCache(maxsize=32, ttl=FORECAST_REFRESH_SECONDS)
+
+def reorder_suggestions(db: Session, max_days_of_cover: float, limit: int) -> dict:
+    demand_forecaster.refresh(db)
+    catalog = fetch_columns(db, select(ProductDB.id, func.coalesce(ProductDB.stock, 0)).order_by(ProductDB.id),
+                            [("id", np.int64), ("stock", np.int64)])
+    ids, stock = catalog["id"], catalog["stock"]
+    rates = demand_forecaster.rates(int(ids.max()) + 1 if ids.size else 0)[ids]
+
+    # Días de cobertura de toda la tienda en una pasada; sin demanda la cobertura es infinita
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cover = np.where(rates > 0, np.maximum(stock, 0) / rates, np.inf)
+    reorder = np.ceil(np.maximum(rates * (FORECAST_LEAD_TIME_DAYS + FORECAST_TARGET_COVER_DAYS) - stock, 0))
+
+    urgent = np.flatnonzero(cover <= max_days_of_cover)
+    urgent = urgent[np.lexsort((-rates[urgent], cover[urgent]))][:limit]
+    names = dict(db.query(ProductDB.id, ProductDB.name).filter(ProductDB.id.in_(ids[urgent].tolist())).all()) if urgent.size else {}
+    today = datetime.utcnow().date()
+    return {
+        "generated_at": datetime.utcnow().isoformat(),
+        "lead_time_days": FORECAST_LEAD_TIME_DAYS,
+        "target_cover_days": FORECAST_TARGET_COVER_DAYS,
+        "products_at_risk": int(np.count_nonzero(cover <= max_days_of_cover)),
+        "items": [
+            {
+                "product_id": int(ids[i]),
+                "name": names.get(int(ids[i])),
+                "stock": int(stock[i]),
+                "daily_demand": round(float(rates[i]), 3),
+                "days_of_cover": round(float(cover[i]), 1),
+                "stockout_date": (
+                    (today + timedelta(days=int(cover[i]))).isoformat() if cover[i] <= FORECAST_MAX_COVER_DAYS else None
+                ),
+                "reorder_quantity": int(reorder[i]),
+            }
+            for i in urgent
+        ],
+    }
+
+@app.get("/admin/inventory/forecast", dependencies=[Depends(verify_role(["admin", "almacenista"]))])
+def inventory_forecast(
+    max_days_of_cover: Optional[float] = Query(None, ge=0, le=FORECAST_MAX_COVER_DAYS,
+                                               description="Por defecto, tiempo de reposición + cobertura objetivo"),
+    limit: int = Query(100, ge=1, le=5000),
+    db: Session = Depends(get_db)
+):
+    """Productos que se agotarán pronto según la demanda reciente, ordenados por urgencia, con cantidad sugerida."""
+    if max_days_of_cover is None:
+        max_days_of_cover = FORECAST_LEAD_TIME_DAYS + FORECAST_TARGET_COVER_DAYS
+    cache_key = (max_days_of_cover, limit)
+    cached = forecast_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    result = reorder_suggestions(db, max_days_of_cover, limit)
+    forecast_cache.set(cache_key, result)
+    return result
+
+@app.get("/admin/cache-stats", dependencies=[Depends(verify_role(["admin"]))])
+def cache_stats():
+    """Contadores de aciertos/fallos de las caches en memoria de este proceso."""
+    return {
+        "principals": principal_cache.stats(),
+        "lambda_validations": lambda_client.stats(),
+        "catalog": catalog_snapshot.stats(),
+        "promotions": promotion_engine.stats(),
+        "idempotency": idempotency_cache.stats(),
+        "admin_summary": admin_summary_cache.stats(),
+        "sales_analytics": analytics_cache.stats(),
+        "inventory_forecast": {**forecast_cache.stats(), **demand_forecaster.stats()},
+        "image_urls": image_url_cache.stats(),
+        "s3_inventory": s3_inventory.stats(),
+        "image_variants": image_derivatives.stats(),
+    }
 
 @app.post("/addresses/", response_model=Address)
-async def create_address(addr: AddressCreate, db: Session = Depends(get_db), current_user: UserDB = Depends(get_current_user)):
+async def create_address(addr: AddressCreate, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_user)):
     address = AddressDB(user_id=current_user.id, **addr.dict())
     db.add(address)
     db.commit()
@@ -1368,11 +4179,11 @@ async def create_address(addr: AddressCreate, db: Session = Depends(get_db), cur
     return address
 
 @app.get("/addresses/", response_model=List[Address])
-async def list_addresses(db: Session = Depends(get_db), current_user: UserDB = Depends(get_current_user)):
+async def list_addresses(db: Session = Depends(get_db), current_user: Principal = Depends(get_current_user)):
     return db.query(AddressDB).filter(AddressDB.user_id == current_user.id).all()
 
 @app.delete("/addresses/{address_id}")
-async def delete_address(address_id: int, db: Session = Depends(get_db), current_user: UserDB = Depends(get_current_user)):
+async def delete_address(address_id: int, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_user)):
     address = db.query(AddressDB).filter(AddressDB.id == address_id, AddressDB.user_id == current_user.id).first()
     if not address:
         raise HTTPException(status_code=404, detail="Dirección no encontrada")
@@ -1381,11 +4192,11 @@ async def delete_address(address_id: int, db: Session = Depends(get_db), current
     return {"message": "Dirección eliminada"}
 
 @app.get("/orders/{order_id}/tracking", response_model=dict)
-async def order_tracking(order_id: int, db: Session = Depends(get_db), current_user: UserDB = Depends(get_current_user)):
+async def order_tracking(order_id: int, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_user)):
     order = db.query(OrderDB).filter(OrderDB.id == order_id).first()
     if not order:
         raise HTTPException(404, "Pedido no encontrado")
-    if current_user.role.name == "cliente" and order.client_id != current_user.id:
+    if current_user.role == "cliente" and order.client_id != current_user.id:
         raise HTTPException(403, "No puedes acceder a este pedido")
     if order.payment_status != "paid":
         raise HTTPException(403, "El pedido aún no ha sido pagado")
@@ -1455,45 +4266,24 @@ async def create_promotion(promo: PromotionCreate, db: Session = Depends(get_db)
     new_promo = PromotionDB(**promo.dict(), active=True)
     db.add(new_promo)
     db.commit()
+    promotion_engine.invalidate()
     db.refresh(new_promo)
     return new_promo
 
 @app.get("/promotions/", response_model=List[Promotion])
 async def list_promotions(db: Session = Depends(get_db)):
-    now = datetime.utcnow()
-    promos = db.query(PromotionDB).filter(
-        PromotionDB.active == True,
-        PromotionDB.start_date <= now,
-        PromotionDB.end_date >= now
-    ).all()
-    return promos
+    return [rule._asdict() for rule in promotion_engine.active(db)]
 
 @app.get("/products/{product_id}/promotions", response_model=List[Promotion])
 async def product_promotions(product_id: int, db: Session = Depends(get_db)):
-    now = datetime.utcnow()
-    product = db.query(ProductDB).filter(ProductDB.id == product_id).first()
+    product = db.query(ProductDB.id, ProductDB.category_id).filter(ProductDB.id == product_id).first()
     if not product:
         raise HTTPException(404, "Producto no encontrado")
-
-    promos = db.query(PromotionDB).filter(
-        PromotionDB.active == True,
-        PromotionDB.start_date <= now,
-        PromotionDB.end_date >= now,
-        ((PromotionDB.product_id == product_id) |
-         (PromotionDB.category_id == product.category_id))
-    ).all()
-    return promos
+    return [rule._asdict() for rule in promotion_engine.active(db, product_id, product.category_id)]
 
 @app.get("/categories/{category_id}/promotions", response_model=List[Promotion])
 async def category_promotions(category_id: int, db: Session = Depends(get_db)):
-    now = datetime.utcnow()
-    promos = db.query(PromotionDB).filter(
-        PromotionDB.active == True,
-        PromotionDB.start_date <= now,
-        PromotionDB.end_date >= now,
-        (PromotionDB.category_id == category_id)
-    ).all()
-    return promos
+    return [rule._asdict() for rule in promotion_engine.active(db, category_id=category_id)]
 
 @app.put("/promotions/{promotion_id}", response_model=Promotion, dependencies=[Depends(verify_role(["admin", "almacenista"]))])
 async def update_promotion(promotion_id: int, promo: PromotionCreate, db: Session = Depends(get_db)):
@@ -1503,6 +4293,7 @@ async def update_promotion(promotion_id: int, promo: PromotionCreate, db: Sessio
     for field, value in promo.dict().items():
         setattr(promotion, field, value)
     db.commit()
+    promotion_engine.invalidate()
     db.refresh(promotion)
     return promotion
 
@@ -1513,6 +4304,7 @@ async def delete_promotion(promotion_id: int, db: Session = Depends(get_db)):
         raise HTTPException(404, "Promoción no encontrada")
     promotion.active = False
     db.commit()
+    promotion_engine.invalidate()
     return {"message": "Promoción desactivada exitosamente"}
 
 def get_user_rank(level):
@@ -1527,29 +4319,32 @@ def get_user_rank(level):
             return r
     return RANKS[0]
 
-def add_points_and_check_level(db, user_id, amount_spent):
+def add_points_and_check_level(db, user_id, amount_spent, commit=True):
     gam = db.query(UserGamificationDB).filter_by(user_id=user_id).first()
     if not gam:
         gam = UserGamificationDB(user_id=user_id, points=0, level=1)
         db.add(gam)
-        db.commit()
-        db.refresh(gam)
+        db.flush()
     points_earned = int(amount_spent // 1000)
     gam.points += points_earned
     levels_up = gam.points // 100
     if levels_up > 0:
         gam.level += levels_up
         gam.points = gam.points % 100
-    db.commit()
+    if commit:
+        db.commit()
+    else:
+        db.flush()
     return gam.level, gam.points
 
 @app.get("/users/me/gamification")
-async def get_my_gamification(current_user: UserDB = Depends(get_current_user), db: Session = Depends(get_db)):
+async def get_my_gamification(current_user: Principal = Depends(get_current_user), db: Session = Depends(get_db)):
     gam = db.query(UserGamificationDB).filter_by(user_id=current_user.id).first()
     if not gam:
         gam = UserGamificationDB(user_id=current_user.id, points=0, level=1)
         db.add(gam)
         db.commit()
+    gamification_cache.set(current_user.id, (gam.level, gam.points))
     rank = get_user_rank(gam.level)
     return {
         "level": gam.level,
@@ -1587,7 +4382,7 @@ def get_active_missions(db: Session = Depends(get_db)):
     ]
 
 @app.get("/users/me/missions")
-def get_my_missions(current_user: UserDB = Depends(get_current_user), db: Session = Depends(get_db)):
+def get_my_missions(current_user: Principal = Depends(get_current_user), db: Session = Depends(get_db)):
     now = datetime.utcnow()
     # Misiones de la semana
     missions = db.query(MissionDB).filter(MissionDB.active == True, MissionDB.week_start <= now, MissionDB.week_end >= now).all()
@@ -1603,15 +4398,12 @@ def get_my_missions(current_user: UserDB = Depends(get_current_user), db: Sessio
         })
     return result
 
-def check_and_complete_missions(db, user_id, order):
-    now = datetime.utcnow()
-    initialize_weekly_missions(db)
-
-    missions = db.query(MissionDB).filter(
-        MissionDB.active == True,
-        MissionDB.week_start <= now,
-        MissionDB.week_end   >= now
-    ).all()
+def check_and_complete_missions(db, user_id, order, missions=None, commit=True, at=None):
+    # at: instante en que ocurrió la compra (el outbox puede procesarla más tarde, incluso en otra semana)
+    now = at or datetime.utcnow()
+    if missions is None:
+        initialize_weekly_missions(db)
+        missions = active_missions(db, now)
 
     for mission in missions:
         user_m = db.query(UserMissionDB).filter_by(user_id=user_id, mission_id=mission.id).first()
@@ -1643,17 +4435,8 @@ def check_and_complete_missions(db, user_id, order):
 
         # PROMO_HUNTER
         elif mission.code == "promo_hunter":
-            if any(
-                db.query(PromotionDB)
-                  .filter(
-                      PromotionDB.active==True,
-                      PromotionDB.start_date<=now,
-                      PromotionDB.end_date>=now,
-                      ((PromotionDB.product_id==item.product_id)|
-                       (PromotionDB.category_id==item.product.category_id))
-                  ).first()
-                for item in order.items
-            ):
+            # Promoción congelada en la línea al comprar: no depende de cuándo se procese el evento
+            if any(item.promotion_id is not None for item in order.items):
                 completed = True
 
         # ALL_TYPES
@@ -1706,9 +4489,19 @@ def check_and_complete_missions(db, user_id, order):
 
             gam = db.query(UserGamificationDB).filter_by(user_id=user_id).first()
             gam.points += mission.points_reward
-            db.commit()
+            if commit:
+                db.commit()
+            else:
+                db.flush()
         # limpiar flag
         if "completed" in locals(): del completed
+
+def active_missions(db, now):
+    return db.query(MissionDB).filter(
+        MissionDB.active == True,
+        MissionDB.week_start <= now,
+        MissionDB.week_end   >= now
+    ).all()
         
 WEEKLY_MISSION_COUNT = 3
 def initialize_weekly_missions(db: Session):
@@ -1735,3 +4528,197 @@ def initialize_weekly_missions(db: Session):
         ))
     db.commit()
 
+# -----------------------------
+# Outbox: efectos secundarios de las órdenes en segundo plano
+# -----------------------------
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "2"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_LOCK_SECONDS = int(os.getenv("OUTBOX_LOCK_SECONDS", "300"))
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "1"))
+# Último nivel/puntos conocidos por usuario: user_id -> (level, points)
+gamification_cache = TTLCache(maxsize=10000, ttl=int(os.getenv("GAMIFICATION_CACHE_TTL", "600")))
+
+def mark_outbox_event_applied(db: Session, event_id: int) -> bool:
+    """
+    Inserta la marca del evento en la transacción que aplica sus efectos. False (y rollback) si otro
+    worker ya la confirmó; si la suya sigue abierta, el INSERT espera a que termine.
+    """
+    db.add(OutboxAppliedEventDB(event_id=event_id))
+    try:
+        db.flush()
+    except IntegrityError:
+        db.rollback()
+        return False
+    return True
+
+def handle_order_created(db: Session, events: list):
+    """Suma puntos y evalúa misiones de un lote de órdenes, un commit por evento."""
+    payloads = {e.id: json.loads(e.payload) for e in events}
+    orders = {
+        o.id: o for o in db.query(OrderDB)
+        .options(selectinload(OrderDB.items).joinedload(OrderItemDB.product))
+        .filter(OrderDB.id.in_({p["order_id"] for p in payloads.values()}))
+    }
+    initialize_weekly_missions(db)
+    missions_by_week = {}  # lunes -> misiones de esa semana; los eventos se evalúan en la semana en que ocurrieron
+    for event in events:
+        payload = payloads[event.id]
+        try:
+            if not mark_outbox_event_applied(db, event.id):
+                # Ya aplicado por el worker que lo reclamó antes: solo se cierra el evento
+                db.query(OutboxEventDB).filter(OutboxEventDB.id == event.id).update(
+                    {"status": "done", "last_error": None}, synchronize_session=False
+                )
+                db.commit()
+                continue
+            order = orders.get(payload["order_id"])
+            if order is not None:
+                week = event.created_at.date() - timedelta(days=event.created_at.weekday())
+                if week not in missions_by_week:
+                    missions_by_week[week] = active_missions(db, event.created_at)
+                add_points_and_check_level(db, payload["user_id"], payload["total"], commit=False)
+                check_and_complete_missions(db, payload["user_id"], order, missions=missions_by_week[week],
+                                            commit=False, at=event.created_at)
+                gam = db.query(UserGamificationDB).filter_by(user_id=payload["user_id"]).first()
+                level, points = gam.level, gam.points
+            event.status = "done"
+            event.last_error = None
+            db.commit()
+            if order is not None:
+                gamification_cache.set(payload["user_id"], (level, points))
+        except Exception as exc:
+            db.rollback()
+            schedule_outbox_retry(db, event.id, exc)
+
+OUTBOX_HANDLERS = {
+    "order_created": handle_order_created,
+}
+
+def schedule_outbox_retry(db: Session, event_id: int, exc: Exception):
+    event = db.get(OutboxEventDB, event_id)
+    event.attempts += 1
+    event.last_error = repr(exc)[:2000]
+    if event.attempts >= OUTBOX_MAX_ATTEMPTS:
+        event.status = "failed"
+        logging.error("Evento de outbox %s descartado tras %d intentos: %r", event_id, event.attempts, exc)
+    else:
+        # Backoff exponencial: 2s, 4s, 8s... hasta 10 minutos
+        event.status = "pending"
+        event.available_at = datetime.utcnow() + timedelta(seconds=min(2 ** event.attempts, 600))
+    db.commit()
+
+def claim_outbox_events(db: Session) -> list:
+    """
+    Reclama un lote de eventos pendientes (o abandonados por un worker caído).
+    El UPDATE condicional con un token propio evita que dos workers procesen el mismo evento.
+    """
+    now = datetime.utcnow()
+    candidates = db.query(OutboxEventDB.id).filter(
+        ((OutboxEventDB.status == "pending") & (OutboxEventDB.available_at <= now)) |
+        ((OutboxEventDB.status == "processing") & (OutboxEventDB.locked_at < now - timedelta(seconds=OUTBOX_LOCK_SECONDS)))
+    ).order_by(OutboxEventDB.id).limit(OUTBOX_BATCH_SIZE).all()
+    if not candidates:
+        return []
+    token = str(uuid.uuid4())
+    # Se repite la condición completa: entre el SELECT y el UPDATE otro worker pudo reprogramar el evento
+    db.query(OutboxEventDB).filter(
+        OutboxEventDB.id.in_([c.id for c in candidates]),
+        ((OutboxEventDB.status == "pending") & (OutboxEventDB.available_at <= now)) |
+        ((OutboxEventDB.status == "processing") & (OutboxEventDB.locked_at < now - timedelta(seconds=OUTBOX_LOCK_SECONDS)))
+    ).update({"status": "processing", "claimed_by": token, "locked_at": now}, synchronize_session=False)
+    db.commit()
+    return db.query(OutboxEventDB).filter(OutboxEventDB.claimed_by == token).order_by(OutboxEventDB.id).all()
+
+def process_outbox_batch() -> int:
+    db = SessionLocal()
+    try:
+        events = claim_outbox_events(db)
+        by_type = {}
+        for event in events:
+            by_type.setdefault(event.event_type, []).append(event)
+        for event_type, group in by_type.items():
+            handler = OUTBOX_HANDLERS.get(event_type)
+            if handler is None:
+                for event in group:
+                    schedule_outbox_retry(db, event.id, ValueError(f"Tipo de evento desconocido: {event_type}"))
+                continue
+            try:
+                handler(db, group)
+            except Exception as exc:
+                # Falló la preparación del lote: todo el grupo se reintenta más tarde
+                db.rollback()
+                for event in group:
+                    if db.get(OutboxEventDB, event.id).status == "processing":
+                        schedule_outbox_retry(db, event.id, exc)
+        return len(events)
+    finally:
+        db.close()
+
+class OutboxWorker:
+    """
+    Pool de tareas asyncio que drenan la tabla outbox; notify() las despierta sin esperar al polling.
+    notify() puede llamarse desde el threadpool: el Event se activa en el loop con call_soon_threadsafe.
+    """
+
+    def __init__(self, workers: int, poll_seconds: float):
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self.tasks = []
+        self.loop = None
+        self.wakeup = None
+        self.processed = 0
+
+    def notify(self):
+        if self.wakeup is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    async def run(self):
+        while True:
+            try:
+                count = await run_in_threadpool(process_outbox_batch)
+            except Exception:
+                logging.exception("Error procesando el outbox")
+                count = 0
+            self.processed += count
+            if count >= OUTBOX_BATCH_SIZE:
+                continue  # quedan eventos: seguir drenando
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.tasks = [asyncio.create_task(self.run()) for _ in range(self.workers)]
+
+    async def stop(self):
+        self.wakeup = None
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def stats(self) -> dict:
+        db = SessionLocal()
+        try:
+            counts = dict(db.query(OutboxEventDB.status, func.count(OutboxEventDB.id)).group_by(OutboxEventDB.status).all())
+        finally:
+            db.close()
+        return {"workers": len(self.tasks), "processed": self.processed, "events": counts}
+
+outbox_worker = OutboxWorker(OUTBOX_WORKERS, OUTBOX_POLL_SECONDS)
+
+@app.on_event("startup")
+async def start_outbox_worker():
+    outbox_worker.start()
+
+@app.on_event("shutdown")
+async def stop_outbox_worker():
+    await outbox_worker.stop()
+
+@app.get("/admin/outbox", dependencies=[Depends(verify_role(["admin"]))])
+def outbox_status():
+    return outbox_worker.stats()
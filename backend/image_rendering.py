@@ -0,0 +1,27 @@
+"""
+Renderizado de variantes de imágenes (miniatura y mediana en WebP) con Pillow.
+
+Vive fuera de farmacia.py para que el pool de procesos use el contexto "spawn": los workers solo
+importan este módulo y Pillow (sin conexiones a la BD, clientes de S3 ni hilos heredados).
+"""
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+
+def render_image_variant(data: bytes, max_side: int, quality: int) -> bytes:
+    """Se ejecuta en el pool de procesos: redimensiona (sin agrandar) y codifica a WebP."""
+    with Image.open(io.BytesIO(data)) as source:
+        image = ImageOps.exif_transpose(source)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info or image.mode in ("LA", "PA") else "RGB")
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, format="WEBP", quality=quality, method=4)
+        return output.getvalue()
+
+
+def create_executor(workers: int) -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
@@ -0,0 +1,68 @@
+"""
+Servidor local que imita las Lambdas de validación para desarrollo sin conexión.
+
+Uso:
+    python lambda_stub.py 9000
+    LAMBDA_URL_PRODUCTO=http://localhost:9000/prod/validate-product \
+    LAMBDA_URL_USERNAME=http://localhost:9000/prod/validate-username \
+    uvicorn farmacia:app
+"""
+import json
+import re
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+USERNAME_RE = re.compile(r"^[A-Za-z0-9_.-]{3,50}$")
+
+
+def validate_product(data):
+    errores = []
+    if not isinstance(data.get("precio"), int) or data["precio"] <= 0:
+        errores.append("El precio debe ser un entero mayor que 0")
+    if not isinstance(data.get("stock"), int) or data["stock"] < 0:
+        errores.append("El stock debe ser un entero mayor o igual a 0")
+    if errores:
+        # Mismo formato que la integración proxy de API Gateway
+        return 400, {"body": json.dumps({"errores": errores})}
+    return 200, {"body": json.dumps({"mensaje": "Producto válido"})}
+
+
+def validate_username(data):
+    username = str(data.get("username", "")).strip()
+    if not USERNAME_RE.match(username):
+        return 400, {"error": "Username inválido: 3-50 caracteres alfanuméricos, '.', '_' o '-'"}
+    return 200, {"data": {"username": username}}
+
+
+ROUTES = {
+    "/prod/validate-product": validate_product,
+    "/prod/validate-username": validate_username,
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, igual que API Gateway
+
+    def do_POST(self):
+        handler = ROUTES.get(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            data = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            data = {}
+        if handler is None:
+            status, body = 404, {"error": "Ruta no encontrada"}
+        else:
+            status, body = handler(data)
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 9000
+    print(f"Lambda stub escuchando en http://localhost:{port}")
+    ThreadingHTTPServer(("0.0.0.0", port), StubHandler).serve_forever()
@@ -0,0 +1,67 @@
+"""
+Hashing + cifrado de contraseñas (bcrypt y luego Fernet).
+
+Vive fuera de farmacia.py para que el pool de procesos use el contexto "spawn": los workers solo
+importan este módulo (sin conexiones a la BD ni hilos heredados) y reciben las claves Fernet por el
+initializer del pool.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from passlib.context import CryptContext
+
+# Contexto bcrypt para hashing
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+primary_cipher = None
+cipher_suite = None
+
+
+def configure(fernet_keys: List[str]):
+    """La primera clave cifra, todas descifran (rotación con MultiFernet)."""
+    global primary_cipher, cipher_suite
+    primary_cipher = Fernet(fernet_keys[0])
+    cipher_suite = MultiFernet([Fernet(k) for k in fernet_keys])
+
+
+def get_password_hash(password: str) -> str:
+    # 1) genera hash bcrypt
+    bcrypt_hash = pwd_context.hash(password)
+    # 2) cifra el hash con Fernet
+    token = cipher_suite.encrypt(bcrypt_hash.encode())
+    # 3) devuelve el token en base64 (str)
+    return token.decode()
+
+
+def verify_password(plain_password: str, token_hash: str) -> bool:
+    try:
+        # 1) descifra el token a bytes -> bcrypt_hash
+        decrypted = cipher_suite.decrypt(token_hash.encode())
+    except Exception:
+        return False
+    # 2) compara con bcrypt
+    return pwd_context.verify(plain_password, decrypted.decode())
+
+
+def password_needs_rekey(token_hash: str) -> bool:
+    """True si el hash fue cifrado con una clave Fernet que ya no es la primaria."""
+    try:
+        primary_cipher.decrypt(token_hash.encode())
+    except InvalidToken:
+        return True
+    return False
+
+
+def rekey_password_hash(token_hash: str) -> str:
+    """Re-cifra el hash con la clave primaria."""
+    return cipher_suite.rotate(token_hash.encode()).decode()
+
+
+def create_executor(workers: int, fernet_keys: List[str]) -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=configure,
+        initargs=(list(fernet_keys),),
+    )
@@ -7,17 +7,26 @@ import { useAuth } from '../../common/context/AuthContext'
 export default function Orders() {
   const { token } = useAuth()
   const [orders, setOrders] = useState([])
+  const [nextCursor, setNextCursor] = useState(null)
   const [loading, setLoading] = useState(true)
+  const [loadingMore, setLoadingMore] = useState(false)
   const [error, setError] = useState('')
 
+  // list_orders pagina de la más reciente a la más antigua; next_cursor pide la siguiente página
+  async function fetchPage(cursor) {
+    const { data } = await api.get('/orders/', {
+      headers: { Authorization: `Bearer ${token}` },
+      params: cursor ? { cursor } : {}
+    })
+    setNextCursor(data.next_cursor)
+    return data.items
+  }
+
   useEffect(() => {
     async function fetchOrders() {
       setLoading(true)
       try {
-        const { data } = await api.get('/orders/', {
-          headers: { Authorization: `Bearer ${token}` }
-        })
-        setOrders(data)  // list_orders devuelve todas las órdenes para admin
+        setOrders(await fetchPage(null))
       } catch (err) {
         setError(err.response?.data?.detail || 'Error al cargar las órdenes')
       } finally {
@@ -27,6 +36,18 @@ export default function Orders() {
     fetchOrders()
   }, [token])
 
+  async function loadMore() {
+    setLoadingMore(true)
+    try {
+      const items = await fetchPage(nextCursor)
+      setOrders(prev => [...prev, ...items])
+    } catch (err) {
+      setError(err.response?.data?.detail || 'Error al cargar las órdenes')
+    } finally {
+      setLoadingMore(false)
+    }
+  }
+
   if (loading) return <p className="text-center py-6">Cargando órdenes…</p>
   if (error)   return <p className="text-center py-6 text-red-600">{error}</p>
 
@@ -68,6 +89,17 @@ export default function Orders() {
           </tbody>
         </table>
       </div>
+      {nextCursor && (
+        <div className="text-center">
+          <button
+            onClick={loadMore}
+            disabled={loadingMore}
+            className="bg-blue-500 hover:bg-blue-600 text-white px-4 py-2 rounded-lg font-medium disabled:opacity-50"
+          >
+            {loadingMore ? 'Cargando…' : 'Cargar más'}
+          </button>
+        </div>
+      )}
     </div>
   )
 }
@@ -20,12 +20,39 @@ export default function ProductForm() {
   const [imageOption, setImageOption] = useState('upload') // 'upload' | 'existing'
   const [file, setFile] = useState(null)
   const [existingImages, setExistingImages] = useState([])
+  const [imagePrefix, setImagePrefix] = useState('')
+  const [imagesCursor, setImagesCursor] = useState(null)
+  const [loadingImages, setLoadingImages] = useState(false)
   const [selectedImage, setSelectedImage] = useState('')
 
   const [error, setError] = useState('')
   const [loading, setLoading] = useState(false)
 
-  // Cargar datos iniciales: categorías, imágenes S3 y producto (si es edición)
+  // Imágenes S3 por páginas (el bucket puede tener miles): filtra por prefijo y pide más con next_cursor
+  async function fetchImages(prefix, cursor) {
+    setLoadingImages(true)
+    try {
+      const { data } = await api.get('/admin/s3-images', {
+        headers: { Authorization: `Bearer ${token}` },
+        params: { prefix, ...(cursor ? { cursor } : {}) }
+      })
+      setExistingImages(prev => (cursor ? [...prev, ...data.images] : data.images))
+      setImagesCursor(data.next_cursor)
+    } catch (err) {
+      setError('Error cargando imágenes')
+      console.error(err)
+    } finally {
+      setLoadingImages(false)
+    }
+  }
+
+  useEffect(() => {
+    if (imageOption !== 'existing') return
+    const timer = setTimeout(() => fetchImages(imagePrefix, null), 300)
+    return () => clearTimeout(timer)
+  }, [imageOption, imagePrefix, token])
+
+  // Cargar datos iniciales: categorías y producto (si es edición)
   useEffect(() => {
     async function fetchData() {
       try {
@@ -35,12 +62,6 @@ export default function ProductForm() {
         })
         setCategories(cats)
 
-        // Imágenes S3
-        const { data } = await api.get('/admin/s3-images', {
-          headers: { Authorization: `Bearer ${token}` }
-        })
-        setExistingImages(data.images)
-
         // Producto (modo edición)
         if (isEdit) {
           const { data: prod } = await api.get(`/products/${id}`, {
@@ -219,18 +240,41 @@ export default function ProductForm() {
               className="border rounded px-2 py-1"
             />
           ) : (
-            <select
-              value={selectedImage}
-              onChange={e => setSelectedImage(e.target.value)}
-              className="w-full border rounded px-3 py-2"
-            >
-              <option value="">-- Elige una imagen --</option>
-              {existingImages.map(img => (
-                <option key={img.key} value={img.key}>
-                  {img.key.split('/').pop()}
-                </option>
-              ))}
-            </select>
+            <div className="space-y-2">
+              <input
+                type="text"
+                value={imagePrefix}
+                onChange={e => setImagePrefix(e.target.value)}
+                placeholder="Buscar por prefijo (ej. productos/ibu)"
+                className="w-full border rounded px-3 py-2"
+              />
+              <select
+                value={selectedImage}
+                onChange={e => setSelectedImage(e.target.value)}
+                className="w-full border rounded px-3 py-2"
+              >
+                <option value="">-- Elige una imagen --</option>
+                {/* La imagen actual del producto puede no estar en las páginas cargadas */}
+                {selectedImage && !existingImages.some(img => img.key === selectedImage) && (
+                  <option value={selectedImage}>{selectedImage.split('/').pop()}</option>
+                )}
+                {existingImages.map(img => (
+                  <option key={img.key} value={img.key}>
+                    {img.key.split('/').pop()}
+                  </option>
+                ))}
+              </select>
+              {imagesCursor && (
+                <button
+                  type="button"
+                  onClick={() => fetchImages(imagePrefix, imagesCursor)}
+                  disabled={loadingImages}
+                  className="text-blue-600 hover:text-blue-800 text-sm disabled:opacity-50"
+                >
+                  {loadingImages ? 'Cargando…' : 'Cargar más imágenes'}
+                </button>
+              )}
+            </div>
           )}
         </div>
 
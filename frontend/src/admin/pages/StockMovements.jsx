@@ -6,18 +6,27 @@ import { useAuth } from '../../common/context/AuthContext'
 export default function StockMovements() {
   const { token } = useAuth()
   const [movements, setMovements] = useState([])
+  const [nextCursor, setNextCursor] = useState(null)
   const [loading, setLoading] = useState(true)
+  const [loadingMore, setLoadingMore] = useState(false)
   const [error, setError] = useState('')
 
+  // El backend pagina por (fecha, id); next_cursor pide la siguiente página
+  async function fetchPage(cursor) {
+    const { data } = await api.get('/stock_movements/', {
+      headers: { Authorization: `Bearer ${token}` },
+      params: cursor ? { cursor } : {}
+    })
+    setNextCursor(data.next_cursor)
+    return data.items
+  }
+
   useEffect(() => {
     async function fetchMovements() {
       setLoading(true)
       setError('')
       try {
-        const { data } = await api.get('/stock_movements/', {
-          headers: { Authorization: `Bearer ${token}` }
-        })
-        setMovements(data)
+        setMovements(await fetchPage(null))
       } catch (err) {
         setError(err.response?.data?.detail || 'Error al cargar los movimientos de stock')
       }
@@ -26,6 +35,17 @@ export default function StockMovements() {
     fetchMovements()
   }, [token])
 
+  async function loadMore() {
+    setLoadingMore(true)
+    try {
+      const items = await fetchPage(nextCursor)
+      setMovements(prev => [...prev, ...items])
+    } catch (err) {
+      setError(err.response?.data?.detail || 'Error al cargar los movimientos de stock')
+    }
+    setLoadingMore(false)
+  }
+
   if (loading) return <p className="text-center py-6">Cargando movimientos de stock…</p>
   if (error)   return <p className="text-red-600 text-center py-6">{error}</p>
 
@@ -64,6 +84,17 @@ export default function StockMovements() {
           </tbody>
         </table>
       </div>
+      {nextCursor && (
+        <div className="text-center">
+          <button
+            onClick={loadMore}
+            disabled={loadingMore}
+            className="bg-blue-500 hover:bg-blue-600 text-white px-4 py-2 rounded-lg font-medium disabled:opacity-50"
+          >
+            {loadingMore ? 'Cargando…' : 'Cargar más'}
+          </button>
+        </div>
+      )}
     </div>
   )
 }
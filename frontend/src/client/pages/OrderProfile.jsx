@@ -6,7 +6,9 @@ import api from '../../common/services/api'
 export default function OrderProfile() {
   const { token } = useAuth()
   const [orders, setOrders] = useState([])
+  const [nextCursor, setNextCursor] = useState(null)
   const [loading, setLoading] = useState(true)
+  const [loadingMore, setLoadingMore] = useState(false)
   const [error, setError] = useState('')
   const navigate = useNavigate()
 
@@ -20,7 +22,8 @@ export default function OrderProfile() {
         const { data } = await api.get('/orders', {
           headers: { Authorization: `Bearer ${token}` }
         })
-        setOrders(data)
+        setOrders(data.items)
+        setNextCursor(data.next_cursor)
       } catch (err) {
         setError(err.response?.data?.detail || 'Error al cargar tus pedidos')
       } finally {
@@ -30,6 +33,22 @@ export default function OrderProfile() {
     fetchOrders()
   }, [token, navigate])
 
+  async function loadMore() {
+    setLoadingMore(true)
+    try {
+      const { data } = await api.get('/orders', {
+        headers: { Authorization: `Bearer ${token}` },
+        params: { cursor: nextCursor }
+      })
+      setOrders(prev => [...prev, ...data.items])
+      setNextCursor(data.next_cursor)
+    } catch (err) {
+      setError(err.response?.data?.detail || 'Error al cargar tus pedidos')
+    } finally {
+      setLoadingMore(false)
+    }
+  }
+
   if (loading) {
     return (
       <div className="flex justify-center items-center py-20">
@@ -128,6 +147,17 @@ export default function OrderProfile() {
           </li>
         ))}
       </ul>
+      {nextCursor && (
+        <div className="text-center mt-6">
+          <button
+            onClick={loadMore}
+            disabled={loadingMore}
+            className="bg-blue-500 hover:bg-blue-600 text-white px-4 py-2 rounded-lg font-medium disabled:opacity-50"
+          >
+            {loadingMore ? 'Cargando…' : 'Cargar más'}
+          </button>
+        </div>
+      )}
     </div>
   )
 }